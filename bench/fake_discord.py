@@ -0,0 +1,271 @@
+"""In-process stand-ins for the Discord gateway and REST API.
+
+Only the parts of discord.py the bot touches are faked. Every REST call
+sleeps for the configured latency, can fail with the configured error rate
+and is counted per route. Message sends are held to Discord's per-channel
+limit like discord.py does after a 429. Messages the bot sends are echoed
+back to `on_message`, like the gateway does.
+"""
+from collections import Counter, deque
+from types import SimpleNamespace
+from typing import Awaitable, Callable, Deque, Dict, List, Optional
+import asyncio
+import contextlib
+import itertools
+import random
+import time
+
+import discord
+
+_ids = itertools.count(10**17)
+
+
+class FakeRest:
+    def __init__(
+        self,
+        latency_seconds: float,
+        error_rate: float,
+        sends_per_window: int = 5,
+        window_seconds: float = 5.0,
+        seed: int = 0,
+    ):
+        self.latency_seconds = latency_seconds
+        self.error_rate = error_rate
+        self.sends_per_window = sends_per_window
+        self.window_seconds = window_seconds
+        self.random = random.Random(seed)
+        self.calls: Counter = Counter()
+        self.errors = 0
+        self.rate_limited = 0
+        self._sent_at: Dict[int, Deque[float]] = {}
+
+    async def call(self, route: str, channel_id: Optional[int] = None):
+        self.calls[route] += 1
+        if route == "send" and channel_id is not None:
+            await self._rate_limit(channel_id)
+        if self.latency_seconds:
+            await asyncio.sleep(self.latency_seconds * self.random.uniform(0.5, 1.5))
+        if self.error_rate and self.random.random() < self.error_rate:
+            self.errors += 1
+            raise discord.HTTPException(
+                SimpleNamespace(status=500, reason="Fake Server Error"), "fake error"
+            )
+
+    async def _rate_limit(self, channel_id: int):
+        sent_at = self._sent_at.setdefault(channel_id, deque())
+        now = time.monotonic()
+        while sent_at and now - sent_at[0] >= self.window_seconds:
+            sent_at.popleft()
+        if len(sent_at) >= self.sends_per_window:
+            # a 429, which discord.py waits out before retrying
+            self.rate_limited += 1
+            self.calls["send"] += 1
+            await asyncio.sleep(sent_at[0] + self.window_seconds - now)
+            sent_at.popleft()
+        sent_at.append(time.monotonic())
+
+    @property
+    def total_calls(self) -> int:
+        return sum(self.calls.values())
+
+
+class FakeUser:
+    def __init__(self, name: str, bot: bool = False):
+        self.id = next(_ids)
+        self.name = name
+        self.bot = bot
+        self.mention = f"<@{self.id}>"
+        self.roles: List = []
+
+    def __str__(self):
+        return self.name
+
+
+class FakeMessage:
+    def __init__(self, channel: "FakeChannel", author: FakeUser, content: str, embeds=()):
+        self.id = next(_ids)
+        self.channel = channel
+        self.guild = channel.guild
+        self.author = author
+        self.content = content
+        self.embeds = list(embeds)
+        self.type = discord.MessageType.default
+        self.reference = None
+        self.created_at = discord.utils.utcnow()
+        self.jump_url = f"https://discord.com/channels/{channel.guild.id}/{channel.id}/{self.id}"
+
+    async def edit(self, content=None, embed=None, **kwargs):
+        await self.channel.guild.rest.call("edit", self.channel.id)
+        if content is not None:
+            self.content = content
+        if embed is not None:
+            self.embeds = [embed]
+        return self
+
+    async def delete(self):
+        await self.channel.guild.rest.call("delete", self.channel.id)
+        self.channel.messages.pop(self.id, None)
+
+
+class FakeChannel:
+    def __init__(self, guild: "FakeGuild", name: str, category=None):
+        self.id = next(_ids)
+        self.guild = guild
+        self.name = name
+        self.category = category
+        self.mention = f"<#{self.id}>"
+        self.jump_url = f"https://discord.com/channels/{guild.id}/{self.id}"
+        self.created_at = discord.utils.utcnow()
+        self.messages: Dict[int, FakeMessage] = {}
+        self.text_channels: List["FakeChannel"] = []
+        self.channels: List["FakeChannel"] = []
+        self.on_bot_message: Optional[Callable[[FakeMessage], None]] = None
+
+    def post(self, author: FakeUser, content: str) -> FakeMessage:
+        """A message arriving from the gateway."""
+        message = FakeMessage(self, author, content)
+        self.messages[message.id] = message
+        return message
+
+    async def send(self, content=None, embed=None, embeds=None, **kwargs) -> FakeMessage:
+        await self.guild.rest.call("send", self.id)
+        message = FakeMessage(
+            self, self.guild.me, content or "", embeds or ([embed] if embed else [])
+        )
+        self.messages[message.id] = message
+        self.guild.echo(message)
+        if self.on_bot_message is not None:
+            self.on_bot_message(message)
+        return message
+
+    async def history(self, limit: int = 100):
+        await self.guild.rest.call("history", self.id)
+        for message in list(reversed(self.messages.values()))[:limit]:
+            yield message
+
+    @contextlib.asynccontextmanager
+    async def typing(self):
+        await self.guild.rest.call("typing", self.id)
+        yield
+
+    async def edit(self, name=None, overwrites=None, reason=None, **kwargs):
+        await self.guild.rest.call("edit_channel", self.id)
+        if name is not None:
+            self.name = name
+        return self
+
+    async def delete(self, reason=None):
+        await self.guild.rest.call("delete_channel", self.id)
+        self.guild.remove_channel(self)
+
+
+class FakeGuild:
+    def __init__(self, guild_id: int, rest: FakeRest, bot_user: FakeUser):
+        self.id = guild_id
+        self.rest = rest
+        self.me = bot_user
+        self.default_role = FakeUser("@everyone")
+        self.channels: Dict[int, FakeChannel] = {}
+        self.members: Dict[int, FakeUser] = {}
+        self.category: Optional[FakeChannel] = None
+        self.on_message: Optional[Callable[[FakeMessage], Awaitable[None]]] = None
+        self._echoes = set()
+
+    def get_channel(self, channel_id: int) -> Optional[FakeChannel]:
+        return self.channels.get(channel_id)
+
+    async def fetch_channel(self, channel_id: int) -> FakeChannel:
+        await self.rest.call("fetch_channel")
+        if channel_id not in self.channels:
+            raise discord.NotFound(SimpleNamespace(status=404, reason="Not Found"), "unknown channel")
+        return self.channels[channel_id]
+
+    def get_member(self, user_id: int) -> Optional[FakeUser]:
+        return self.members.get(user_id)
+
+    async def fetch_member(self, user_id: int) -> FakeUser:
+        await self.rest.call("fetch_member")
+        if user_id not in self.members:
+            raise discord.NotFound(SimpleNamespace(status=404, reason="Not Found"), "unknown member")
+        return self.members[user_id]
+
+    def add_category(self, category_id: int) -> FakeChannel:
+        category = FakeChannel(self, "AI Chats")
+        category.id = category_id
+        self.channels[category_id] = category
+        self.category = category
+        return category
+
+    async def create_text_channel(self, name, category=None, overwrites=None, reason=None):
+        await self.rest.call("create_channel")
+        channel = FakeChannel(self, name, category=category or self.category)
+        self.channels[channel.id] = channel
+        if channel.category is not None:
+            channel.category.text_channels.append(channel)
+            channel.category.channels.append(channel)
+        return channel
+
+    def remove_channel(self, channel: FakeChannel):
+        self.channels.pop(channel.id, None)
+        if channel.category is not None and channel in channel.category.text_channels:
+            channel.category.text_channels.remove(channel)
+            channel.category.channels.remove(channel)
+
+    def echo(self, message: FakeMessage):
+        """Delivers the bot's own message back through the gateway."""
+        if self.on_message is not None:
+            task = asyncio.create_task(self.on_message(message))
+            self._echoes.add(task)
+            task.add_done_callback(self._echoes.discard)
+
+
+class FakeResponse:
+    def __init__(self, rest: FakeRest):
+        self.rest = rest
+        self._done = False
+
+    def is_done(self) -> bool:
+        return self._done
+
+    async def defer(self, ephemeral: bool = False):
+        await self.rest.call("interaction_defer")
+        self._done = True
+
+    async def send_message(self, content=None, ephemeral: bool = False, **kwargs):
+        await self.rest.call("interaction_response")
+        self._done = True
+
+
+class FakeFollowup:
+    def __init__(self, rest: FakeRest):
+        self.rest = rest
+        self.messages: List[str] = []
+
+    async def send(self, content=None, ephemeral: bool = False, **kwargs):
+        await self.rest.call("interaction_followup")
+        self.messages.append(content)
+
+
+class FakeInteraction:
+    def __init__(self, guild: FakeGuild, user: FakeUser, channel: Optional[FakeChannel] = None):
+        self.guild = guild
+        self.user = user
+        self.channel = channel
+        self.response = FakeResponse(guild.rest)
+        self.followup = FakeFollowup(guild.rest)
+
+
+def install(client: discord.Client, guild: FakeGuild):
+    """Points the real discord.Client's lookups at the fake guild."""
+    client._connection.user = guild.me
+    client.get_channel = guild.get_channel
+    client.get_user = lambda user_id: guild.members.get(user_id)
+
+    async def fetch_channel(channel_id: int):
+        return await guild.fetch_channel(channel_id)
+
+    async def fetch_user(user_id: int):
+        return await guild.fetch_member(user_id)
+
+    client.fetch_channel = fetch_channel
+    client.fetch_user = fetch_user
@@ -0,0 +1,191 @@
+"""A local HTTP server speaking enough of the OpenAI API for the bot.
+
+Serves chat completions (plain and streamed), moderations and the model
+list, with configurable latency, error rate and a requests-per-minute limit
+that answers 429 with Retry-After and sends x-ratelimit headers.
+"""
+from collections import Counter, deque
+from typing import Deque, Optional
+import asyncio
+import json
+import random
+import time
+
+from aiohttp import web
+
+MODERATION_CATEGORIES = [
+    "harassment",
+    "harassment/threatening",
+    "hate",
+    "hate/threatening",
+    "self-harm",
+    "self-harm/instructions",
+    "self-harm/intent",
+    "sexual",
+    "sexual/minors",
+    "violence",
+    "violence/graphic",
+]
+REPLY_WORDS = (
+    "For TikTok uploads keep the bitrate high and export at 1080p so the app "
+    "doesn't compress the clip twice. Add captions early, they help retention."
+).split()
+
+
+class FakeOpenAI:
+    def __init__(
+        self,
+        latency_seconds: float = 0.2,
+        error_rate: float = 0.0,
+        requests_per_minute: int = 0,
+        reply_words: int = 60,
+        seed: int = 0,
+    ):
+        self.latency_seconds = latency_seconds
+        self.error_rate = error_rate
+        self.requests_per_minute = requests_per_minute
+        self.reply_words = reply_words
+        self.random = random.Random(seed)
+        self.calls: Counter = Counter()
+        self.errors = 0
+        self.rate_limited = 0
+        self._requests: Deque[float] = deque()
+        self._runner: Optional[web.AppRunner] = None
+        self.base_url = ""
+
+    @property
+    def total_calls(self) -> int:
+        return sum(self.calls.values())
+
+    async def start(self) -> str:
+        app = web.Application()
+        app.router.add_post("/v1/chat/completions", self._chat)
+        app.router.add_post("/v1/moderations", self._moderations)
+        app.router.add_get("/v1/models", self._models)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, "127.0.0.1", 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.base_url = f"http://127.0.0.1:{port}/v1"
+        return self.base_url
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+
+    def _rate_limit_headers(self) -> dict:
+        limit = self.requests_per_minute or 10000
+        return {
+            "x-ratelimit-limit-requests": str(limit),
+            "x-ratelimit-remaining-requests": str(max(limit - len(self._requests), 0)),
+            "x-ratelimit-reset-requests": "1s",
+        }
+
+    async def _admit(self, route: str) -> Optional[web.Response]:
+        """Returns an error response if the request should fail."""
+        self.calls[route] += 1
+        now = time.monotonic()
+        while self._requests and now - self._requests[0] >= 60:
+            self._requests.popleft()
+        if self.requests_per_minute and len(self._requests) >= self.requests_per_minute:
+            self.rate_limited += 1
+            retry_after = self._requests[0] + 60 - now
+            return web.json_response(
+                {"error": {"message": "Rate limit reached", "type": "requests"}},
+                status=429,
+                headers={**self._rate_limit_headers(), "retry-after": f"{retry_after:.3f}"},
+            )
+        self._requests.append(now)
+        if self.latency_seconds:
+            await asyncio.sleep(self.latency_seconds * self.random.uniform(0.5, 1.5))
+        if self.error_rate and self.random.random() < self.error_rate:
+            self.errors += 1
+            return web.json_response(
+                {"error": {"message": "The server had an error", "type": "server_error"}},
+                status=500,
+            )
+        return None
+
+    def _reply(self) -> str:
+        return " ".join(REPLY_WORDS[i % len(REPLY_WORDS)] for i in range(self.reply_words))
+
+    async def _chat(self, request: web.Request) -> web.StreamResponse:
+        error = await self._admit("chat")
+        if error is not None:
+            return error
+        body = await request.json()
+        model = body.get("model", "gpt-3.5-turbo")
+        prompt_chars = sum(len(m.get("content") or "") for m in body.get("messages", []))
+        reply = self._reply()
+        if not body.get("stream"):
+            return web.json_response(
+                {
+                    "id": "chatcmpl-fake",
+                    "object": "chat.completion",
+                    "created": int(time.time()),
+                    "model": model,
+                    "choices": [
+                        {
+                            "index": 0,
+                            "message": {"role": "assistant", "content": reply},
+                            "finish_reason": "stop",
+                        }
+                    ],
+                    "usage": {
+                        "prompt_tokens": prompt_chars // 4,
+                        "completion_tokens": len(reply) // 4,
+                        "total_tokens": prompt_chars // 4 + len(reply) // 4,
+                    },
+                },
+                headers=self._rate_limit_headers(),
+            )
+
+        response = web.StreamResponse(
+            headers={"Content-Type": "text/event-stream", **self._rate_limit_headers()}
+        )
+        await response.prepare(request)
+        try:
+            for word in reply.split(" "):
+                chunk = {
+                    "id": "chatcmpl-fake",
+                    "object": "chat.completion.chunk",
+                    "created": int(time.time()),
+                    "model": model,
+                    "choices": [{"index": 0, "delta": {"content": word + " "}, "finish_reason": None}],
+                }
+                await response.write(f"data: {json.dumps(chunk)}\n\n".encode())
+                await asyncio.sleep(0.005)
+            await response.write(b"data: [DONE]\n\n")
+            await response.write_eof()
+        except ConnectionResetError:
+            pass  # the client closed the stream early, like a superseded reply does
+        return response
+
+    async def _moderations(self, request: web.Request) -> web.Response:
+        error = await self._admit("moderations")
+        if error is not None:
+            return error
+        body = await request.json()
+        inputs = body["input"] if isinstance(body["input"], list) else [body["input"]]
+        return web.json_response(
+            {
+                "id": "modr-fake",
+                "model": body.get("model", "text-moderation-latest"),
+                "results": [
+                    {
+                        "flagged": False,
+                        "categories": {c: False for c in MODERATION_CATEGORIES},
+                        "category_scores": {c: 0.0001 for c in MODERATION_CATEGORIES},
+                    }
+                    for _ in inputs
+                ],
+            },
+            headers=self._rate_limit_headers(),
+        )
+
+    async def _models(self, request: web.Request) -> web.Response:
+        self.calls["models"] += 1
+        return web.json_response(
+            {"object": "list", "data": [{"id": "gpt-3.5-turbo", "object": "model"}]}
+        )
@@ -0,0 +1,390 @@
+"""Offline load test and benchmarks.
+
+Drives the bot's real /chat, on_message and inactivity code paths against
+the fake Discord layer in bench/fake_discord.py and the local fake OpenAI
+server in bench/fake_openai.py, then runs a few micro benchmarks of the
+hot helpers. No network access or API keys are needed.
+
+    python -m bench.run --channels 50 --turns 5
+    python -m bench.run --json results.json
+    python -m bench.run --baseline results.json  # exits 1 on a regression
+"""
+import argparse
+import asyncio
+import datetime
+import json
+import logging
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+from typing import Callable, Dict, List
+
+from bench.fake_discord import FakeGuild, FakeInteraction, FakeRest, FakeUser, install
+from bench.fake_openai import FakeOpenAI
+
+GUILD_ID = 1000
+MODEL = "gpt-3.5-turbo"
+MODERATION_REPLAY = os.path.join(os.path.dirname(__file__), "moderation_replay.txt")
+QUESTIONS = [
+    "What bitrate should I export my TikTok videos at?",
+    "How do I add captions that people actually read?",
+    "What should I name my clips so they get found?",
+    "Is 60fps worth it for gameplay clips?",
+    "How long should a hook be?",
+]
+
+
+def percentile(values: List[float], p: float) -> float:
+    if not values:
+        return float("nan")
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, round(p / 100 * (len(ordered) - 1)))]
+
+
+def summarize(values: List[float]) -> Dict[str, float]:
+    return {
+        "p50_ms": percentile(values, 50) * 1000,
+        "p95_ms": percentile(values, 95) * 1000,
+        "p99_ms": percentile(values, 99) * 1000,
+    }
+
+
+def traced_src_bytes() -> int:
+    snapshot = tracemalloc.take_snapshot().filter_traces(
+        [tracemalloc.Filter(True, f"*{os.sep}src{os.sep}*")]
+    )
+    return sum(stat.size for stat in snapshot.statistics("filename"))
+
+
+def bench_micro(main) -> Dict[str, float]:
+    """Microseconds per call of the hot helpers."""
+    from src.base import Message
+    from src.completion import ConversationSummaries, ConversationSummary, render_prompt
+    from src.moderation import local_moderator
+    from src.utils import split_into_shorter_messages
+
+    history = [
+        Message(user=f"user{i % 2}", text=QUESTIONS[i % len(QUESTIONS)] * 3) for i in range(200)
+    ]
+    summaries = ConversationSummaries()
+    summaries._summaries[1] = ConversationSummary(text="summary", tail=tuple(history[100:103]))
+    summaries._refreshing[1] = None  # keep compact() from starting a refresh
+    reply = ("word " * 90 + "\n\n") * 15
+
+    def timed(func: Callable[[], object], runs: int) -> float:
+        started = time.perf_counter()
+        for _ in range(runs):
+            func()
+        return (time.perf_counter() - started) / runs * 1e6
+
+    return {
+        "prompt_render_us": timed(lambda: render_prompt(history, MODEL, 512), 200),
+        "compaction_us": timed(lambda: summaries.compact(1, history, MODEL), 200),
+        "moderation_fast_path_us": timed(lambda: local_moderator.check("ok thanks", "user"), 20000),
+        "reply_packing_us": timed(lambda: split_into_shorter_messages(reply), 2000),
+    }
+
+
+def bench_moderation_replay(path: str) -> Dict[str, float]:
+    """Share of a replayed chat's messages the local moderation tier decides
+    without the API, with the configured block terms and safe words. The
+    bundled chat is hand-written around the safe words, so the share is an
+    upper bound, not what real chats get."""
+    from src.constants import (
+        MODERATION_BLOCK_TERMS,
+        MODERATION_FAST_PATH_MAX_CHARS,
+        MODERATION_SAFE_WORDS,
+    )
+    from src.moderation import LocalModerator
+
+    moderator = LocalModerator(
+        block_terms=MODERATION_BLOCK_TERMS,
+        safe_words=MODERATION_SAFE_WORDS,
+        max_safe_chars=MODERATION_FAST_PATH_MAX_CHARS,
+    )
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if line.strip() and not line.startswith("#"):
+                moderator.check(line.rstrip("\n"), "user")
+    return {"moderation_avoided_fraction_upper_bound": moderator.stats.avoided_fraction}
+
+
+async def bench_session_recovery(count: int) -> Dict[str, float]:
+    """Startup recovery of `count` stored sessions: loading them from SQLite
+    and dropping the ones whose channel was deleted while the bot was down,
+    then one flush after every session was touched."""
+    from src.base import ThreadConfig
+    from src.sessions import Session, SessionStore, SQLiteSessionBackend
+
+    config = ThreadConfig(model=MODEL, max_tokens=512, temperature=1.0)
+    now = datetime.datetime.now()
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "sessions.db")
+        SQLiteSessionBackend(path).write(
+            [Session(i, GUILD_ID, i, config, now) for i in range(1, count + 1)], []
+        )
+        store = SessionStore(SQLiteSessionBackend(path), flush_seconds=3600)
+        started = time.perf_counter()
+        await store.load()
+        store.reconcile(GUILD_ID, (i for i in range(1, count + 1) if i % 20))
+        recovered = time.perf_counter() - started
+        for session in store.values():
+            store.touch(session.channel_id)
+        started = time.perf_counter()
+        await store.flush()
+        flushed = time.perf_counter() - started
+    return {"session_recovery_ms": recovered * 1000, "session_flush_ms": flushed * 1000}
+
+
+async def bench_compaction(main, fake_openai: FakeOpenAI, turns: int) -> Dict[str, float]:
+    """Prompt tokens and bot side time per turn of one long session, with
+    and without compaction. Each summary is awaited before the next turn, as
+    users normally take longer to reply than the summary takes."""
+    from src.base import Message, ThreadConfig
+    from src.request_scheduler import RequestScheduler
+    from src.tokens import token_stats
+
+    completion = main.completion
+    config = ThreadConfig(model=MODEL, max_tokens=256, temperature=1.0)
+    # the fake's latency doesn't depend on the prompt and a long session
+    # without compaction would wait on the token budget, leave both out
+    latency, fake_openai.latency_seconds = fake_openai.latency_seconds, 0
+    scheduler = completion.request_scheduler
+    completion.request_scheduler = RequestScheduler(
+        max_concurrent=scheduler.max_concurrent,
+        requests_per_minute=float("inf"),
+        tokens_per_minute=float("inf"),
+    )
+    compaction = completion.ENABLE_COMPACTION
+    results = {}
+    for enabled, label in ((False, "off"), (True, "on")):
+        completion.ENABLE_COMPACTION = enabled
+        channel = FakeUser(f"session-{label}")  # only the id is used
+        history, tokens, seconds = [], [], []
+        for turn in range(turns):
+            history.append(Message(user="user", text=QUESTIONS[turn % len(QUESTIONS)]))
+            prompt_tokens = token_stats.prompt_tokens
+            started = time.perf_counter()
+            response = await completion.generate_completion_response(
+                messages=history, user="user", thread_config=config, thread=channel
+            )
+            seconds.append(time.perf_counter() - started)
+            tokens.append(token_stats.prompt_tokens - prompt_tokens)
+            history.append(Message(user=completion.MY_BOT_NAME, text=response.reply_text or ""))
+            refreshing = completion.conversation_summaries._refreshing.get(channel.id)
+            if refreshing is not None:
+                await refreshing
+        completion.conversation_summaries.forget(channel.id)
+        results[f"compaction_{label}_prompt_tokens_per_turn"] = sum(tokens) / turns
+        results[f"compaction_{label}_last_turn_prompt_tokens"] = tokens[-1]
+        results[f"compaction_{label}_turn_ms"] = sum(seconds) / turns * 1000
+    completion.ENABLE_COMPACTION = compaction
+    completion.request_scheduler = scheduler
+    fake_openai.latency_seconds = latency
+    return results
+
+
+async def run(args) -> Dict[str, float]:
+    fake_openai = FakeOpenAI(
+        latency_seconds=args.openai_latency,
+        error_rate=args.openai_error_rate,
+        requests_per_minute=args.openai_rpm,
+        seed=args.seed,
+    )
+    os.environ.update(
+        DISCORD_BOT_TOKEN="bench",
+        DISCORD_CLIENT_ID="1",
+        OPENAI_API_KEY="sk-bench",
+        OPENAI_BASE_URL=await fake_openai.start(),
+        DEFAULT_MODEL=MODEL,
+        ALLOWED_SERVER_IDS=str(GUILD_ID),
+        SERVER_TO_MODERATION_CHANNEL=f"{GUILD_ID}:1",
+        SESSION_DB_PATH="",
+    )
+    os.environ.pop("OPENAI_BACKENDS", None)
+    os.environ.pop("METRICS_PORT", None)
+    from src import main
+
+    logging.getLogger().setLevel(logging.WARNING)
+    rest = FakeRest(
+        latency_seconds=args.discord_latency, error_rate=args.discord_error_rate, seed=args.seed
+    )
+    guild = FakeGuild(GUILD_ID, rest, FakeUser("bench-bot", bot=True))
+    guild.add_category(main.AI_CHATS_CATEGORY_ID)
+    owner = FakeUser("owner")
+    owner.id = main.SERVER_OWNER_ID
+    guild.members[owner.id] = owner
+    guild.on_message = main.on_message
+    install(main.client, guild)
+    # the fake server stands in for OpenAI, moderation included
+    main.backend_pool.backends[0].moderation = True
+    main.reply_scheduler.debounce_seconds = args.debounce
+    main.reply_scheduler.max_delay_seconds = max(args.debounce, main.reply_scheduler.max_delay_seconds)
+    main.inactivity_timers.start()
+    main.completion.ANSWER_CACHE = args.answer_cache
+    rng = random.Random(args.seed)
+
+    results = bench_micro(main)
+    results.update(bench_moderation_replay(args.moderation_replay))
+    results.update(await bench_session_recovery(args.recovery_sessions))
+    results.update(await bench_compaction(main, fake_openai, args.session_turns))
+    main.completion.STREAM_COMPLETIONS = args.stream
+    users = [FakeUser(f"user{i}") for i in range(args.channels)]
+    for user in users:
+        guild.members[user.id] = user
+
+    # /chat for every user at once
+    tracemalloc.start()
+    memory_before = traced_src_bytes()
+    chat_latencies = []
+
+    async def start_chat(user: FakeUser):
+        started = time.perf_counter()
+        await main.chat_command.callback(
+            FakeInteraction(guild, user),
+            message=rng.choice(QUESTIONS),
+            model=MODEL,
+            temperature=1.0,
+            max_tokens=256,
+        )
+        chat_latencies.append(time.perf_counter() - started)
+
+    await asyncio.gather(*(start_chat(user) for user in users))
+    await asyncio.sleep(0.1)  # let the gateway echoes settle
+    sessions_started = len(main.sessions)
+    results["memory_per_session_bytes"] = (traced_src_bytes() - memory_before) / max(
+        sessions_started, 1
+    )
+    tracemalloc.stop()
+    results.update({f"chat_{k}": v for k, v in summarize(chat_latencies).items()})
+    results["chat_sessions_started"] = sessions_started
+    if args.answer_cache:
+        results["answer_cache_hit_rate"] = main.answer_cache.stats.hit_rate
+
+    # every user talks in their channel, waiting for each reply
+    turn_latencies = []
+    timeouts = 0
+    discord_calls, openai_calls = rest.total_calls, fake_openai.total_calls
+
+    async def converse(user: FakeUser):
+        nonlocal timeouts
+        session = main.sessions.for_user(user.id)
+        if session is None:
+            return
+        channel = guild.get_channel(session.channel_id)
+        for _ in range(args.turns):
+            replied = asyncio.Event()
+
+            def on_bot_message(message):
+                notice = message.embeds and "queue" in (message.embeds[0].description or "")
+                if not notice:
+                    replied.set()
+
+            channel.on_bot_message = on_bot_message
+            started = time.perf_counter()
+            await main.on_message(channel.post(user, rng.choice(QUESTIONS)))
+            try:
+                await asyncio.wait_for(replied.wait(), args.turn_timeout)
+                turn_latencies.append(time.perf_counter() - started)
+            except asyncio.TimeoutError:
+                timeouts += 1
+            await asyncio.sleep(rng.uniform(0, args.think_time))
+
+    started = time.perf_counter()
+    await asyncio.gather(*(converse(user) for user in users))
+    elapsed = time.perf_counter() - started
+    turns = max(len(turn_latencies), 1)
+    results.update({f"turn_{k}": v for k, v in summarize(turn_latencies).items()})
+    results["turns_per_second"] = len(turn_latencies) / elapsed
+    results["turn_timeouts"] = timeouts
+    results["discord_calls_per_turn"] = (rest.total_calls - discord_calls) / turns
+    results["openai_calls_per_turn"] = (fake_openai.total_calls - openai_calls) / turns
+    results["discord_rate_limited"] = rest.rate_limited
+    results["openai_rate_limited"] = fake_openai.rate_limited
+
+    # every channel goes inactive and gets reminded and closed
+    timers = main.inactivity_timers
+    timers.remind_after_seconds, timers.close_after_seconds = 0.2, 0.4
+    started = time.perf_counter()
+    for session in main.sessions.values():
+        session.reminder_sent = False
+        session.last_activity = datetime.datetime.now()
+        timers.schedule(session)
+    while len(main.sessions) and time.perf_counter() - started < args.turn_timeout:
+        await asyncio.sleep(0.01)
+    results["inactivity_close_all_seconds"] = time.perf_counter() - started
+    results["inactivity_max_lateness_ms"] = timers.stats.max_lateness_seconds * 1000
+
+    await fake_openai.stop()
+    return results
+
+
+# results where a higher value is better, everything else should not go up
+HIGHER_IS_BETTER = {
+    "turns_per_second",
+    "chat_sessions_started",
+    "answer_cache_hit_rate",
+    "moderation_avoided_fraction_upper_bound",
+}
+COUNTS = {"turn_timeouts", "discord_rate_limited", "openai_rate_limited"}
+
+
+def regressions(results: Dict[str, float], baseline: Dict[str, float], tolerance: float) -> List[str]:
+    found = []
+    for key, old in baseline.items():
+        new = results.get(key)
+        if new is None or not old or key in COUNTS:
+            continue
+        change = (old - new) / old if key in HIGHER_IS_BETTER else (new - old) / old
+        if change > tolerance:
+            found.append(f"{key}: {old:.2f} -> {new:.2f} ({change:+.0%})")
+    for key in COUNTS:
+        if results.get(key, 0) > baseline.get(key, 0):
+            found.append(f"{key}: {baseline.get(key, 0)} -> {results[key]}")
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--channels", type=int, default=20, help="concurrent users, one chat channel each")
+    parser.add_argument("--turns", type=int, default=3, help="messages each user sends after /chat")
+    parser.add_argument("--think-time", type=float, default=0.5, help="max seconds between a reply and the next message")
+    parser.add_argument("--debounce", type=float, default=0.05, help="reply debounce, the bot's default is 1s")
+    parser.add_argument("--turn-timeout", type=float, default=60)
+    parser.add_argument("--openai-latency", type=float, default=0.2)
+    parser.add_argument("--openai-error-rate", type=float, default=0.0)
+    parser.add_argument("--openai-rpm", type=int, default=0, help="fake OpenAI request limit, 0 for none")
+    parser.add_argument("--discord-latency", type=float, default=0.05)
+    parser.add_argument("--discord-error-rate", type=float, default=0.0)
+    parser.add_argument("--moderation-replay", default=MODERATION_REPLAY, help="messages, one per line, to measure the local moderation tier on (# starts a comment line)")
+    parser.add_argument("--recovery-sessions", type=int, default=5000, help="stored sessions to restore in the startup recovery benchmark")
+    parser.add_argument("--session-turns", type=int, default=120, help="turns of the long session run with and without compaction")
+    parser.add_argument("--stream", action="store_true", help="post replies while they are generated")
+    parser.add_argument("--answer-cache", action="store_true", help="answer repeated first questions from the cache")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", help="write the results to this file")
+    parser.add_argument("--baseline", help="results file to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed slowdown against the baseline")
+    args = parser.parse_args()
+
+    results = asyncio.run(run(args))
+    width = max(len(key) for key in results)
+    for key, value in results.items():
+        print(f"{key:<{width}}  {value:,.2f}")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            found = regressions(results, json.load(f), args.tolerance)
+        for line in found:
+            print(f"REGRESSION {line}")
+        if found:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,212 @@
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Dict, FrozenSet, Optional, Set, Tuple
+import asyncio
+import hashlib
+import random
+import re
+import time
+import unicodedata
+
+from src.base import ThreadConfig
+from src.constants import (
+    ANSWER_CACHE_MAX_ENTRIES,
+    ANSWER_CACHE_SIMILARITY,
+    ANSWER_CACHE_TTL_SECONDS,
+)
+
+WORD = re.compile(r"\w+")
+NUMBER = re.compile(r"\d")
+MINHASH_BANDS = 16
+MINHASH_ROWS = 4  # per band, so questions from about 50% overlap become candidates
+PRIME = (1 << 61) - 1
+_rng = random.Random(0)
+PERMUTATIONS = [
+    (_rng.randrange(1, PRIME), _rng.randrange(PRIME))
+    for _ in range(MINHASH_BANDS * MINHASH_ROWS)
+]
+
+
+@dataclass
+class AnswerCacheStats:
+    hits: int = 0
+    near_hits: int = 0  # of the hits, the ones found by the near duplicate index
+    misses: int = 0
+    stores: int = 0
+    evictions: int = 0
+    saved_tokens: int = 0
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+
+@dataclass(frozen=True)
+class _Entry:
+    expires_at: float
+    config: ThreadConfig
+    shingles: FrozenSet[str]
+    numbers: FrozenSet[str]
+    bands: Tuple[int, ...]
+    answer: str
+    tokens: int
+
+
+def _words(question: str):
+    words = WORD.findall(unicodedata.normalize("NFKC", question).casefold())
+    # fold plurals, "video" and "videos" are the same question
+    return [w[:-1] if len(w) > 3 and w.endswith("s") and not w.endswith("ss") else w for w in words]
+
+
+def _shingles(words) -> FrozenSet[str]:
+    return frozenset(words) | frozenset(" ".join(pair) for pair in zip(words, words[1:]))
+
+
+def _hash(text: str) -> int:
+    return int.from_bytes(hashlib.blake2b(text.encode(), digest_size=8).digest(), "little")
+
+
+def _bands(shingles: FrozenSet[str]) -> Tuple[int, ...]:
+    hashes = [_hash(s) for s in shingles]
+    signature = [min((a * h + b) % PRIME for h in hashes) for a, b in PERMUTATIONS]
+    return tuple(
+        hash(tuple(signature[i : i + MINHASH_ROWS]))
+        for i in range(0, len(signature), MINHASH_ROWS)
+    )
+
+
+class AnswerCache:
+    """Answers to first questions of a chat, reused for repeats.
+
+    A question is looked up by a hash of its normalized words, then in a
+    MinHash LSH index of its words and word pairs, where candidates must
+    overlap by at least `similarity` (Jaccard) and mention the same numbers.
+    Entries are kept per model, temperature and max tokens, expire after
+    `ttl_seconds` and the least recently used ones are evicted past
+    `max_entries`. A question asked again while its answer is being
+    generated waits for that answer instead of generating its own.
+    """
+
+    def __init__(self, max_entries: int, ttl_seconds: float, similarity: float):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.similarity = similarity
+        self.stats = AnswerCacheStats()
+        self._entries: "OrderedDict[bytes, _Entry]" = OrderedDict()
+        self._index: Dict[Tuple[ThreadConfig, int, int], Set[bytes]] = {}
+        self._in_flight: Dict[bytes, asyncio.Future] = {}
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    @staticmethod
+    def key(words, config: ThreadConfig) -> bytes:
+        text = f"{config.model}|{config.temperature}|{config.max_tokens}|{' '.join(words)}"
+        return hashlib.blake2b(text.encode(), digest_size=16).digest()
+
+    async def get(self, question: str, config: ThreadConfig) -> Optional[str]:
+        words = _words(question)
+        entry = self._find(words, config)
+        if entry is None and words and self.key(words, config) in self._in_flight:
+            entry = await asyncio.shield(self._in_flight[self.key(words, config)])
+        if entry is None:
+            self.stats.misses += 1
+            return None
+        self.stats.hits += 1
+        self.stats.saved_tokens += entry.tokens
+        return entry.answer
+
+    def reserve(self, question: str, config: ThreadConfig) -> Optional[bytes]:
+        """Marks the answer to `question` as being generated, until `put` or
+        `release`. Returns None if it already is."""
+        words = _words(question)
+        if not words or self.key(words, config) in self._in_flight:
+            return None
+        key = self.key(words, config)
+        self._in_flight[key] = asyncio.get_running_loop().create_future()
+        return key
+
+    def release(self, key: bytes):
+        """Lets anyone waiting on a reserved answer that never came go ahead."""
+        future = self._in_flight.pop(key, None)
+        if future is not None and not future.done():
+            future.set_result(None)
+
+    def put(self, question: str, config: ThreadConfig, answer: str, tokens: int):
+        words = _words(question)
+        if not words:
+            return
+        key = self.key(words, config)
+        if key in self._entries:
+            self._remove(key)
+        shingles = _shingles(words)
+        entry = _Entry(
+            expires_at=time.monotonic() + self.ttl_seconds,
+            config=config,
+            shingles=shingles,
+            numbers=frozenset(w for w in words if NUMBER.search(w)),
+            bands=_bands(shingles),
+            answer=answer,
+            tokens=tokens,
+        )
+        self._entries[key] = entry
+        for i, band in enumerate(entry.bands):
+            self._index.setdefault((config, i, band), set()).add(key)
+        self.stats.stores += 1
+        future = self._in_flight.pop(key, None)
+        if future is not None and not future.done():
+            future.set_result(entry)
+        while len(self._entries) > self.max_entries:
+            self._remove(next(iter(self._entries)))
+            self.stats.evictions += 1
+
+    def _find(self, words, config: ThreadConfig) -> Optional[_Entry]:
+        if not words:
+            return None
+        key = self.key(words, config)
+        if key in self._entries:
+            return self._fresh(key)
+
+        shingles = _shingles(words)
+        numbers = frozenset(w for w in words if NUMBER.search(w))
+        candidates = set()
+        for i, band in enumerate(_bands(shingles)):
+            candidates |= self._index.get((config, i, band), set())
+        best, best_similarity = None, self.similarity
+        for candidate in candidates:
+            entry = self._entries[candidate]
+            if entry.numbers != numbers:
+                continue
+            similarity = len(shingles & entry.shingles) / len(shingles | entry.shingles)
+            if similarity >= best_similarity:
+                best, best_similarity = candidate, similarity
+        if best is None:
+            return None
+        entry = self._fresh(best)
+        if entry is not None:
+            self.stats.near_hits += 1
+        return entry
+
+    def _fresh(self, key: bytes) -> Optional[_Entry]:
+        entry = self._entries[key]
+        if entry.expires_at <= time.monotonic():
+            self._remove(key)
+            return None
+        self._entries.move_to_end(key)
+        return entry
+
+    def _remove(self, key: bytes):
+        entry = self._entries.pop(key)
+        for i, band in enumerate(entry.bands):
+            bucket = self._index[(entry.config, i, band)]
+            bucket.discard(key)
+            if not bucket:
+                del self._index[(entry.config, i, band)]
+
+
+answer_cache = AnswerCache(
+    max_entries=ANSWER_CACHE_MAX_ENTRIES,
+    ttl_seconds=ANSWER_CACHE_TTL_SECONDS,
+    similarity=ANSWER_CACHE_SIMILARITY,
+)
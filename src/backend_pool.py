@@ -0,0 +1,272 @@
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable, FrozenSet, List, Optional
+from urllib.parse import urlparse
+import asyncio
+import re
+import time
+
+import openai
+from openai import AsyncOpenAI
+
+from src.constants import (
+    OPENAI_BACKENDS,
+    COMPLETION_TIMEOUT_SECONDS,
+    OPENAI_HEALTH_CHECK_SECONDS,
+    MODERATION_MODEL,
+)
+from src.resilience import is_transient, retry_after_seconds
+from src.utils import logger
+from src.metrics import metrics
+
+DURATION_PART = re.compile(r"(\d+(?:\.\d+)?)(ms|s|m|h)")
+DURATION_UNITS = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+DEFAULT_LATENCY_SECONDS = 0.001
+
+
+def parse_reset(value: Optional[str]) -> Optional[float]:
+    """Parses rate limit reset durations like "1s", "250ms" or "6m0s"."""
+    if not value:
+        return None
+    parts = DURATION_PART.findall(value)
+    if not parts:
+        return None
+    return sum(float(n) * DURATION_UNITS[unit] for n, unit in parts)
+
+
+@dataclass
+class BackendStats:
+    requests: int = 0
+    errors: int = 0
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+
+
+class _RateLimit:
+    """What the last response's x-ratelimit headers said about one limit."""
+
+    def __init__(self):
+        self.limit: Optional[int] = None
+        self.remaining: Optional[int] = None
+        self.reset_at = 0.0
+
+    def update(self, headers, name: str, now: float):
+        try:
+            limit = headers.get(f"x-ratelimit-limit-{name}")
+            remaining = headers.get(f"x-ratelimit-remaining-{name}")
+            if limit is not None and remaining is not None:
+                self.limit, self.remaining = int(limit), int(remaining)
+        except ValueError:
+            return
+        reset = parse_reset(headers.get(f"x-ratelimit-reset-{name}"))
+        self.reset_at = now + reset if reset is not None else now + 60
+
+    def exhaust(self, seconds: float, now: float):
+        self.limit = self.limit or 1
+        self.remaining = 0
+        self.reset_at = now + seconds
+
+    def headroom(self, now: float) -> float:
+        if not self.limit or self.remaining is None or now >= self.reset_at:
+            return 1.0
+        return self.remaining / self.limit
+
+
+class OpenAIBackend:
+    """One API key and base URL, e.g. an OpenAI key or an OpenAI compatible
+    local server. `models` limits it to those models, empty means any.
+
+    Moderation requests only go to OpenAI itself, or to other servers whose
+    `models` name MODERATION_MODEL. Their rate limits are tracked apart from
+    the completion limits used for routing.
+    """
+
+    def __init__(
+        self,
+        api_key: str,
+        base_url: Optional[str] = None,
+        models: FrozenSet[str] = frozenset(),
+        client: Optional[AsyncOpenAI] = None,
+    ):
+        self.base_url = base_url
+        self.models = models
+        self.name = f"{base_url or 'openai'} (...{api_key[-4:]})"
+        self.moderation = (
+            base_url is None
+            or urlparse(base_url).hostname == "api.openai.com"
+            or MODERATION_MODEL in models
+        )
+        self.client = client or AsyncOpenAI(
+            api_key=api_key,
+            base_url=base_url,
+            # retries are done by completion_caller
+            max_retries=0,
+            timeout=COMPLETION_TIMEOUT_SECONDS,
+        )
+        self.stats = BackendStats()
+        self.healthy = True
+        self.in_flight = 0
+        self.latency_seconds: Optional[float] = None
+        self.requests_limit = _RateLimit()
+        self.tokens_limit = _RateLimit()
+        self.moderation_limit = _RateLimit()
+
+    def serves(self, model: Optional[str], moderation: bool = False) -> bool:
+        if moderation:
+            return self.moderation
+        return not self.models or model is None or model in self.models
+
+    def score(self, now: float, moderation: bool = False) -> float:
+        if moderation:
+            headroom = self.moderation_limit.headroom(now)
+        else:
+            headroom = min(self.requests_limit.headroom(now), self.tokens_limit.headroom(now))
+        # unmeasured backends look fast so each one gets tried
+        latency = self.latency_seconds or DEFAULT_LATENCY_SECONDS
+        return headroom / (latency * (1 + self.in_flight))
+
+    def record_response(self, headers, latency: float, moderation: bool = False):
+        now = time.monotonic()
+        self.stats.requests += 1
+        self.healthy = True
+        if moderation:
+            self.moderation_limit.update(headers, "requests", now)
+            return
+        self.requests_limit.update(headers, "requests", now)
+        self.tokens_limit.update(headers, "tokens", now)
+        if self.latency_seconds is None:
+            self.latency_seconds = latency
+        else:
+            self.latency_seconds += 0.2 * (latency - self.latency_seconds)
+
+    def record_usage(self, usage):
+        self.stats.prompt_tokens += getattr(usage, "prompt_tokens", 0) or 0
+        self.stats.completion_tokens += getattr(usage, "completion_tokens", 0) or 0
+
+    def record_error(self, error: Exception, moderation: bool = False):
+        self.stats.requests += 1
+        self.stats.errors += 1
+        if isinstance(error, openai.RateLimitError):
+            seconds = retry_after_seconds(error) or 1.0
+            limit = self.moderation_limit if moderation else self.requests_limit
+            limit.exhaust(seconds, time.monotonic())
+        elif is_transient(error) and self.healthy:
+            logger.warning(f"OpenAI backend {self.name} marked unhealthy: {error}")
+            self.healthy = False
+
+
+class _InFlightStream:
+    """A streamed completion that counts as in flight on its backend until
+    it has been read to the end, failed or been closed."""
+
+    def __init__(self, stream: openai.AsyncStream, backend: OpenAIBackend):
+        self._stream = stream
+        self._chunks = stream.__aiter__()
+        self._backend = backend
+        self._done = False
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            return await self._chunks.__anext__()
+        except BaseException:
+            self._finish()
+            raise
+
+    async def close(self):
+        self._finish()
+        await self._stream.close()
+
+    def _finish(self):
+        if not self._done:
+            self._done = True
+            self._backend.in_flight -= 1
+
+
+class BackendPool:
+    """Spreads OpenAI requests over several backends.
+
+    Each request goes to the healthy backend serving the model with the most
+    rate limit headroom (from the x-ratelimit headers of its last response)
+    per second of latency and request in flight. Backends that fail with
+    connection errors or 5xx are taken out until a health check succeeds.
+    """
+
+    def __init__(self, backends: List[OpenAIBackend], health_check_seconds: float):
+        self.backends = backends
+        self.health_check_seconds = health_check_seconds
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        if self._task is None and len(self.backends) > 1:
+            self._task = asyncio.create_task(self._health_check_loop())
+
+    def choose(self, model: Optional[str] = None, moderation: bool = False) -> OpenAIBackend:
+        candidates = [b for b in self.backends if b.serves(model, moderation)]
+        if not candidates:
+            raise ValueError(f"No OpenAI backend serves {'moderation' if moderation else model}")
+        healthy = [b for b in candidates if b.healthy] or candidates
+        now = time.monotonic()
+        return max(healthy, key=lambda b: b.score(now, moderation))
+
+    async def call(
+        self,
+        send: Callable[[AsyncOpenAI], Awaitable[Any]],
+        model: Optional[str] = None,
+        moderation: bool = False,
+    ) -> Any:
+        """Runs `send` with the chosen backend's client. `send` makes the
+        request with `with_raw_response` so the rate limit headers can be
+        read; the parsed response is returned."""
+        backend = self.choose(model, moderation)
+        backend.in_flight += 1
+        started_at = time.monotonic()
+        response = None
+        try:
+            raw = await send(backend.client)
+            response = raw.parse()
+        except Exception as e:
+            backend.record_error(e, moderation)
+            metrics.inc("openai_errors_total", error=type(e).__name__, model=model)
+            raise
+        finally:
+            # a stream stays in flight until it has been read or closed
+            if not isinstance(response, openai.AsyncStream):
+                backend.in_flight -= 1
+        backend.record_response(raw.headers, time.monotonic() - started_at, moderation)
+        if isinstance(response, openai.AsyncStream):
+            return _InFlightStream(response, backend)
+        usage = getattr(response, "usage", None)
+        if usage is not None:
+            backend.record_usage(usage)
+            metrics.inc("openai_tokens_total", usage.prompt_tokens or 0, kind="prompt", model=model)
+            metrics.inc(
+                "openai_tokens_total", usage.completion_tokens or 0, kind="completion", model=model
+            )
+        return response
+
+    async def _health_check_loop(self):
+        while True:
+            await asyncio.sleep(self.health_check_seconds)
+            for backend in self.backends:
+                if not backend.healthy:
+                    await self._check(backend)
+
+    async def _check(self, backend: OpenAIBackend):
+        try:
+            await backend.client.models.list()
+        except Exception as e:
+            logger.info(f"OpenAI backend {backend.name} still unhealthy: {e}")
+            return
+        logger.info(f"OpenAI backend {backend.name} is healthy again")
+        backend.healthy = True
+
+
+backend_pool = BackendPool(
+    backends=[
+        OpenAIBackend(api_key, base_url, models)
+        for api_key, base_url, models in OPENAI_BACKENDS
+    ],
+    health_check_seconds=OPENAI_HEALTH_CHECK_SECONDS,
+)
@@ -50,9 +50,10 @@ class Prompt:
     examples: List[Conversation]
     convo: Conversation
 
-    def full_render(self, bot_name):
+    def full_render(self, bot_name, system_message: Optional[dict] = None):
         messages = [
-            {
+            system_message
+            or {
                 "role": "system",
                 "content": self.render_system_prompt(),
             }
@@ -0,0 +1,148 @@
+from collections import deque
+from dataclasses import dataclass
+from typing import Awaitable, Callable, Deque, Dict, Optional, Tuple
+import asyncio
+import datetime
+
+import discord
+
+from src.utils import logger
+
+
+@dataclass
+class ChannelPoolStats:
+    claimed: int = 0
+    misses: int = 0
+    created: int = 0
+    expired: int = 0
+    failed: int = 0  # claims that failed and retired the channel
+
+
+class ChannelPool:
+    """Warm pool of hidden, pre-created chat channels.
+
+    Creating a channel with permission overwrites is one of the slowest and
+    most rate limited Discord calls. The pool keeps `size` channels ready so
+    /chat only has to rename one and set its overwrites; a background task
+    refills the pool and replaces channels older than `max_age_seconds`.
+    """
+
+    def __init__(
+        self,
+        size: int,
+        max_age_seconds: float,
+        create: Callable[[], Awaitable[Optional[discord.TextChannel]]],
+        retry_seconds: float = 30,
+    ):
+        self.size = size
+        self.max_age_seconds = max_age_seconds
+        self.create = create
+        self.retry_seconds = retry_seconds
+        self.stats = ChannelPoolStats()
+        self._channels: Deque[Tuple[datetime.datetime, discord.TextChannel]] = deque()
+        self._refill_needed: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        self._deleting = set()
+
+    def __len__(self) -> int:
+        return len(self._channels)
+
+    def __contains__(self, channel_id: int) -> bool:
+        return any(channel.id == channel_id for _, channel in self._channels)
+
+    def adopt(self, channel: discord.TextChannel) -> bool:
+        """Takes back a pool channel left over from before a restart, unless
+        it was ever used for a chat or is already in the pool."""
+        if channel.last_message_id is not None or channel.id in self:
+            return False
+        self._channels.append((channel.created_at, channel))
+        return True
+
+    def discard(self, channel_id: int):
+        self._channels = deque(
+            (created_at, channel)
+            for created_at, channel in self._channels
+            if channel.id != channel_id
+        )
+        self._wake()
+
+    def start(self):
+        if self.size > 0 and self._task is None:
+            self._refill_needed = asyncio.Event()
+            self._refill_needed.set()
+            self._task = asyncio.create_task(self._refill_loop())
+
+    async def claim(
+        self, name: str, overwrites: Dict, reason: str
+    ) -> Optional[discord.TextChannel]:
+        """Turns a pool channel into a chat channel, None if the pool is empty."""
+        while self._channels:
+            created_at, channel = self._channels.popleft()
+            self._wake()
+            if self._expired(created_at):
+                self.stats.expired += 1
+                self._retire(channel)
+                continue
+            try:
+                channel = await channel.edit(name=name, overwrites=overwrites, reason=reason)
+            except discord.NotFound:
+                continue
+            except discord.HTTPException as e:
+                logger.error(f"Failed to claim pool channel {channel.id}: {e}")
+                self.stats.failed += 1
+                self._retire(channel)
+                continue
+            self.stats.claimed += 1
+            return channel
+        self.stats.misses += 1
+        return None
+
+    def _seconds_left(self, created_at: datetime.datetime) -> float:
+        age = discord.utils.utcnow() - created_at
+        return self.max_age_seconds - age.total_seconds()
+
+    def _expired(self, created_at: datetime.datetime) -> bool:
+        return self._seconds_left(created_at) < 0
+
+    def _retire(self, channel: discord.TextChannel):
+        task = asyncio.create_task(self._delete(channel))
+        self._deleting.add(task)
+        task.add_done_callback(self._deleting.discard)
+
+    async def _delete(self, channel: discord.TextChannel):
+        try:
+            await channel.delete(reason="Retired warm pool channel")
+        except Exception as e:
+            logger.error(f"Failed to delete pool channel {channel.id}: {e}")
+
+    def _wake(self):
+        if self._refill_needed is not None:
+            self._refill_needed.set()
+
+    async def _refill_loop(self):
+        while True:
+            # sleep until a channel is claimed or the oldest one expires
+            timeout = (
+                self._seconds_left(self._channels[0][0]) if self._channels else None
+            )
+            try:
+                await asyncio.wait_for(self._refill_needed.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+            self._refill_needed.clear()
+
+            while self._channels and self._expired(self._channels[0][0]):
+                self.stats.expired += 1
+                self._retire(self._channels.popleft()[1])
+
+            while len(self._channels) < self.size:
+                try:
+                    channel = await self.create()
+                except Exception as e:
+                    logger.error(f"Failed to create pool channel: {e}")
+                    channel = None
+                if channel is None:
+                    await asyncio.sleep(self.retry_seconds)
+                    continue
+                self._channels.append((channel.created_at, channel))
+                self.stats.created += 1
@@ -1,25 +1,45 @@
 from enum import Enum
-from dataclasses import dataclass
+from dataclasses import dataclass, field
+import asyncio
+import functools
+import time
 import openai
-from openai import AsyncOpenAI
 
 from src.moderation import moderate_message
-from typing import Optional, List
+from typing import Awaitable, Callable, Dict, Optional, List, Tuple
 from src.constants import (
     BOT_INSTRUCTIONS,
     BOT_NAME,
+    CONFIG_VERSION,
     EXAMPLE_CONVOS,
+    STREAM_COMPLETIONS,
+    STREAM_EDIT_INTERVAL_SECONDS,
+    SPECULATIVE_COMPLETIONS,
+    PARTIAL_MODERATION_CHARS,
+    ENABLE_COMPACTION,
+    COMPACTION_TOKEN_THRESHOLD,
+    COMPACTION_KEEP_RECENT_MESSAGES,
+    SUMMARY_MODEL,
+    SUMMARY_MAX_TOKENS,
+    ANSWER_CACHE,
 )
 import discord
 from src.base import Message, Prompt, Conversation, ThreadConfig
-from src.utils import split_into_shorter_messages, close_thread, logger
+from src.utils import split_into_shorter_messages, logger
+from src.tokens import fit_to_context, token_counter
+from src.conversation_cache import conversation_cache
+from src.send_queue import send_queue
+from src.answer_cache import answer_cache
+from src.metrics import STAGE_SECONDS, metrics
+from src.request_scheduler import request_scheduler
+from src.resilience import completion_caller
+from src.backend_pool import backend_pool
 from src.moderation import (
     send_moderation_flagged_message,
     send_moderation_blocked_message,
 )
 
 MY_BOT_NAME = BOT_NAME
-MY_BOT_EXAMPLE_CONVOS = EXAMPLE_CONVOS
 
 
 class CompletionResult(Enum):
@@ -36,34 +56,466 @@ class CompletionData:
     status: CompletionResult
     reply_text: Optional[str]
     status_text: Optional[str]
+    # messages already posted while streaming the reply
+    sent_messages: List[discord.Message] = field(default_factory=list)
 
 
-client = AsyncOpenAI()
+def create_chat_completion(**kwargs):
+    return backend_pool.call(
+        lambda client: client.chat.completions.with_raw_response.create(**kwargs),
+        model=kwargs["model"],
+    )
 
 
-async def generate_completion_response(
-    messages: List[Message], user: str, thread_config: ThreadConfig
-) -> CompletionData:
-    try:
-        prompt = Prompt(
+class CompiledSystemPrompt:
+    """System prompt rendered once per (bot name, config version).
+
+    The same message dict is reused for every request so the prompt prefix
+    stays byte-for-byte identical, which lets the provider's prompt caching
+    hit. Its token count is computed once per model and token counter
+    scale, so it follows the counter's calibration.
+    """
+
+    def __init__(self, bot_name: str):
+        examples = []
+        for c in EXAMPLE_CONVOS:
+            messages = []
+            for m in c.messages:
+                if m.user == "Lenard":
+                    messages.append(Message(user=bot_name, text=m.text))
+                else:
+                    messages.append(m)
+            examples.append(Conversation(messages=messages))
+        self.prompt = Prompt(
             header=Message(
-                "system", f"Instructions for {MY_BOT_NAME}: {BOT_INSTRUCTIONS}"
+                "system", f"Instructions for {bot_name}: {BOT_INSTRUCTIONS}"
             ),
-            examples=MY_BOT_EXAMPLE_CONVOS,
-            convo=Conversation(messages),
+            examples=examples,
+            convo=Conversation([]),
+        )
+        self.message = {"role": "system", "content": self.prompt.render_system_prompt()}
+        # model -> (token counter scale, tokens)
+        self._tokens: Dict[str, Tuple[float, int]] = {}
+
+    def tokens(self, model: str) -> int:
+        scale, tokens = self._tokens.get(model, (None, 0))
+        if scale != token_counter.scale:
+            tokens = token_counter.count_message(self.message, model)
+            self._tokens[model] = (token_counter.scale, tokens)
+        return tokens
+
+
+@functools.lru_cache(maxsize=8)
+def compile_system_prompt(bot_name: str, config_version: str) -> CompiledSystemPrompt:
+    return CompiledSystemPrompt(bot_name)
+
+
+def set_bot_name(bot_name: str):
+    global MY_BOT_NAME
+    MY_BOT_NAME = bot_name
+    compile_system_prompt(bot_name, CONFIG_VERSION)
+
+
+def render_prompt(
+    messages: List[Message],
+    model: str,
+    max_tokens: int,
+    summary: Optional[str] = None,
+) -> Tuple[Optional[List[dict]], int]:
+    """Renders the request messages, trimmed to the model's context window."""
+    system_prompt = compile_system_prompt(MY_BOT_NAME, CONFIG_VERSION)
+    prompt = Prompt(
+        header=system_prompt.prompt.header,
+        examples=system_prompt.prompt.examples,
+        convo=Conversation(messages),
+    )
+    rendered = prompt.full_render(MY_BOT_NAME, system_message=system_prompt.message)
+    if summary:
+        rendered.insert(
+            1,
+            {
+                "role": "system",
+                "content": f"Summary of the earlier conversation: {summary}",
+            },
         )
-        rendered = prompt.full_render(MY_BOT_NAME)
-        response = await client.chat.completions.create(
+    return fit_to_context(
+        rendered,
+        model=model,
+        max_tokens=max_tokens,
+        system_tokens=system_prompt.tokens(model),
+        keep_first=2 if summary else 1,
+    )
+
+
+class ReplyBlocked(Exception):
+    def __init__(self, blocked_str: str):
+        super().__init__(blocked_str)
+        self.blocked_str = blocked_str
+
+
+class StreamingReply:
+    """Posts a streamed reply progressively to a channel.
+
+    The first chunk is sent as soon as it arrives, then the message is edited
+    at most once every `edit_interval` seconds. Text beyond
+    MAX_CHARS_PER_REPLY_MSG rolls over into a new message, using the same
+    split as `split_into_shorter_messages`.
+
+    With `moderate_partial`, the partial reply is moderated in the background
+    every `partial_moderation_chars` characters and `add` raises ReplyBlocked
+    once a check blocks it.
+    """
+
+    def __init__(
+        self,
+        thread: discord.abc.Messageable,
+        edit_interval: float,
+        send_after: Optional[Awaitable] = None,
+        moderate_partial: Optional[Callable[[str], Awaitable[Tuple[str, str]]]] = None,
+        partial_moderation_chars: int = PARTIAL_MODERATION_CHARS,
+    ):
+        self.thread = thread
+        self.edit_interval = edit_interval
+        self.send_after = send_after
+        self.moderate_partial = moderate_partial
+        self.partial_moderation_chars = partial_moderation_chars
+        self.text = ""
+        self.sent_messages: List[discord.Message] = []
+        self.started_at = time.monotonic()
+        self.first_visible_seconds: Optional[float] = None
+        self._last_sync = 0.0
+        self._partial_check: Optional[asyncio.Task] = None
+        self._checked_chars = 0
+
+    def _check_partial(self):
+        if self._partial_check is not None and self._partial_check.done():
+            check, self._partial_check = self._partial_check, None
+            if not check.cancelled() and check.exception() is None:
+                _, blocked_str = check.result()
+                if blocked_str:
+                    raise ReplyBlocked(blocked_str)
+        if (
+            self._partial_check is None
+            and len(self.text) - self._checked_chars >= self.partial_moderation_chars
+        ):
+            self._checked_chars = len(self.text)
+            self._partial_check = asyncio.create_task(self.moderate_partial(self.text))
+
+    async def add(self, delta: str):
+        self.text += delta
+        if self.moderate_partial is not None:
+            self._check_partial()
+        if not self.sent_messages or (
+            time.monotonic() - self._last_sync >= self.edit_interval
+        ):
+            await self.sync()
+
+    def close(self):
+        """Stops the partial moderation check still running, if any."""
+        check, self._partial_check = self._partial_check, None
+        if check is None:
+            return
+        if not check.done():
+            check.cancel()
+        elif not check.cancelled():
+            check.exception()  # retrieve it so it isn't logged as never retrieved
+
+    async def retract(self):
+        for sent_message in self.sent_messages:
+            try:
+                await sent_message.delete()
+            except Exception as e:
+                logger.error(f"Failed to retract message {sent_message.id}: {e}")
+        self.sent_messages = []
+
+    async def sync(self):
+        if self.send_after is not None:
+            await self.send_after
+            self.send_after = None
+        # blank parts are dropped before numbering so part i is sent_messages[i]
+        parts = [part for part in split_into_shorter_messages(self.text.strip()) if part.strip()]
+        for i, part in enumerate(parts):
+            if i >= len(self.sent_messages):
+                sent_message = await send_queue.send(self.thread, content=part)
+                conversation_cache.record(sent_message)
+                self.sent_messages.append(sent_message)
+            elif self.sent_messages[i].content != part:
+                self.sent_messages[i] = await self.sent_messages[i].edit(content=part)
+                conversation_cache.update(self.sent_messages[i])
+        if self.sent_messages and self.first_visible_seconds is None:
+            self.first_visible_seconds = time.monotonic() - self.started_at
+            logger.info(f"first visible token after {self.first_visible_seconds:.2f}s")
+        self._last_sync = time.monotonic()
+
+
+SUMMARY_INSTRUCTIONS = (
+    "Summarize the conversation below for yourself so it can be continued later. "
+    "Keep every fact, decision, name, number and open question. Be terse."
+)
+
+
+class QueueNotice:
+    """Tells the user their queue position while their request waits for
+    the request scheduler, and takes it down once the request is admitted."""
+
+    _deleting = set()
+
+    def __init__(self, thread: Optional[discord.abc.Messageable]):
+        self.thread = thread
+        self._sending: Optional[asyncio.Task] = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.clear()
+
+    def show(self, position: int):
+        if self.thread is None:
+            return
+        self._sending = asyncio.create_task(
+            send_queue.send(
+                self.thread,
+                embed=discord.Embed(
+                    description=f"⏳ Lots of chats right now, you're #{position} in the queue.",
+                    color=discord.Color.blue(),
+                ),
+            )
+        )
+
+    def clear(self):
+        if self._sending is None:
+            return
+        task = asyncio.create_task(self._delete(self._sending))
+        self._sending = None
+        self._deleting.add(task)
+        task.add_done_callback(self._deleting.discard)
+
+    async def _delete(self, sending: asyncio.Task):
+        try:
+            await (await sending).delete()
+        except Exception as e:
+            logger.error(f"Failed to remove queue notice: {e}")
+
+
+@dataclass(frozen=True)
+class ConversationSummary:
+    text: str
+    # newest messages folded into the summary, used to find where it ends
+    tail: Tuple[Message, ...]
+
+
+class ConversationSummaries:
+    """Rolling per-channel summaries of older turns.
+
+    Once the messages after a channel's summary exceed
+    COMPACTION_TOKEN_THRESHOLD tokens, all but the newest
+    COMPACTION_KEEP_RECENT_MESSAGES of them are folded into the summary by
+    SUMMARY_MODEL in the background. Requests use the latest finished summary
+    and are never held up by a refresh.
+    """
+
+    def __init__(self):
+        self._summaries: Dict[int, ConversationSummary] = {}
+        self._refreshing: Dict[int, asyncio.Task] = {}
+
+    def forget(self, channel_id: int):
+        self._summaries.pop(channel_id, None)
+        task = self._refreshing.pop(channel_id, None)
+        if task:
+            task.cancel()
+
+    def compact(
+        self, channel_id: int, messages: List[Message], model: str
+    ) -> Tuple[Optional[str], List[Message]]:
+        """Returns the channel's summary and the messages it doesn't cover."""
+        summary = self._summaries.get(channel_id)
+        pending = messages
+        if summary:
+            n = len(summary.tail)
+            for i in range(len(messages), n - 1, -1):
+                if tuple(messages[i - n : i]) == summary.tail:
+                    pending = messages[i:]
+                    break
+
+        to_fold = pending[:-COMPACTION_KEEP_RECENT_MESSAGES]
+        if to_fold and channel_id not in self._refreshing:
+            pending_tokens = sum(
+                token_counter.count_text(m.render(), model) for m in pending
+            )
+            if pending_tokens > COMPACTION_TOKEN_THRESHOLD:
+                task = asyncio.create_task(self._refresh(channel_id, summary, to_fold))
+                self._refreshing[channel_id] = task
+                task.add_done_callback(
+                    lambda _: self._refreshing.pop(channel_id, None)
+                )
+        return (summary.text if summary else None), pending
+
+    async def _refresh(
+        self,
+        channel_id: int,
+        previous: Optional[ConversationSummary],
+        to_fold: List[Message],
+    ):
+        transcript = "\n".join(m.render() for m in to_fold)
+        if previous:
+            transcript = f"Summary so far: {previous.text}\n\n{transcript}"
+        try:
+            # summaries share one round-robin turn
+            async with request_scheduler.slot(
+                SUMMARY_MODEL,
+                token_counter.count_text(transcript, SUMMARY_MODEL) + SUMMARY_MAX_TOKENS,
+            ):
+                response = await completion_caller.call(
+                    SUMMARY_MODEL,
+                    lambda model: create_chat_completion(
+                        model=model,
+                        messages=[
+                            {"role": "system", "content": SUMMARY_INSTRUCTIONS},
+                            {"role": "user", "content": transcript},
+                        ],
+                        temperature=0,
+                        max_tokens=SUMMARY_MAX_TOKENS,
+                    ),
+                )
+        except Exception as e:
+            logger.error(f"Failed to summarize channel {channel_id}: {e}")
+            return
+        text = (response.choices[0].message.content or "").strip()
+        if text:
+            self._summaries[channel_id] = ConversationSummary(
+                text=text, tail=tuple(to_fold[-3:])
+            )
+            logger.info(f"compacted {len(to_fold)} messages in channel {channel_id}")
+
+
+conversation_summaries = ConversationSummaries()
+
+
+async def generate_completion_response(
+    messages: List[Message],
+    user: str,
+    thread_config: ThreadConfig,
+    thread: Optional[discord.abc.Messageable] = None,
+    send_after: Optional[Awaitable] = None,
+) -> CompletionData:
+    """If `thread` is given and STREAM_COMPLETIONS is on, the reply is posted
+    to it while it is generated (but not before `send_after` is done) and
+    returned in `sent_messages`. With ANSWER_CACHE on, a first question
+    may be answered from the answer cache."""
+    question = reserved = None
+    try:
+        if ANSWER_CACHE and len(messages) == 1 and messages[0].user != MY_BOT_NAME:
+            question = messages[0].text or ""
+            cached = await answer_cache.get(question, thread_config)
+            if cached is not None:
+                return CompletionData(
+                    status=CompletionResult.OK, reply_text=cached, status_text=None
+                )
+            reserved = answer_cache.reserve(question, thread_config)
+        summary = None
+        if ENABLE_COMPACTION and thread is not None:
+            summary, messages = conversation_summaries.compact(
+                thread.id, messages, thread_config.model
+            )
+        with metrics.timer("prompt_render"):
+            rendered, prompt_tokens = render_prompt(
+                messages,
+                model=thread_config.model,
+                max_tokens=thread_config.max_tokens,
+                summary=summary,
+            )
+        if rendered is None:
+            return CompletionData(
+                status=CompletionResult.TOO_LONG,
+                reply_text=None,
+                status_text=f"message needs ~{prompt_tokens} tokens",
+            )
+        sent_messages = []
+        async with QueueNotice(thread) as queue_notice, request_scheduler.slot(
+            getattr(user, "id", user),
+            prompt_tokens + thread_config.max_tokens,
+            on_queued=queue_notice.show,
+        ) as grant:
+            queue_notice.clear()
+            completion_started_at = time.perf_counter()
+            if STREAM_COMPLETIONS and thread is not None:
+                moderate_partial = None
+                if SPECULATIVE_COMPLETIONS:
+
+                    async def moderate_partial(text: str) -> Tuple[str, str]:
+                        return await moderate_message(
+                            message=(rendered[-1]["content"] + text)[-500:], user=user
+                        )
+
+                streaming_reply = StreamingReply(
+                    thread,
+                    STREAM_EDIT_INTERVAL_SECONDS,
+                    send_after=send_after,
+                    moderate_partial=moderate_partial,
+                )
+                stream = await completion_caller.call(
+                    thread_config.model,
+                    lambda model: create_chat_completion(
+                        model=model,
+                        messages=rendered,
+                        temperature=thread_config.temperature,
+                        top_p=1.0,
+                        max_tokens=thread_config.max_tokens,
+                        stop=["<|endoftext|>"],
+                        stream=True,
+                    ),
+                )
+                try:
+                    async for chunk in stream:
+                        if chunk.choices and chunk.choices[0].delta.content:
+                            await streaming_reply.add(chunk.choices[0].delta.content)
+                    await streaming_reply.sync()
+                except asyncio.CancelledError:
+                    # superseded by a newer reply, take back the partial one
+                    await streaming_reply.retract()
+                    raise
+                except ReplyBlocked as e:
+                    # process_response retracts what was already posted
+                    return CompletionData(
+                        status=CompletionResult.MODERATION_BLOCKED,
+                        reply_text=streaming_reply.text.strip(),
+                        status_text=f"from_response:{e.blocked_str}",
+                        sent_messages=streaming_reply.sent_messages,
+                    )
+                finally:
+                    # also when superseded or a send fails, not just when done
+                    streaming_reply.close()
+                    await stream.close()
+                reply = streaming_reply.text.strip()
+                sent_messages = streaming_reply.sent_messages
+                grant.used_tokens = prompt_tokens + token_counter.count_text(
+                    reply, thread_config.model
+                )
+            else:
+                response = await completion_caller.call(
+                    thread_config.model,
+                    lambda model: create_chat_completion(
+                        model=model,
+                        messages=rendered,
+                        temperature=thread_config.temperature,
+                        top_p=1.0,
+                        max_tokens=thread_config.max_tokens,
+                        stop=["<|endoftext|>"],
+                    ),
+                )
+                reply = response.choices[0].message.content.strip()
+                if response.usage:
+                    token_counter.calibrate(prompt_tokens, response.usage.prompt_tokens)
+                    grant.used_tokens = response.usage.total_tokens
+        metrics.observe(
+            STAGE_SECONDS,
+            time.perf_counter() - completion_started_at,
+            stage="completion",
             model=thread_config.model,
-            messages=rendered,
-            temperature=thread_config.temperature,
-            top_p=1.0,
-            max_tokens=thread_config.max_tokens,
-            stop=["<|endoftext|>"],
         )
-        reply = response.choices[0].message.content.strip()
         if reply:
-            flagged_str, blocked_str = moderate_message(
+            flagged_str, blocked_str = await moderate_message(
                 message=(rendered[-1]["content"] + reply)[-500:], user=user
             )
             if len(blocked_str) > 0:
@@ -71,6 +523,7 @@ async def generate_completion_response(
                     status=CompletionResult.MODERATION_BLOCKED,
                     reply_text=reply,
                     status_text=f"from_response:{blocked_str}",
+                    sent_messages=sent_messages,
                 )
 
             if len(flagged_str) > 0:
@@ -78,12 +531,19 @@ async def generate_completion_response(
                     status=CompletionResult.MODERATION_FLAGGED,
                     reply_text=reply,
                     status_text=f"from_response:{flagged_str}",
+                    sent_messages=sent_messages,
                 )
 
+        if question is not None and reply:
+            answer_cache.put(question, thread_config, reply, grant.used_tokens or grant.tokens)
         return CompletionData(
-            status=CompletionResult.OK, reply_text=reply, status_text=None
+            status=CompletionResult.OK,
+            reply_text=reply,
+            status_text=None,
+            sent_messages=sent_messages,
         )
     except openai.BadRequestError as e:
+        metrics.inc("errors_total", stage="completion", error=type(e).__name__)
         if "This model's maximum context length" in str(e):
             return CompletionData(
                 status=CompletionResult.TOO_LONG, reply_text=None, status_text=str(e)
@@ -97,11 +557,16 @@ async def generate_completion_response(
             )
     except Exception as e:
         logger.exception(e)
+        metrics.inc("errors_total", stage="completion", error=type(e).__name__)
         return CompletionData(
             status=CompletionResult.OTHER_ERROR, reply_text=None, status_text=str(e)
         )
+    finally:
+        if reserved is not None:
+            answer_cache.release(reserved)
 
 
+@metrics.timed("discord_send")
 async def process_response(
     user: str, thread: discord.Thread, response_data: CompletionData
 ):
@@ -109,18 +574,30 @@ async def process_response(
     reply_text = response_data.reply_text
     status_text = response_data.status_text
     if status is CompletionResult.OK or status is CompletionResult.MODERATION_FLAGGED:
+        notice = None
+        if status is CompletionResult.MODERATION_FLAGGED:
+            notice = discord.Embed(
+                description=f"⚠️ **This conversation has been flagged by moderation.**",
+                color=discord.Color.yellow(),
+            )
         sent_message = None
-        if not reply_text:
-            sent_message = await thread.send(
+        if response_data.sent_messages:
+            # already posted while streaming
+            sent_message = response_data.sent_messages[-1]
+            if notice:
+                sent_message = await sent_message.edit(embed=notice)
+        elif not reply_text:
+            sent_message = await send_queue.send(
+                thread,
                 embed=discord.Embed(
                     description=f"**Invalid response** - empty response",
                     color=discord.Color.yellow(),
-                )
+                ),
             )
+            conversation_cache.record(sent_message)
         else:
-            shorter_response = split_into_shorter_messages(reply_text)
-            for r in shorter_response:
-                sent_message = await thread.send(r)
+            for sent_message in await send_queue.send_reply(thread, reply_text, notice=notice):
+                conversation_cache.record(sent_message)
         if status is CompletionResult.MODERATION_FLAGGED:
             await send_moderation_flagged_message(
                 guild=thread.guild,
@@ -129,14 +606,13 @@ async def process_response(
                 message=reply_text,
                 url=sent_message.jump_url if sent_message else "no url",
             )
-
-            await thread.send(
-                embed=discord.Embed(
-                    description=f"⚠️ **This conversation has been flagged by moderation.**",
-                    color=discord.Color.yellow(),
-                )
-            )
     elif status is CompletionResult.MODERATION_BLOCKED:
+        # retract anything already posted while streaming
+        for sent_message in response_data.sent_messages:
+            try:
+                await sent_message.delete()
+            except Exception as e:
+                logger.error(f"Failed to retract blocked message {sent_message.id}: {e}")
         await send_moderation_blocked_message(
             guild=thread.guild,
             user=user,
@@ -144,25 +620,34 @@ async def process_response(
             message=reply_text,
         )
 
-        await thread.send(
+        await send_queue.send(
+            thread,
             embed=discord.Embed(
                 description=f"❌ **The response has been blocked by moderation.**",
                 color=discord.Color.red(),
-            )
+            ),
         )
     elif status is CompletionResult.TOO_LONG:
-        await close_thread(thread)
+        await send_queue.send(
+            thread,
+            embed=discord.Embed(
+                description=f"**Message too long** - {status_text}",
+                color=discord.Color.yellow(),
+            ),
+        )
     elif status is CompletionResult.INVALID_REQUEST:
-        await thread.send(
+        await send_queue.send(
+            thread,
             embed=discord.Embed(
                 description=f"**Invalid request** - {status_text}",
                 color=discord.Color.yellow(),
-            )
+            ),
         )
     else:
-        await thread.send(
+        await send_queue.send(
+            thread,
             embed=discord.Embed(
                 description=f"**Error** - {status_text}",
                 color=discord.Color.yellow(),
-            )
+            ),
         )
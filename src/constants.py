@@ -1,8 +1,9 @@
 from dotenv import load_dotenv
+import hashlib
 import os
 import dacite
 import yaml
-from typing import Dict, List, Literal
+from typing import Dict, FrozenSet, List, Literal, Optional, Tuple
 
 from src.base import Config
 
@@ -11,9 +12,10 @@ load_dotenv()
 
 # load config.yaml
 SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__))
-CONFIG: Config = dacite.from_dict(
-    Config, yaml.safe_load(open(os.path.join(SCRIPT_DIR, "config.yaml"), "r"))
-)
+with open(os.path.join(SCRIPT_DIR, "config.yaml"), "r") as f:
+    CONFIG_TEXT = f.read()
+CONFIG: Config = dacite.from_dict(Config, yaml.safe_load(CONFIG_TEXT))
+CONFIG_VERSION = hashlib.sha256(CONFIG_TEXT.encode()).hexdigest()[:12]
 
 BOT_NAME = CONFIG.name
 BOT_INSTRUCTIONS = CONFIG.instructions
@@ -24,6 +26,17 @@ DISCORD_CLIENT_ID = os.environ["DISCORD_CLIENT_ID"]
 OPENAI_API_KEY = os.environ["OPENAI_API_KEY"]
 DEFAULT_MODEL = os.environ["DEFAULT_MODEL"]
 
+# more OpenAI compatible backends to spread requests over, comma separated
+# "api_key|base_url|model+model" entries; base_url and models are optional
+OPENAI_BACKENDS: List[Tuple[str, Optional[str], FrozenSet[str]]] = [
+    (OPENAI_API_KEY, os.environ.get("OPENAI_BASE_URL"), frozenset())
+]
+for s in filter(None, os.environ.get("OPENAI_BACKENDS", "").split(",")):
+    api_key, base_url, models = (s.split("|") + ["", ""])[:3]
+    OPENAI_BACKENDS.append(
+        (api_key, base_url or None, frozenset(filter(None, models.split("+"))))
+    )
+
 ALLOWED_SERVER_IDS: List[int] = []
 server_ids = os.environ["ALLOWED_SERVER_IDS"].split(",")
 for s in server_ids:
@@ -52,6 +65,34 @@ MODERATION_VALUES_FOR_BLOCKED = {
     "violence/graphic": 0.8,
 }
 
+MODERATION_MODEL = "text-moderation-latest"
+MODERATION_TIMEOUT_SECONDS = 10.0
+MODERATION_MAX_RETRIES = 2
+# moderation calls from all channels are sent together as one list request
+MODERATION_BATCH_WINDOW_SECONDS = 0.005
+MODERATION_BATCH_MAX_SIZE = 32
+MODERATION_CACHE_SIZE = 10000  # moderation scores of recent texts kept to skip repeat lookups
+MODERATION_CACHE_TTL_SECONDS = 3600
+# answer the first question of a chat from earlier answers to the same or a nearly identical question
+ANSWER_CACHE = False
+ANSWER_CACHE_MAX_ENTRIES = 1000
+ANSWER_CACHE_TTL_SECONDS = 24 * 3600
+ANSWER_CACHE_SIMILARITY = 0.75  # overlap of words and word pairs to count as the same question
+# local first tier: block these terms outright, and skip the API for short
+# messages made only of safe words
+MODERATION_BLOCK_TERMS: List[str] = []
+MODERATION_SAFE_WORDS: List[str] = [
+    "ok", "okay", "k", "kk", "yes", "yeah", "yep", "ya", "no", "nah", "nope",
+    "thanks", "thank", "you", "ty", "thx", "tysm", "cool", "nice", "great",
+    "perfect", "bet", "got", "it", "sure", "lol", "lmao", "yo", "hi", "hey",
+    "hello", "bro", "fr", "facts", "true", "makes", "sense", "sounds", "good",
+    "alright", "what", "why", "how", "really", "wow", "damn", "done", "and",
+    "so", "ah", "oh", "i", "see", "will", "try", "that", "this", "more",
+]
+MODERATION_FAST_PATH_MAX_CHARS = 40
+MODERATION_REPORT_QUEUE_SIZE = 500  # reports beyond this are dropped instead of delaying replies
+MODERATION_DIGEST_SECONDS = 2.0  # reports within this window are sent as one digest message
+
 MODERATION_VALUES_FOR_FLAGGED = {
     "harassment": 0.5,
     "harassment/threatening": 0.1,
@@ -66,14 +107,65 @@ MODERATION_VALUES_FOR_FLAGGED = {
     "violence/graphic": 0.1,
 }
 
-SECONDS_DELAY_RECEIVING_MSG = (
-    3  # give a delay for the bot to respond so it can catch multiple messages
+SESSION_DB_PATH = os.environ.get(
+    "SESSION_DB_PATH", os.path.join(SCRIPT_DIR, "..", "sessions.db")
+)  # set to an empty string to keep chat sessions in memory only
+SESSION_FLUSH_SECONDS = 2.0  # how often session changes are written to disk
+REPLY_DEBOUNCE_SECONDS = (
+    1.0  # wait this long after the last message so one reply can cover several messages
 )
+REPLY_MAX_DELAY_SECONDS = 3  # never hold a reply back longer than this
 MAX_THREAD_MESSAGES = 200
 ACTIVATE_THREAD_PREFX = "💬✅"
 INACTIVATE_THREAD_PREFIX = "💬❌"
-MAX_CHARS_PER_REPLY_MSG = (
-    1500  # discord has a 2k limit, we just break message into 1.5k
+MAX_DISCORD_MESSAGE_CHARS = 2000
+MAX_CHARS_PER_REPLY_MSG = MAX_DISCORD_MESSAGE_CHARS  # replies are split on paragraph, sentence and code block boundaries
+CHANNEL_SENDS_PER_WINDOW = 5  # discord allows 5 messages per 5s in a channel
+CHANNEL_SEND_WINDOW_SECONDS = 5.0
+STREAM_COMPLETIONS = False  # post replies while they are generated, editing them as tokens arrive
+STREAM_EDIT_INTERVAL_SECONDS = (
+    1.2  # discord allows 5 message edits per 5s per channel, leave room for other sends
 )
+# start the completion while the user's message is still being moderated, and
+# moderate streamed replies while they are generated
+SPECULATIVE_COMPLETIONS = False
+PARTIAL_MODERATION_CHARS = 300  # moderate a streamed reply every this many new characters
 
 AVAILABLE_MODELS = Literal["gpt-3.5-turbo", "gpt-4", "gpt-4-1106-preview", "gpt-4-32k"]
+MODEL_CONTEXT_SIZES: Dict[str, int] = {
+    "gpt-3.5-turbo": 16385,
+    "gpt-4": 8192,
+    "gpt-4-1106-preview": 128000,
+    "gpt-4-32k": 32768,
+}
+# fold older turns of long chats into a summary made by a cheaper model
+ENABLE_COMPACTION = False
+COMPACTION_TOKEN_THRESHOLD = 2000  # tokens of unsummarized messages before compacting
+COMPACTION_KEEP_RECENT_MESSAGES = 10  # newest messages always sent verbatim
+SUMMARY_MODEL = "gpt-3.5-turbo"
+SUMMARY_MAX_TOKENS = 400
+CONTEXT_HEADROOM_TOKENS = (
+    256  # safety margin for token count estimation errors when trimming history
+)
+# limits for all completion requests together, keep them under the account's rate limits
+OPENAI_MAX_CONCURRENT_REQUESTS = 8
+OPENAI_REQUESTS_PER_MINUTE = 500
+OPENAI_TOKENS_PER_MINUTE = 150000  # counts the prompt estimate plus max_tokens of each request
+OPENAI_USER_WEIGHTS: Dict[int, int] = {}  # user id -> requests admitted per round-robin turn, default 1
+COMPLETION_TIMEOUT_SECONDS = 60.0
+OPENAI_HEALTH_CHECK_SECONDS = 30.0  # how often failing backends are probed
+# serve Prometheus metrics on this local port, metrics are off when unset
+METRICS_PORT = int(os.environ["METRICS_PORT"]) if os.environ.get("METRICS_PORT") else None
+METRICS_HOST = "127.0.0.1"
+LOOP_LAG_THRESHOLD_SECONDS = 0.25  # log event loop stalls longer than this with the blocking stack
+LOOP_HEARTBEAT_SECONDS = 0.1
+# also turn on asyncio debug mode and log blocking socket calls made on the event loop
+LOOP_DEBUG = bool(os.environ.get("LOOP_DEBUG"))
+COMPLETION_MAX_RETRIES = 3  # retries of rate limited, timed out or 5xx completion requests
+COMPLETION_BACKOFF_BASE_SECONDS = 0.5
+COMPLETION_BACKOFF_MAX_SECONDS = 20.0  # give up instead if Retry-After asks for longer
+CIRCUIT_FAILURE_THRESHOLD = 5  # failures in a row before a model's requests fail fast
+CIRCUIT_OPEN_SECONDS = 30.0
+# model -> model used while the first one is failing, e.g. {"gpt-4": "gpt-4-1106-preview"}.
+# the fallback should have at least the same context size
+MODEL_FALLBACKS: Dict[str, str] = {}
@@ -0,0 +1,124 @@
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Callable, Dict, List, Optional, Set
+import asyncio
+
+import discord
+from discord import Message as DiscordMessage
+
+from src.base import Message
+from src.constants import MAX_THREAD_MESSAGES
+from src.utils import discord_message_to_message
+
+
+@dataclass(frozen=True)
+class CachedMessage:
+    id: int
+    author_id: int
+    message: Optional[Message]
+
+
+class ConversationCache:
+    """In-memory, append-only message history for each managed channel.
+
+    The cache is fed from gateway events and from the bot's own sends, so a
+    turn only needs to hit `channel.history` on a cold start or after the
+    channel has been invalidated. Only the newest `limit` messages are kept.
+    """
+
+    def __init__(self, limit: int = MAX_THREAD_MESSAGES):
+        self.limit = limit
+        self._channels: Dict[int, "OrderedDict[int, CachedMessage]"] = {}
+        # events received while a cold fetch is running, replayed afterwards
+        self._loading: Dict[int, List[Callable[[], None]]] = {}
+        # channels invalidated while a cold fetch is running, which may be stale
+        self._invalidated: Set[int] = set()
+        self._locks: Dict[int, asyncio.Lock] = {}
+
+    def start(self, channel_id: int):
+        """Mark a freshly created channel as warm with an empty history."""
+        self._channels[channel_id] = OrderedDict()
+
+    def invalidate(self, channel_id: int):
+        self._channels.pop(channel_id, None)
+        if channel_id in self._loading:
+            self._invalidated.add(channel_id)
+        self._locks.pop(channel_id, None)
+
+    def record(self, message: Optional[DiscordMessage]):
+        if message is None:
+            return
+        self._apply(message.channel.id, lambda: self._append(message))
+
+    def update(self, message: DiscordMessage):
+        self._apply(message.channel.id, lambda: self._replace(message))
+
+    def remove(self, channel_id: int, message_id: int):
+        self._apply(
+            channel_id, lambda: self._channels[channel_id].pop(message_id, None)
+        )
+
+    async def get_messages(self, channel: discord.abc.Messageable) -> List[Message]:
+        messages = self._channels.get(channel.id)
+        if messages is None:
+            lock = self._locks.setdefault(channel.id, asyncio.Lock())
+            async with lock:
+                messages = self._channels.get(channel.id)
+                if messages is None:
+                    messages = await self._load(channel)
+        return [
+            cached.message for cached in messages.values() if cached.message is not None
+        ]
+
+    async def _load(
+        self, channel: discord.abc.Messageable
+    ) -> "OrderedDict[int, CachedMessage]":
+        """Fetches the channel's history and caches it, unless the channel was
+        invalidated during the fetch; the next turn fetches it again then."""
+        self._loading[channel.id] = []
+        self._invalidated.discard(channel.id)
+        try:
+            fetched = [m async for m in channel.history(limit=self.limit)]
+        except Exception:
+            self._loading.pop(channel.id, None)
+            self._invalidated.discard(channel.id)
+            raise
+        fetched.reverse()
+        messages = OrderedDict((m.id, self._to_cached(m)) for m in fetched)
+        self._channels[channel.id] = messages
+        for apply in self._loading.pop(channel.id):
+            apply()
+        if channel.id in self._invalidated:
+            self._invalidated.discard(channel.id)
+            del self._channels[channel.id]
+        return messages
+
+    def _apply(self, channel_id: int, apply: Callable[[], None]):
+        if channel_id in self._loading:
+            self._loading[channel_id].append(apply)
+        elif channel_id in self._channels:
+            apply()
+
+    def _append(self, message: DiscordMessage):
+        messages = self._channels[message.channel.id]
+        if message.id in messages:
+            return
+        messages[message.id] = self._to_cached(message)
+        while len(messages) > self.limit:
+            messages.popitem(last=False)
+
+    def _replace(self, message: DiscordMessage):
+        messages = self._channels[message.channel.id]
+        if message.id in messages:
+            messages[message.id] = self._to_cached(message)
+
+    @staticmethod
+    def _to_cached(message: DiscordMessage) -> CachedMessage:
+        return CachedMessage(
+            id=message.id,
+            author_id=message.author.id,
+            message=discord_message_to_message(message),
+        )
+
+
+conversation_cache = ConversationCache()
@@ -0,0 +1,123 @@
+from dataclasses import dataclass
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+import asyncio
+import heapq
+import itertools
+import time
+
+from src.sessions import Session
+from src.utils import logger
+
+REMIND = "remind"
+CLOSE = "close"
+
+
+@dataclass
+class InactivityStats:
+    scheduled: int = 0
+    reminders: int = 0
+    closes: int = 0
+    max_lateness_seconds: float = 0.0
+
+
+class InactivityTimers:
+    """Fires inactivity reminders and closes at each channel's deadline.
+
+    Deadlines live in a min-heap, so rescheduling a channel on activity is
+    O(log n) and the timer loop only wakes up when the earliest deadline is
+    due. Rescheduled or cancelled entries are skipped lazily by comparing a
+    per-channel generation number. Closes run with bounded concurrency.
+    """
+
+    def __init__(
+        self,
+        remind_after_seconds: float,
+        close_after_seconds: float,
+        on_remind: Callable[[int], Awaitable[None]],
+        on_close: Callable[[int], Awaitable[None]],
+        max_concurrent_closes: int,
+    ):
+        self.remind_after_seconds = remind_after_seconds
+        self.close_after_seconds = close_after_seconds
+        self.on_remind = on_remind
+        self.on_close = on_close
+        self.stats = InactivityStats()
+        self._heap: List[Tuple[float, int, int, str, int]] = []
+        self._generations: Dict[int, int] = {}
+        self._counter = itertools.count()
+        self.max_concurrent_closes = max_concurrent_closes
+        # created in start() so they bind to the running loop
+        self._wakeup: Optional[asyncio.Event] = None
+        self._close_slots: Optional[asyncio.Semaphore] = None
+        self._task: Optional[asyncio.Task] = None
+        self._running = set()
+
+    def schedule(self, session: Session):
+        generation = self._generations.get(session.channel_id, 0) + 1
+        self._generations[session.channel_id] = generation
+        last_activity = session.last_activity.timestamp()
+        if not session.reminder_sent:
+            self._push(last_activity + self.remind_after_seconds, session.channel_id, REMIND, generation)
+        self._push(last_activity + self.close_after_seconds, session.channel_id, CLOSE, generation)
+        self.stats.scheduled += 1
+
+        # rebuild once the heap is mostly rescheduled or cancelled entries
+        if len(self._heap) > 4 * len(self._generations) + 64:
+            self._heap = [e for e in self._heap if self._generations.get(e[2]) == e[4]]
+            heapq.heapify(self._heap)
+
+    def cancel(self, channel_id: int):
+        self._generations.pop(channel_id, None)
+
+    def start(self):
+        if self._task is None:
+            self._wakeup = asyncio.Event()
+            self._close_slots = asyncio.Semaphore(self.max_concurrent_closes)
+            self._task = asyncio.create_task(self._run())
+
+    def _push(self, deadline: float, channel_id: int, kind: str, generation: int):
+        entry = (deadline, next(self._counter), channel_id, kind, generation)
+        if self._wakeup is not None and (not self._heap or entry < self._heap[0]):
+            self._wakeup.set()
+        heapq.heappush(self._heap, entry)
+
+    async def _run(self):
+        while True:
+            self._wakeup.clear()
+            timeout = self._heap[0][0] - time.time() if self._heap else None
+            if timeout is None or timeout > 0:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            deadline, _, channel_id, kind, generation = heapq.heappop(self._heap)
+            if self._generations.get(channel_id) != generation:
+                continue
+            self.stats.max_lateness_seconds = max(
+                self.stats.max_lateness_seconds, time.time() - deadline
+            )
+            if kind == CLOSE:
+                self._generations.pop(channel_id, None)
+                self.stats.closes += 1
+                self._spawn(self._close(channel_id))
+            else:
+                self.stats.reminders += 1
+                self._spawn(self.on_remind(channel_id))
+
+    async def _close(self, channel_id: int):
+        async with self._close_slots:
+            await self.on_close(channel_id)
+
+    def _spawn(self, coro: Awaitable[None]):
+        task = asyncio.create_task(self._guard(coro))
+        self._running.add(task)
+        task.add_done_callback(self._running.discard)
+
+    @staticmethod
+    async def _guard(coro: Awaitable[None]):
+        try:
+            await coro
+        except Exception as e:
+            logger.exception(e)
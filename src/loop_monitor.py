@@ -0,0 +1,143 @@
+from dataclasses import dataclass
+from typing import Callable, Optional, Set, Tuple
+import asyncio
+import functools
+import os
+import socket
+import sys
+import threading
+import time
+import traceback
+
+from src.constants import LOOP_DEBUG, LOOP_HEARTBEAT_SECONDS, LOOP_LAG_THRESHOLD_SECONDS
+from src.metrics import metrics
+from src.utils import logger
+
+STACK_FRAMES = 15
+
+
+@dataclass
+class LoopMonitorStats:
+    stalls: int = 0
+    max_lag_seconds: float = 0.0
+    blocking_io_calls: int = 0
+
+
+def _where(stack: traceback.StackSummary) -> str:
+    """The innermost frame of the bot's own code, to label a stall by."""
+    frames = [f for f in stack if f"{os.sep}src{os.sep}" in f.filename] or list(stack)
+    if not frames:
+        return "unknown"
+    return f"{os.path.basename(frames[-1].filename)}:{frames[-1].name}"
+
+
+class LoopMonitor:
+    """Watches the event loop for stalls.
+
+    A task on the loop stamps a heartbeat every `interval_seconds` and a
+    daemon thread checks it. When the heartbeat is late by more than
+    `threshold_seconds`, the thread grabs the loop thread's stack while the
+    blocking code is still running. Once the loop gets going again, the lag
+    and that stack are logged and recorded in the metrics.
+
+    In debug mode asyncio's debug checks are turned on, and blocking socket
+    calls and DNS lookups made on the loop thread are logged with their
+    caller.
+    """
+
+    def __init__(self, threshold_seconds: float, interval_seconds: float, debug: bool):
+        self.threshold_seconds = threshold_seconds
+        self.interval_seconds = interval_seconds
+        self.debug = debug
+        self.stats = LoopMonitorStats()
+        self._heartbeat = time.monotonic()
+        # (heartbeat the stall started after, stack of the loop thread)
+        self._stalled: Optional[Tuple[float, traceback.StackSummary]] = None
+        self._loop_thread_id: Optional[int] = None
+        self._task: Optional[asyncio.Task] = None
+        self._reported_io: Set[Tuple[str, str, int]] = set()
+
+    def start(self):
+        if self._task is not None:
+            return
+        loop = asyncio.get_running_loop()
+        self._loop_thread_id = threading.get_ident()
+        self._heartbeat = time.monotonic()
+        self._task = asyncio.create_task(self._beat())
+        threading.Thread(target=self._watch, name="loop-monitor", daemon=True).start()
+        if self.debug:
+            loop.set_debug(True)
+            loop.slow_callback_duration = self.threshold_seconds
+            self._flag_blocking_io()
+
+    async def _beat(self):
+        while True:
+            expected = time.monotonic() + self.interval_seconds
+            await asyncio.sleep(self.interval_seconds)
+            now = time.monotonic()
+            lag = max(now - expected, 0.0)
+            previous, self._heartbeat = self._heartbeat, now
+            metrics.observe("event_loop_lag_seconds", lag)
+            if lag >= self.threshold_seconds:
+                stalled = self._stalled
+                self._record_stall(lag, stalled[1] if stalled and stalled[0] == previous else None)
+
+    def _watch(self):
+        while True:
+            time.sleep(self.interval_seconds)
+            heartbeat = self._heartbeat
+            late = time.monotonic() - heartbeat - self.interval_seconds
+            if late < self.threshold_seconds or (self._stalled and self._stalled[0] == heartbeat):
+                continue
+            frame = sys._current_frames().get(self._loop_thread_id)
+            if frame is not None:
+                stack = traceback.extract_stack(frame, limit=STACK_FRAMES)
+                self._stalled = (heartbeat, stack)
+
+    def _record_stall(self, lag: float, stack: Optional[traceback.StackSummary]):
+        self.stats.stalls += 1
+        self.stats.max_lag_seconds = max(self.stats.max_lag_seconds, lag)
+        if stack is None:
+            metrics.inc("event_loop_stalls_total", where="unknown")
+            logger.warning(f"Event loop was blocked for {lag:.3f}s")
+            return
+        metrics.inc("event_loop_stalls_total", where=_where(stack))
+        logger.warning(
+            f"Event loop was blocked for {lag:.3f}s in:\n{''.join(traceback.format_list(stack))}"
+        )
+
+    def _flag_blocking_io(self):
+        def flagged(name: str, func: Callable) -> Callable:
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                if threading.get_ident() == self._loop_thread_id and not (
+                    args and isinstance(args[0], socket.socket) and args[0].gettimeout() == 0.0
+                ):
+                    self._report_blocking_io(name)
+                return func(*args, **kwargs)
+
+            return wrapper
+
+        # the loop's own sockets are non-blocking and skipped
+        for name in ("connect", "send", "sendall", "recv", "recv_into"):
+            setattr(socket.socket, name, flagged(f"socket.{name}", getattr(socket.socket, name)))
+        socket.getaddrinfo = flagged("socket.getaddrinfo", socket.getaddrinfo)
+
+    def _report_blocking_io(self, name: str):
+        self.stats.blocking_io_calls += 1
+        metrics.inc("blocking_io_calls_total", call=name)
+        stack = traceback.extract_stack(limit=STACK_FRAMES + 2)[:-2]  # drop the wrapper
+        caller = stack[-1]
+        if (name, caller.filename, caller.lineno) in self._reported_io:
+            return
+        self._reported_io.add((name, caller.filename, caller.lineno))
+        logger.warning(
+            f"Blocking {name} call on the event loop thread:\n{''.join(traceback.format_list(stack))}"
+        )
+
+
+loop_monitor = LoopMonitor(
+    threshold_seconds=LOOP_LAG_THRESHOLD_SECONDS,
+    interval_seconds=LOOP_HEARTBEAT_SECONDS,
+    debug=LOOP_DEBUG,
+)
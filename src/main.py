@@ -6,26 +6,41 @@ import logging
 
 import discord
 from discord import Message as DiscordMessage, app_commands
-from discord.ext import tasks
 
-from src.base import Message, Conversation, ThreadConfig
+from src.base import Message, ThreadConfig
 from src.constants import (
     BOT_INVITE_URL,
     DISCORD_BOT_TOKEN,
-    EXAMPLE_CONVOS,
-    MAX_THREAD_MESSAGES,  # Using MAX_THREAD_MESSAGES instead of MAX_MESSAGES
-    SECONDS_DELAY_RECEIVING_MSG,
     AVAILABLE_MODELS,
     DEFAULT_MODEL,
+    SPECULATIVE_COMPLETIONS,
 )
 from src.utils import (
     logger,
     should_block,
-    discord_message_to_message,
+    TTLCache,
 )
+from src.conversation_cache import conversation_cache
+from src.reply_scheduler import reply_scheduler
+from src.sessions import Session, sessions
+from src.inactivity import InactivityTimers
+from src.channel_pool import ChannelPool
+from src.loop_monitor import loop_monitor
+from src.send_queue import send_queue
+from src.answer_cache import answer_cache
+from src.backend_pool import backend_pool
+from src.metrics import metrics, start_metrics_server
+from src.request_scheduler import request_scheduler
+from src.resilience import completion_caller
+from src.tokens import token_stats
 from src import completion
 from src.completion import generate_completion_response, process_response
 from src.moderation import (
+    local_moderator,
+    moderation_batcher,
+    moderation_cache,
+    moderation_reporter,
+    invalidate_moderation_channel,
     moderate_message,
     send_moderation_blocked_message,
     send_moderation_flagged_message,
@@ -42,6 +57,11 @@ AI_CHATS_CATEGORY_ID = 1366330359805116547
 CHANNEL_PREFIX = "ai-chat-"
 INACTIVITY_REMINDER_MINUTES = 15
 INACTIVITY_CLOSE_MINUTES = 30
+MAX_CONCURRENT_CHANNEL_CLOSES = 4
+STABLE_ENTITY_TTL_SECONDS = 600  # how long owner member and category lookups are cached
+WARM_POOL_SIZE = 0  # hidden channels kept pre-created for /chat, 0 disables the pool
+WARM_POOL_MAX_AGE_MINUTES = 24 * 60
+POOL_CHANNEL_NAME = "warm-pool-channel"  # outside CHANNEL_PREFIX so no chat can be named like it
 REMINDER_MESSAGE = "{user.mention}, this AI chat will close automatically if no activity happens in the next 15 minutes! You can also close this chat by typing /close."
 
 intents = discord.Intents.default()
@@ -50,26 +70,47 @@ intents.message_content = True
 client = discord.Client(intents=intents)
 tree = discord.app_commands.CommandTree(client)
 
-# Dictionary to store channel data: {channel_id: {"config": ThreadConfig, "last_activity": datetime}}
-channel_data = {}
+# Owner member and category objects, which practically never change
+stable_entities = TTLCache(ttl_seconds=STABLE_ENTITY_TTL_SECONDS)
+
+# on_ready runs again after every gateway reconnect, the startup only once
+started = False
 
 
 @client.event
 async def on_ready():
+    global started
     logger.info(f"We have logged in as {client.user}. Invite URL: {BOT_INVITE_URL}")
-    completion.MY_BOT_NAME = client.user.name
-    completion.MY_BOT_EXAMPLE_CONVOS = []
-    for c in EXAMPLE_CONVOS:
-        messages = []
-        for m in c.messages:
-            if m.user == "Lenard":
-                messages.append(Message(user=client.user.name, text=m.text))
-            else:
-                messages.append(m)
-        completion.MY_BOT_EXAMPLE_CONVOS.append(Conversation(messages=messages))
-    
-    # Start the background task to check for inactive channels
-    check_inactive_channels.start()
+    if started:
+        return
+    started = True
+    loop_monitor.start()
+    completion.set_bot_name(client.user.name)
+
+    # Restore sessions from before a restart, dropping channels deleted in the meantime
+    await sessions.load()
+    category = client.get_channel(AI_CHATS_CATEGORY_ID)
+    if category:
+        for session in sessions.reconcile(
+            category.guild.id, (c.id for c in category.channels)
+        ):
+            logger.info(f"Dropped session for deleted channel {session.channel_id}")
+    sessions.start()
+    backend_pool.start()
+
+    # Take back pool channels from before a restart and start refilling the pool
+    if category:
+        for channel in category.text_channels:
+            if channel.name == POOL_CHANNEL_NAME and channel.id not in sessions:
+                if not channel_pool.adopt(channel):
+                    logger.warning(f"Not reusing pool channel {channel.id}, it has messages")
+    channel_pool.start()
+
+    # Start the timers that remind about and close inactive channels
+    for session in sessions.values():
+        inactivity_timers.schedule(session)
+    inactivity_timers.start()
+    await start_metrics_server()
     await tree.sync()
 
 
@@ -88,51 +129,169 @@ def has_verified_role():
     return app_commands.check(predicate)
 
 
-@tasks.loop(minutes=1)
-async def check_inactive_channels():
-    """Check for inactive channels and send reminders or delete them based on inactivity time"""
-    current_time = datetime.datetime.now()
-    channels_to_close = []
-    
-    for channel_id, data in list(channel_data.items()):
-        last_activity = data["last_activity"]
-        inactive_minutes = (current_time - last_activity).total_seconds() / 60
-        user_id = data["user_id"]
-        
-        # Send reminder at 15 minutes
-        if inactive_minutes >= INACTIVITY_REMINDER_MINUTES and not data.get("reminder_sent", False):
-            channel = client.get_channel(channel_id)
-            if channel:
-                user = await client.fetch_user(user_id)
-                if user:
-                    try:
-                        await channel.send(REMINDER_MESSAGE.format(user=user))
-                        channel_data[channel_id]["reminder_sent"] = True
-                    except Exception as e:
-                        logger.error(f"Failed to send reminder in channel {channel_id}: {str(e)}")
-        
-        # Close channel at 30 minutes
-        if inactive_minutes >= INACTIVITY_CLOSE_MINUTES:
-            channels_to_close.append(channel_id)
-    
-    # Close channels that need to be closed
-    for channel_id in channels_to_close:
-        channel = client.get_channel(channel_id)
-        if channel:
-            try:
-                await channel.delete(reason="Closed due to inactivity")
-                logger.info(f"Deleted channel {channel.name} due to inactivity")
-            except Exception as e:
-                logger.error(f"Failed to delete channel {channel_id}: {str(e)}")
-        
-        # Remove channel from our tracking
-        if channel_id in channel_data:
-            del channel_data[channel_id]
+async def send_inactivity_reminder(channel_id: int):
+    session = sessions.get(channel_id)
+    channel = client.get_channel(channel_id)
+    if not session or not channel:
+        return
+    # the user is normally cached from their last message, only fetch after a restart
+    user = client.get_user(session.user_id) or await client.fetch_user(session.user_id)
+    try:
+        await send_queue.send(channel, content=REMINDER_MESSAGE.format(user=user))
+        sessions.mark_reminder_sent(channel_id)
+    except Exception as e:
+        logger.error(f"Failed to send reminder in channel {channel_id}: {str(e)}")
+
+
+async def close_inactive_channel(channel_id: int):
+    channel = client.get_channel(channel_id)
+    if channel:
+        try:
+            await channel.delete(reason="Closed due to inactivity")
+            logger.info(f"Deleted channel {channel.name} due to inactivity")
+        except Exception as e:
+            logger.error(f"Failed to delete channel {channel_id}: {str(e)}")
+
+    # Remove channel from our tracking
+    forget_channel(channel_id)
+
+
+def forget_channel(channel_id: int):
+    sessions.remove(channel_id)
+    inactivity_timers.cancel(channel_id)
+    conversation_cache.invalidate(channel_id)
+    reply_scheduler.cancel(channel_id)
+    completion.conversation_summaries.forget(channel_id)
+
+
+inactivity_timers = InactivityTimers(
+    remind_after_seconds=INACTIVITY_REMINDER_MINUTES * 60,
+    close_after_seconds=INACTIVITY_CLOSE_MINUTES * 60,
+    on_remind=send_inactivity_reminder,
+    on_close=close_inactive_channel,
+    max_concurrent_closes=MAX_CONCURRENT_CHANNEL_CLOSES,
+)
+
+
+async def resolve_category() -> Optional[discord.CategoryChannel]:
+    category = client.get_channel(AI_CHATS_CATEGORY_ID)
+    if category:
+        return category
+
+    async def fetch():
+        try:
+            return await client.fetch_channel(AI_CHATS_CATEGORY_ID)
+        except discord.NotFound:
+            return None
+
+    return await stable_entities.get_or_fetch(("channel", AI_CHATS_CATEGORY_ID), fetch)
+
+
+async def resolve_owner_member(guild: discord.Guild) -> Optional[discord.Member]:
+    async def fetch():
+        try:
+            return guild.get_member(SERVER_OWNER_ID) or await guild.fetch_member(
+                SERVER_OWNER_ID
+            )
+        except discord.NotFound:
+            return None
+
+    return await stable_entities.get_or_fetch(("member", guild.id, SERVER_OWNER_ID), fetch)
+
+
+async def create_pool_channel() -> Optional[discord.TextChannel]:
+    category = await resolve_category()
+    if not category:
+        return None
+    guild = category.guild
+    overwrites = {
+        guild.default_role: discord.PermissionOverwrite(read_messages=False),
+        guild.me: discord.PermissionOverwrite(read_messages=True, send_messages=True),
+    }
+    return await guild.create_text_channel(
+        name=POOL_CHANNEL_NAME,
+        category=category,
+        overwrites=overwrites,
+        reason="Warm pool for AI chats",
+    )
+
+
+channel_pool = ChannelPool(
+    size=WARM_POOL_SIZE,
+    max_age_seconds=WARM_POOL_MAX_AGE_MINUTES * 60,
+    create=create_pool_channel,
+)
+
+# Exported on METRICS_PORT when it is set
+metrics.gauge("active_sessions", lambda: len(sessions))
+metrics.gauge("openai_queue_depth", lambda: request_scheduler.queue_depth)
+metrics.gauge("openai_active_requests", lambda: request_scheduler.active)
+metrics.gauge("send_queue_depth", lambda: send_queue.queue_depth)
+metrics.gauge("warm_pool_channels", lambda: len(channel_pool))
+for prefix, stats in (
+    ("tokens", token_stats),
+    ("moderation_batch", moderation_batcher.stats),
+    ("moderation_cache", moderation_cache.stats),
+    ("answer_cache", answer_cache.stats),
+    ("moderation_local", local_moderator.stats),
+    ("moderation_reports", moderation_reporter.stats),
+    ("reply_scheduler", reply_scheduler.stats),
+    ("openai_scheduler", request_scheduler.stats),
+    ("openai_retries", completion_caller.stats),
+    ("send_queue", send_queue.stats),
+    ("inactivity", inactivity_timers.stats),
+    ("warm_pool", channel_pool.stats),
+    ("event_loop", loop_monitor.stats),
+):
+    metrics.export_stats(prefix, stats)
+for backend in backend_pool.backends:
+    metrics.export_stats("openai_backend", backend.stats, backend=backend.name)
 
 
-@check_inactive_channels.before_loop
-async def before_check_inactive_channels():
-    await client.wait_until_ready()
+async def send_chat_welcome(
+    chat_channel: discord.TextChannel,
+    user: discord.User,
+    message: str,
+    flagged_str: str,
+    thread_config: ThreadConfig,
+):
+    # Send initial message with embed
+    embed = discord.Embed(
+        title="AI Chat Session Started",
+        description=f"{user.mention} has started a new AI chat session!",
+        color=discord.Color.blue()
+    )
+    embed.add_field(name="Model", value=thread_config.model)
+    embed.add_field(name="Temperature", value=thread_config.temperature)
+    embed.add_field(name="Max Tokens", value=thread_config.max_tokens)
+    embeds = [embed]
+
+    # Add the flagged notice to the same message if needed
+    if len(flagged_str) > 0:
+        warning_embed = discord.Embed(
+            title="⚠️ Flagged by moderation",
+            description=f"Your message was flagged but allowed.",
+            color=discord.Color.yellow()
+        )
+        embeds.append(warning_embed)
+    conversation_cache.record(
+        await send_queue.send(chat_channel, content=f"{user.mention}", embeds=embeds)
+    )
+
+    # Send user's initial message
+    initial_message = await send_queue.send(
+        chat_channel, content=f"**{user.name}**: {message}"
+    )
+    conversation_cache.record(initial_message)
+
+    if len(flagged_str) > 0:
+        await send_moderation_flagged_message(
+            guild=chat_channel.guild,
+            user=user,
+            flagged_str=flagged_str,
+            message=message,
+            url=chat_channel.jump_url,
+        )
 
 
 # /chat command
@@ -144,6 +303,7 @@ async def before_check_inactive_channels():
 @app_commands.describe(model="The model to use for the chat")
 @app_commands.describe(temperature="Controls randomness. Higher values mean more randomness. Between 0 and 1")
 @app_commands.describe(max_tokens="How many tokens the model should output at max for each message.")
+@metrics.timed("chat_command")
 async def chat_command(
     interaction: discord.Interaction,
     message: str,
@@ -175,19 +335,46 @@ async def chat_command(
             return
 
         # Check if user already has an active chat channel
-        for channel_id, data in channel_data.items():
-            if data["user_id"] == user.id:
-                channel = client.get_channel(channel_id)
-                if channel:
-                    await interaction.response.send_message(
-                        f"You already have an open AI chat: {channel.mention}",
-                        ephemeral=True,
-                    )
-                    return
+        session = sessions.for_user(user.id)
+        if session:
+            channel = client.get_channel(session.channel_id)
+            if channel:
+                await interaction.response.send_message(
+                    f"You already have an open AI chat: {channel.mention}",
+                    ephemeral=True,
+                )
+                return
+            # the channel was deleted behind our back
+            forget_channel(session.channel_id)
 
+        # Only one /chat per user can create a channel at a time
+        if not sessions.try_reserve(user.id):
+            await interaction.response.send_message(
+                "Your AI chat is already being created.", ephemeral=True
+            )
+            return
+
+        speculative_reply = None
         try:
-            # Moderate
-            flagged_str, blocked_str = moderate_message(message=message, user=user)
+            await interaction.response.defer(ephemeral=True)
+
+            thread_config = ThreadConfig(model=model, max_tokens=max_tokens, temperature=temperature)
+            messages = [Message(user=user.name, text=message)]
+            if SPECULATIVE_COMPLETIONS:
+                # Generate the first reply while the prompt is moderated and
+                # the channel is set up, it is dropped if the prompt is blocked
+                speculative_reply = asyncio.create_task(
+                    generate_completion_response(
+                        messages=messages, user=user, thread_config=thread_config
+                    )
+                )
+
+            # Moderate while looking up the category and server owner
+            (flagged_str, blocked_str), category, owner_member = await asyncio.gather(
+                moderate_message(message=message, user=user),
+                resolve_category(),
+                resolve_owner_member(interaction.guild),
+            )
             await send_moderation_blocked_message(
                 guild=interaction.guild,
                 user=user,
@@ -195,16 +382,13 @@ async def chat_command(
                 message=message,
             )
             if len(blocked_str) > 0:
-                await interaction.response.send_message(
+                await interaction.followup.send(
                     f"Your prompt was blocked.\n{message}",
                     ephemeral=True,
                 )
                 return
 
-            await interaction.response.defer(ephemeral=True)
-
             # Get AI Chats category
-            category = client.get_channel(AI_CHATS_CATEGORY_ID)
             if not category:
                 await interaction.followup.send(
                     "AI Chats category not found. Please contact an administrator.",
@@ -221,66 +405,54 @@ async def chat_command(
             }
             
             # Add server owner to overwrites
-            server_owner = await client.fetch_user(SERVER_OWNER_ID)
-            if server_owner:
-                owner_member = await interaction.guild.fetch_member(SERVER_OWNER_ID)
-                if owner_member:
-                    overwrites[owner_member] = discord.PermissionOverwrite(read_messages=True, send_messages=True)
+            if owner_member:
+                overwrites[owner_member] = discord.PermissionOverwrite(read_messages=True, send_messages=True)
 
-            chat_channel = await interaction.guild.create_text_channel(
+            # Claim a pre-created channel if the warm pool has one
+            chat_channel = await channel_pool.claim(
                 name=channel_name,
-                category=category,
                 overwrites=overwrites,
-                reason=f"AI Chat for {user.name}"
+                reason=f"AI Chat for {user.name}",
             )
+            if chat_channel is None:
+                chat_channel = await interaction.guild.create_text_channel(
+                    name=channel_name,
+                    category=category,
+                    overwrites=overwrites,
+                    reason=f"AI Chat for {user.name}"
+                )
 
             # Store channel data
-            channel_data[chat_channel.id] = {
-                "config": ThreadConfig(model=model, max_tokens=max_tokens, temperature=temperature),
-                "last_activity": datetime.datetime.now(),
-                "user_id": user.id,
-                "reminder_sent": False
-            }
-
-            # Send initial message with embed
-            embed = discord.Embed(
-                title="AI Chat Session Started",
-                description=f"{user.mention} has started a new AI chat session!",
-                color=discord.Color.blue()
-            )
-            embed.add_field(name="Model", value=model)
-            embed.add_field(name="Temperature", value=temperature)
-            embed.add_field(name="Max Tokens", value=max_tokens)
-            await chat_channel.send(content=f"{user.mention}", embed=embed)
-
-            # Send flagged message if needed
-            if len(flagged_str) > 0:
-                warning_embed = discord.Embed(
-                    title="⚠️ Flagged by moderation",
-                    description=f"Your message was flagged but allowed.",
-                    color=discord.Color.yellow()
-                )
-                await chat_channel.send(embed=warning_embed)
-                
-                await send_moderation_flagged_message(
-                    guild=interaction.guild,
-                    user=user,
-                    flagged_str=flagged_str,
-                    message=message,
-                    url=chat_channel.jump_url,
+            conversation_cache.start(chat_channel.id)
+            sessions.add(
+                Session(
+                    channel_id=chat_channel.id,
+                    guild_id=interaction.guild.id,
+                    user_id=user.id,
+                    config=thread_config,
+                    last_activity=datetime.datetime.now(),
                 )
+            )
+            inactivity_timers.schedule(sessions.get(chat_channel.id))
 
-            # Send user's initial message
-            initial_message = await chat_channel.send(f"**{user.name}**: {message}")
+            # Post the welcome messages while the first reply is generated
+            welcome = asyncio.create_task(
+                send_chat_welcome(chat_channel, user, message, flagged_str, thread_config)
+            )
 
             # Generate AI response
             async with chat_channel.typing():
-                messages = [Message(user=user.name, text=message)]
-                response_data = await generate_completion_response(
-                    messages=messages,
-                    user=user,
-                    thread_config=channel_data[chat_channel.id]["config"],
-                )
+                if speculative_reply is not None:
+                    response_data = await speculative_reply
+                else:
+                    response_data = await generate_completion_response(
+                        messages=messages,
+                        user=user,
+                        thread_config=thread_config,
+                        thread=chat_channel,
+                        send_after=welcome,
+                    )
+                await welcome
 
                 await process_response(
                     user=user,
@@ -300,9 +472,14 @@ async def chat_command(
                 f"Failed to start chat: {str(e)}", ephemeral=True
             )
             return
+        finally:
+            if speculative_reply is not None and not speculative_reply.done():
+                speculative_reply.cancel()
+            sessions.release(user.id)
 
     except Exception as e:
         logger.exception(e)
+        metrics.inc("errors_total", stage="chat_command", error=type(e).__name__)
         if not interaction.response.is_done():
             await interaction.response.send_message(
                 f"Failed to create chat: {str(e)}", ephemeral=True
@@ -314,8 +491,12 @@ async def chat_command(
 
 
 @client.event
+@metrics.timed("on_message")
 async def on_message(message: DiscordMessage):
     try:
+        # Keep the conversation cache of managed channels up to date, including our own sends
+        conversation_cache.record(message)
+
         # Ignore messages from the bot itself
         if message.author == client.user:
             return
@@ -329,18 +510,28 @@ async def on_message(message: DiscordMessage):
             return
 
         # Check if this is a message in one of our AI chat channels
-        if message.channel.id not in channel_data:
+        if message.channel.id not in sessions:
             return
 
-        # Update the last activity time for this channel
-        channel_data[message.channel.id]["last_activity"] = datetime.datetime.now()
-        # Reset reminder flag when there's new activity
-        channel_data[message.channel.id]["reminder_sent"] = False
+        # Update the last activity time for this channel and reset the reminder
+        sessions.touch(message.channel.id)
+        inactivity_timers.schedule(sessions.get(message.channel.id))
 
         # Moderate
-        flagged_str, blocked_str = moderate_message(
-            message=message.content, user=message.author
-        )
+        if SPECULATIVE_COMPLETIONS:
+            # Schedule the reply right away, it is only sent once the message passes
+            input_check = asyncio.create_task(
+                moderate_message(message=message.content, user=message.author)
+            )
+            submission = reply_scheduler.submit(
+                message.channel.id,
+                lambda: reply_in_channel(message.channel, message.author, input_check),
+            )
+            flagged_str, blocked_str = await input_check
+        else:
+            flagged_str, blocked_str = await moderate_message(
+                message=message.content, user=message.author
+            )
         await send_moderation_blocked_message(
             guild=message.guild,
             user=message.author,
@@ -348,9 +539,17 @@ async def on_message(message: DiscordMessage):
             message=message.content,
         )
         if len(blocked_str) > 0:
+            if SPECULATIVE_COMPLETIONS:
+                # drop this message's reply, earlier messages still get one
+                reply_scheduler.withdraw(
+                    message.channel.id,
+                    submission,
+                    lambda: reply_in_channel(message.channel, message.author),
+                )
             try:
                 await message.delete()
-                await message.channel.send(
+                await send_queue.send(
+                    message.channel,
                     embed=discord.Embed(
                         description=f"❌ {message.author.mention}'s message deleted by moderation.",
                         color=discord.Color.red(),
@@ -358,7 +557,8 @@ async def on_message(message: DiscordMessage):
                 )
                 return
             except Exception:
-                await message.channel.send(
+                await send_queue.send(
+                    message.channel,
                     embed=discord.Embed(
                         description=f"❌ {message.author.mention}'s message blocked but couldn't delete it.",
                         color=discord.Color.red(),
@@ -366,55 +566,113 @@ async def on_message(message: DiscordMessage):
                 )
                 return
 
-        await asyncio.sleep(SECONDS_DELAY_RECEIVING_MSG)
+        # Wait for the user to stop typing, one reply covers all messages since the last one
+        if not SPECULATIVE_COMPLETIONS:
+            reply_scheduler.submit(
+                message.channel.id, lambda: reply_in_channel(message.channel, message.author)
+            )
 
-        # Check if another message from the bot was sent after this user's message
-        async for last_msg in message.channel.history(limit=1):
-            if last_msg.author == client.user and last_msg.id != message.id:
-                # Bot already responded to a newer message
-                return
+    except Exception as e:
+        logger.exception(e)
+        metrics.inc("errors_total", stage="on_message", error=type(e).__name__)
 
-        logger.info(
-            f"Channel message to process - {message.author}: {message.content[:50]} - {message.channel.name}"
-        )
 
-        # Collect message history
-        channel_messages = [
-            discord_message_to_message(m)
-            async for m in message.channel.history(limit=MAX_THREAD_MESSAGES)  # Using MAX_THREAD_MESSAGES instead of MAX_MESSAGES
-        ]
-        channel_messages = [x for x in channel_messages if x is not None]
-        channel_messages.reverse()
-
-        # Generate AI response
-        async with message.channel.typing():
-            response_data = await generate_completion_response(
-                messages=channel_messages,
-                user=message.author,
-                thread_config=channel_data[message.channel.id]["config"],
-            )
+@metrics.timed("turn")
+async def reply_in_channel(
+    channel: discord.TextChannel,
+    user: discord.User,
+    input_check: Optional[asyncio.Task] = None,
+):
+    """`input_check` is the moderation of the latest message when the reply
+    was started speculatively; nothing is sent unless it passes."""
+    session = sessions.get(channel.id)
+    if session is None:
+        return
+
+    async def input_passed() -> bool:
+        return input_check is None or not (await asyncio.shield(input_check))[1]
+
+    async def wait_for_input_check():
+        if not await input_passed():
+            # drop the reply like a superseded one
+            raise asyncio.CancelledError()
+
+    # Collect message history, only hitting the API on a cold cache
+    with metrics.timer("history_fetch"):
+        channel_messages = await conversation_cache.get_messages(channel)
+
+    logger.info(
+        f"Channel message to process - {user}: {channel_messages[-1].text[:50] if channel_messages else ''} - {channel.name}"
+    )
+
+    # Generate AI response
+    async with channel.typing():
+        response_data = await generate_completion_response(
+            messages=channel_messages,
+            user=user,
+            thread_config=session.config,
+            thread=channel,
+            send_after=asyncio.create_task(wait_for_input_check()) if input_check is not None else None,
+        )
+        if not await input_passed():
+            return
 
+        async with reply_scheduler.sending(channel.id):
             await process_response(
-                user=message.author,
-                thread=message.channel,  # Using channel in place of thread
+                user=user,
+                thread=channel,  # Using channel in place of thread
                 response_data=response_data,
             )
-            
-            # Update last activity time after bot responds
-            channel_data[message.channel.id]["last_activity"] = datetime.datetime.now()
 
-    except Exception as e:
-        logger.exception(e)
+        # Update last activity time after bot responds
+        if channel.id in sessions:
+            sessions.touch(channel.id)
+            inactivity_timers.schedule(session)
         
+@client.event
+async def on_guild_channel_delete(channel: discord.abc.GuildChannel):
+    channel_pool.discard(channel.id)
+    invalidate_moderation_channel(channel.id)
+
+
+@client.event
+async def on_guild_channel_update(
+    before: discord.abc.GuildChannel, after: discord.abc.GuildChannel
+):
+    invalidate_moderation_channel(after.id)
+
+
+@client.event
+async def on_message_edit(before: DiscordMessage, after: DiscordMessage):
+    conversation_cache.update(after)
+
+
+@client.event
+async def on_raw_message_edit(payload: discord.RawMessageUpdateEvent):
+    # on_message_edit only fires for messages in discord.py's cache
+    if payload.cached_message is None:
+        conversation_cache.invalidate(payload.channel_id)
+
+
+@client.event
+async def on_raw_message_delete(payload: discord.RawMessageDeleteEvent):
+    conversation_cache.remove(payload.channel_id, payload.message_id)
+
+
+@client.event
+async def on_raw_bulk_message_delete(payload: discord.RawBulkMessageDeleteEvent):
+    conversation_cache.invalidate(payload.channel_id)
+
+
 @tree.command(name="close", description="Close this AI chat channel")
 async def close(interaction: discord.Interaction):
     channel = interaction.channel
     if isinstance(channel, discord.TextChannel):
-        if channel.id in channel_data:
+        if channel.id in sessions:
             try:
                 await interaction.response.send_message("Closing this chat...", ephemeral=True)
                 await channel.delete(reason="Closed by user via /close")
-                del channel_data[channel.id]
+                forget_channel(channel.id)
             except Exception as e:
                 logger.error(f"Error deleting channel {channel.id}: {e}")
                 await interaction.response.send_message("Failed to delete channel.", ephemeral=True)
@@ -425,4 +683,14 @@ async def close(interaction: discord.Interaction):
 
 
 
-client.run(DISCORD_BOT_TOKEN)
+async def run_bot():
+    try:
+        async with client:
+            await client.start(DISCORD_BOT_TOKEN)
+    finally:
+        # keep the session changes made since the last periodic flush
+        await sessions.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(run_bot())
@@ -0,0 +1,188 @@
+from bisect import bisect_left
+from typing import Any, Callable, Dict, List, Optional, Tuple
+import contextlib
+import dataclasses
+import functools
+import time
+
+from src.constants import METRICS_HOST, METRICS_PORT
+from src.utils import logger
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+STAGE_SECONDS = "stage_latency_seconds"
+
+LabelKey = Tuple[Tuple[str, str], ...]
+
+
+class Histogram:
+    def __init__(self, buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class _Timer:
+    __slots__ = ("metrics", "name", "labels", "started_at")
+
+    def __init__(self, metrics: "Metrics", name: str, labels: Dict[str, str]):
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.started_at = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.metrics.observe(self.name, time.perf_counter() - self.started_at, **self.labels)
+
+
+_NO_TIMER = contextlib.nullcontext()
+
+
+def _label_key(labels: Dict[str, Any]) -> LabelKey:
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _stat_names(stats: Any) -> List[str]:
+    """The dataclass fields of `stats`, then its properties such as hit_rate."""
+    properties = [
+        name for name, value in vars(type(stats)).items() if isinstance(value, property)
+    ]
+    return [field.name for field in dataclasses.fields(stats)] + properties
+
+
+def _format_labels(key: LabelKey, extra: Optional[Tuple[str, str]] = None) -> str:
+    pairs = list(key) + ([extra] if extra else [])
+    if not pairs:
+        return ""
+    escaped = (
+        k + '="' + v.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") + '"'
+        for k, v in pairs
+    )
+    return "{" + ",".join(escaped) + "}"
+
+
+class Metrics:
+    """Histograms, counters and gauges in Prometheus text format.
+
+    When disabled, recording returns right away and `timer` hands out a
+    shared no-op context manager, so instrumented code costs next to nothing.
+    The stats dataclasses of the other modules are exported as gauges with
+    `export_stats`.
+    """
+
+    def __init__(self, enabled: bool):
+        self.enabled = enabled
+        self._histograms: Dict[str, Dict[LabelKey, Histogram]] = {}
+        self._counters: Dict[str, Dict[LabelKey, float]] = {}
+        self._gauges: List[Tuple[str, Callable[[], float]]] = []
+        self._stats: List[Tuple[str, Any, LabelKey]] = []
+        self._runner = None
+
+    def observe(self, name: str, value: float, **labels):
+        if not self.enabled:
+            return
+        series = self._histograms.setdefault(name, {})
+        key = _label_key(labels)
+        if key not in series:
+            series[key] = Histogram()
+        series[key].observe(value)
+
+    def inc(self, name: str, value: float = 1, **labels):
+        if not self.enabled:
+            return
+        series = self._counters.setdefault(name, {})
+        key = _label_key(labels)
+        series[key] = series.get(key, 0) + value
+
+    def timer(self, stage: str, **labels):
+        """Times the block into the stage latency histogram."""
+        if not self.enabled:
+            return _NO_TIMER
+        return _Timer(self, STAGE_SECONDS, dict(labels, stage=stage))
+
+    def gauge(self, name: str, read: Callable[[], float]):
+        self._gauges.append((name, read))
+
+    def export_stats(self, prefix: str, stats: Any, **labels):
+        self._stats.append((prefix, stats, _label_key(labels)))
+
+    def timed(self, stage: str):
+        """Decorator timing every call of an async function, a no-op when
+        metrics are disabled."""
+
+        def decorate(func):
+            if not self.enabled:
+                return func
+
+            @functools.wraps(func)
+            async def wrapper(*args, **kwargs):
+                with self.timer(stage):
+                    return await func(*args, **kwargs)
+
+            return wrapper
+
+        return decorate
+
+    def render(self) -> str:
+        lines = []
+        for name, series in self._histograms.items():
+            lines.append(f"# TYPE {name} histogram")
+            for key, histogram in series.items():
+                cumulative = 0
+                for bound, count in zip(histogram.buckets, histogram.counts):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{_format_labels(key, ('le', str(bound)))} {cumulative}")
+                lines.append(f"{name}_bucket{_format_labels(key, ('le', '+Inf'))} {histogram.count}")
+                lines.append(f"{name}_sum{_format_labels(key)} {histogram.sum}")
+                lines.append(f"{name}_count{_format_labels(key)} {histogram.count}")
+        for name, series in self._counters.items():
+            lines.append(f"# TYPE {name} counter")
+            for key, value in series.items():
+                lines.append(f"{name}{_format_labels(key)} {value}")
+        for name, read in self._gauges:
+            lines.append(f"# TYPE {name} gauge")
+            lines.append(f"{name} {read()}")
+        samples: Dict[str, List[str]] = {}
+        for prefix, stats, key in self._stats:
+            for stat in _stat_names(stats):
+                value = getattr(stats, stat)
+                if isinstance(value, (int, float)):
+                    name = f"{prefix}_{stat}"
+                    samples.setdefault(name, []).append(f"{name}{_format_labels(key)} {float(value)}")
+        for name, series_lines in samples.items():
+            lines.append(f"# TYPE {name} gauge")
+            lines.extend(series_lines)
+        return "\n".join(lines) + "\n"
+
+    async def serve(self, host: str, port: int):
+        """Serves /metrics over HTTP, using the aiohttp that discord.py
+        already depends on."""
+        if self._runner is not None:
+            return
+        from aiohttp import web
+
+        async def handle(request):
+            return web.Response(text=self.render(), content_type="text/plain")
+
+        app = web.Application()
+        app.router.add_get("/metrics", handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host, port).start()
+        logger.info(f"Serving metrics on http://{host}:{port}/metrics")
+
+
+metrics = Metrics(enabled=METRICS_PORT is not None)
+
+
+async def start_metrics_server():
+    if metrics.enabled:
+        await metrics.serve(METRICS_HOST, METRICS_PORT)
@@ -1,31 +1,312 @@
-from openai._compat import model_dump
-
 from src.constants import (
     SERVER_TO_MODERATION_CHANNEL,
     MODERATION_VALUES_FOR_BLOCKED,
     MODERATION_VALUES_FOR_FLAGGED,
+    MODERATION_MODEL,
+    MODERATION_TIMEOUT_SECONDS,
+    MODERATION_MAX_RETRIES,
+    MODERATION_BATCH_WINDOW_SECONDS,
+    MODERATION_BATCH_MAX_SIZE,
+    MODERATION_REPORT_QUEUE_SIZE,
+    MODERATION_DIGEST_SECONDS,
+    MAX_DISCORD_MESSAGE_CHARS,
+    MODERATION_CACHE_SIZE,
+    MODERATION_CACHE_TTL_SECONDS,
+    MODERATION_BLOCK_TERMS,
+    MODERATION_SAFE_WORDS,
+    MODERATION_FAST_PATH_MAX_CHARS,
 )
-from openai import OpenAI
-
-client = OpenAI()
-from typing import Optional, Tuple
+from src.backend_pool import BackendPool, backend_pool
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+import asyncio
+import hashlib
+import re
+import sys
+import time
+import unicodedata
 import discord
-from src.utils import logger
+from src.utils import SharedCalls, logger
+from src.metrics import metrics
 
 
-def moderate_message(
-    message: str, user: str
-) -> Tuple[str, str]:  # [flagged_str, blocked_str]
-    moderation_response = client.moderations.create(
-        input=message, model="text-moderation-latest"
-    )
-    category_scores = moderation_response.results[0].category_scores
+class OpenAIModerationBackend:
+    """Moderation backend using the OpenAI backend pool.
+
+    The pool's clients are shared by every call so requests reuse the same
+    connection pools instead of opening a new connection per message.
+    """
+
+    def __init__(self, pool: Optional[BackendPool] = None):
+        self.pool = pool or backend_pool
+
+    async def moderate(self, inputs: List[str]) -> List[Dict[str, float]]:
+        moderation_response = await self.pool.call(
+            lambda client: client.with_options(
+                timeout=MODERATION_TIMEOUT_SECONDS,
+                max_retries=MODERATION_MAX_RETRIES,
+            ).moderations.with_raw_response.create(input=inputs, model=MODERATION_MODEL),
+            model=MODERATION_MODEL,
+            moderation=True,
+        )
+        return [
+            result.category_scores.model_dump(by_alias=True)
+            for result in moderation_response.results
+        ]
+
+
+# Any object with an `async moderate(inputs) -> List[Dict[str, float]]` method
+# can be swapped in with `set_moderation_backend`, e.g. a local fake in tests.
+moderation_backend = OpenAIModerationBackend()
+
+
+def set_moderation_backend(backend) -> None:
+    global moderation_backend
+    moderation_backend = backend
+
+
+@dataclass
+class ModerationBatchStats:
+    batches: int = 0
+    inputs: int = 0
+    max_batch_size: int = 0
+    total_wait_seconds: float = 0.0
+    max_wait_seconds: float = 0.0
+
+    @property
+    def average_batch_size(self) -> float:
+        return self.inputs / self.batches if self.batches else 0.0
+
+    @property
+    def average_wait_seconds(self) -> float:
+        return self.total_wait_seconds / self.inputs if self.inputs else 0.0
+
+
+class ModerationBatcher:
+    """Collects moderation calls from every channel into list requests.
+
+    A batch is sent once `window_seconds` have passed since its first input or
+    as soon as it holds `max_size` inputs, whichever comes first. Each caller
+    gets back the category scores for its own input.
+    """
+
+    def __init__(self, window_seconds: float, max_size: int):
+        self.window_seconds = window_seconds
+        self.max_size = max_size
+        self.stats = ModerationBatchStats()
+        self._pending: List[Tuple[str, asyncio.Future, float]] = []
+        self._flush_handle: Optional[asyncio.TimerHandle] = None
+        self._tasks = set()
+
+    async def moderate(self, message: str) -> Dict[str, float]:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((message, future, loop.time()))
+        if len(self._pending) >= self.max_size:
+            self._flush()
+        elif self._flush_handle is None:
+            self._flush_handle = loop.call_later(self.window_seconds, self._flush)
+        return await future
+
+    def _flush(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        batch, self._pending = self._pending, []
+        if batch:
+            task = asyncio.create_task(self._send(batch))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _send(self, batch: List[Tuple[str, asyncio.Future, float]]):
+        now = asyncio.get_running_loop().time()
+        waits = [now - queued_at for _, _, queued_at in batch]
+        self.stats.batches += 1
+        self.stats.inputs += len(batch)
+        self.stats.max_batch_size = max(self.stats.max_batch_size, len(batch))
+        self.stats.total_wait_seconds += sum(waits)
+        self.stats.max_wait_seconds = max(self.stats.max_wait_seconds, max(waits))
+        logger.debug(
+            f"moderation batch size={len(batch)} max_wait={max(waits):.4f}s "
+            f"avg_size={self.stats.average_batch_size:.2f}"
+        )
+
+        try:
+            results = await moderation_backend.moderate([m for m, _, _ in batch])
+            if len(results) != len(batch):
+                # zip would leave the callers without a result waiting forever
+                raise ValueError(
+                    f"Moderation returned {len(results)} results for {len(batch)} inputs"
+                )
+        except Exception as e:
+            for _, future, _ in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        for (_, future, _), category_scores in zip(batch, results):
+            if not future.done():
+                future.set_result(category_scores)
+
+
+moderation_batcher = ModerationBatcher(
+    window_seconds=MODERATION_BATCH_WINDOW_SECONDS,
+    max_size=MODERATION_BATCH_MAX_SIZE,
+)
+
+
+@dataclass
+class ModerationCacheStats:
+    hits: int = 0
+    misses: int = 0
+    evictions: int = 0
+    size_bytes: int = 0
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+
+class ModerationCache:
+    """LRU cache of raw category scores keyed by a hash of normalized text.
+
+    Scores are stored rather than flagged/blocked results so changes to the
+    MODERATION_VALUES_FOR_* thresholds apply without re-querying. Identical
+    texts that are being moderated at the same time share one lookup.
+    """
+
+    def __init__(self, max_entries: int, ttl_seconds: float):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.stats = ModerationCacheStats()
+        self._entries: "OrderedDict[bytes, Tuple[float, Dict[str, float]]]" = OrderedDict()
+        self._in_flight = SharedCalls()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    @staticmethod
+    def key(message: str) -> bytes:
+        normalized = " ".join(unicodedata.normalize("NFKC", message).casefold().split())
+        return hashlib.blake2b(normalized.encode(), digest_size=16).digest()
+
+    async def get_or_moderate(self, message: str) -> Dict[str, float]:
+        key = self.key(message)
+        entry = self._entries.get(key)
+        if entry and entry[0] > time.monotonic():
+            self._entries.move_to_end(key)
+            self.stats.hits += 1
+            return entry[1]
+        if key in self._in_flight:
+            self.stats.hits += 1
+        else:
+            self.stats.misses += 1
+
+        async def moderate_and_put():
+            category_scores = await moderation_batcher.moderate(message)
+            self._put(key, category_scores)
+            return category_scores
+
+        return await self._in_flight.call(key, moderate_and_put)
+
+    def _put(self, key: bytes, category_scores: Dict[str, float]):
+        if key in self._entries:
+            self.stats.size_bytes -= self._entry_size(key, self._entries.pop(key)[1])
+        self._entries[key] = (time.monotonic() + self.ttl_seconds, category_scores)
+        self.stats.size_bytes += self._entry_size(key, category_scores)
+        while len(self._entries) > self.max_entries:
+            old_key, (_, old_scores) = self._entries.popitem(last=False)
+            self.stats.size_bytes -= self._entry_size(old_key, old_scores)
+            self.stats.evictions += 1
+
+    @staticmethod
+    def _entry_size(key: bytes, category_scores: Dict[str, float]) -> int:
+        # approximate, the category names are shared interned strings
+        return (
+            sys.getsizeof(key)
+            + sys.getsizeof(category_scores)
+            + 24 * len(category_scores)
+        )
+
+
+moderation_cache = ModerationCache(
+    max_entries=MODERATION_CACHE_SIZE,
+    ttl_seconds=MODERATION_CACHE_TTL_SECONDS,
+)
+
+
+LOCAL_BLOCK = "block"
+LOCAL_ALLOW = "allow"
+
+
+@dataclass
+class LocalModerationStats:
+    blocked: int = 0
+    allowed: int = 0
+    remote: int = 0
+
+    @property
+    def avoided_fraction(self) -> float:
+        total = self.blocked + self.allowed + self.remote
+        return (self.blocked + self.allowed) / total if total else 0.0
+
+
+class LocalModerator:
+    """First moderation tier that runs locally in microseconds.
+
+    Blocks text containing any of `block_terms` (one compiled alternation)
+    and allows short plain-ASCII messages made only of `safe_words`, like
+    "ok" or "thanks". Everything else returns None and goes to the API.
+    """
+
+    def __init__(self, block_terms: List[str], safe_words: List[str], max_safe_chars: int):
+        self.block_pattern = (
+            re.compile(
+                r"\b(?:" + "|".join(re.escape(t) for t in block_terms) + r")\b",
+                re.IGNORECASE,
+            )
+            if block_terms
+            else None
+        )
+        self.safe_words = frozenset(w.lower() for w in safe_words)
+        self.max_safe_chars = max_safe_chars
+        self.stats = LocalModerationStats()
+
+    def check(self, message: str, user: str) -> Optional[str]:
+        if self.block_pattern is not None:
+            match = self.block_pattern.search(message)
+            if match:
+                self.stats.blocked += 1
+                logger.info(f"local moderation blocked {user} term={match.group(0)!r}")
+                return LOCAL_BLOCK
+        if len(message) <= self.max_safe_chars and message.isascii():
+            words = SAFE_WORD_SPLIT.split(message.lower())
+            if all(w in self.safe_words for w in words if w):
+                self.stats.allowed += 1
+                logger.info(f"local moderation allowed {user} {message!r}")
+                return LOCAL_ALLOW
+        self.stats.remote += 1
+        return None
+
+
+# punctuation that may surround safe words, anything else goes to the API
+SAFE_WORD_SPLIT = re.compile(r"[\s.,!?']+")
+
+local_moderator = LocalModerator(
+    block_terms=MODERATION_BLOCK_TERMS,
+    safe_words=MODERATION_SAFE_WORDS,
+    max_safe_chars=MODERATION_FAST_PATH_MAX_CHARS,
+)
 
-    category_score_items = dict(category_scores)  # <--- THIS LINE
 
+def scores_to_result(
+    category_scores: Dict[str, Optional[float]], user: str
+) -> Tuple[str, str]:  # [flagged_str, blocked_str]
     blocked_str = ""
     flagged_str = ""
-    for category, score in category_score_items.items():
+    for category, score in category_scores.items():
         if score is not None and score > MODERATION_VALUES_FOR_BLOCKED.get(category, 1.0):
             blocked_str += f"({category}: {score})"
             logger.info(f"blocked {user} {category} {score}")
@@ -37,18 +318,125 @@ def moderate_message(
     return (flagged_str, blocked_str)
 
 
+@metrics.timed("moderation")
+async def moderate_message(
+    message: str, user: str
+) -> Tuple[str, str]:  # [flagged_str, blocked_str]
+    local_result = local_moderator.check(message, user)
+    if local_result == LOCAL_BLOCK:
+        return ("", "(local: block term)")
+    if local_result == LOCAL_ALLOW:
+        return ("", "")
+    category_scores = await moderation_cache.get_or_moderate(message)
+    return scores_to_result(category_scores, user)
+
+
+# moderation channel per guild id, dropped when the channel is deleted or updated
+moderation_channels: Dict[int, discord.abc.GuildChannel] = {}
+
+
+def invalidate_moderation_channel(channel_id: int):
+    for guild_id, channel in list(moderation_channels.items()):
+        if channel.id == channel_id:
+            del moderation_channels[guild_id]
+
+
 async def fetch_moderation_channel(
     guild: Optional[discord.Guild],
 ) -> Optional[discord.abc.GuildChannel]:
     if not guild or not guild.id:
         return None
+    if guild.id in moderation_channels:
+        return moderation_channels[guild.id]
     moderation_channel = SERVER_TO_MODERATION_CHANNEL.get(guild.id, None)
     if moderation_channel:
-        channel = await guild.fetch_channel(moderation_channel)
+        channel = guild.get_channel(moderation_channel) or await guild.fetch_channel(
+            moderation_channel
+        )
+        moderation_channels[guild.id] = channel
         return channel
     return None
 
 
+@dataclass
+class ModerationReportStats:
+    reports: int = 0
+    dropped: int = 0
+    digests: int = 0
+
+
+class ModerationReporter:
+    """Sends moderation reports from a bounded background queue.
+
+    Reporting never waits on Discord: reports are queued and dropped when the
+    queue is full. Reports arriving within `digest_seconds` of each other are
+    coalesced into as few digest messages per guild as possible.
+    """
+
+    def __init__(self, max_queued: int, digest_seconds: float):
+        self.max_queued = max_queued
+        self.digest_seconds = digest_seconds
+        self.stats = ModerationReportStats()
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def report(self, guild: discord.Guild, line: str):
+        if self._queue is None:
+            self._queue = asyncio.Queue(maxsize=self.max_queued)
+            self._task = asyncio.create_task(self._run())
+        try:
+            self._queue.put_nowait((guild, line))
+            self.stats.reports += 1
+        except asyncio.QueueFull:
+            self.stats.dropped += 1
+            logger.warning(f"moderation report dropped, queue full: {line[:100]}")
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self.digest_seconds
+            while True:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            by_guild: Dict[int, Tuple[discord.Guild, List[str]]] = {}
+            for guild, line in batch:
+                by_guild.setdefault(guild.id, (guild, []))[1].append(line)
+            for guild, lines in by_guild.values():
+                try:
+                    await self._send(guild, lines)
+                except Exception as e:
+                    logger.error(f"Failed to send moderation report: {e}")
+
+    async def _send(self, guild: discord.Guild, lines: List[str]):
+        moderation_channel = await fetch_moderation_channel(guild=guild)
+        if not moderation_channel:
+            return
+        digest = ""
+        for line in lines:
+            line = line[:MAX_DISCORD_MESSAGE_CHARS]
+            if digest and len(digest) + 1 + len(line) > MAX_DISCORD_MESSAGE_CHARS:
+                await moderation_channel.send(digest)
+                self.stats.digests += 1
+                digest = ""
+            digest = f"{digest}\n{line}" if digest else line
+        if digest:
+            await moderation_channel.send(digest)
+            self.stats.digests += 1
+
+
+moderation_reporter = ModerationReporter(
+    max_queued=MODERATION_REPORT_QUEUE_SIZE,
+    digest_seconds=MODERATION_DIGEST_SECONDS,
+)
+
+
 async def send_moderation_flagged_message(
     guild: Optional[discord.Guild],
     user: str,
@@ -57,12 +445,10 @@ async def send_moderation_flagged_message(
     url: Optional[str],
 ):
     if guild and flagged_str and len(flagged_str) > 0:
-        moderation_channel = await fetch_moderation_channel(guild=guild)
-        if moderation_channel:
-            message = message[:100] if message else None
-            await moderation_channel.send(
-                f"⚠️ {user} - {flagged_str} - {message} - {url}"
-            )
+        message = message[:100] if message else None
+        moderation_reporter.report(
+            guild, f"⚠️ {user} - {flagged_str} - {message} - {url}"
+        )
 
 
 async def send_moderation_blocked_message(
@@ -72,7 +458,5 @@ async def send_moderation_blocked_message(
     message: Optional[str],
 ):
     if guild and blocked_str and len(blocked_str) > 0:
-        moderation_channel = await fetch_moderation_channel(guild=guild)
-        if moderation_channel:
-            message = message[:500] if message else None
-            await moderation_channel.send(f"❌ {user} - {blocked_str} - {message}")
+        message = message[:500] if message else None
+        moderation_reporter.report(guild, f"❌ {user} - {blocked_str} - {message}")
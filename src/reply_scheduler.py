@@ -0,0 +1,145 @@
+from dataclasses import dataclass
+from typing import Awaitable, Callable, Dict, Optional
+import asyncio
+import contextlib
+
+from src.constants import REPLY_DEBOUNCE_SECONDS, REPLY_MAX_DELAY_SECONDS
+from src.utils import logger
+
+
+@dataclass
+class ReplySchedulerStats:
+    submitted: int = 0
+    started: int = 0
+    superseded: int = 0
+
+
+@dataclass
+class _ChannelState:
+    timer: Optional[asyncio.TimerHandle] = None
+    first_pending_at: Optional[float] = None
+    task: Optional[asyncio.Task] = None
+    sending_task: Optional[asyncio.Task] = None
+    latest: int = 0  # number of the last submission
+    waiting: int = 0  # submitted messages not yet covered by a sending reply
+
+
+class ReplyScheduler:
+    """Coalesces incoming messages into one reply per channel.
+
+    Every new message resets a short debounce timer (capped so a steady
+    stream of messages still gets answered) and cancels a reply that is
+    still being generated, since the new reply will cover its messages too.
+    A reply that has started sending is never cancelled; the next one waits
+    for it, so at most one completion is in flight per channel.
+    """
+
+    def __init__(self, debounce_seconds: float, max_delay_seconds: float):
+        self.debounce_seconds = debounce_seconds
+        self.max_delay_seconds = max_delay_seconds
+        self.stats = ReplySchedulerStats()
+        self._channels: Dict[int, _ChannelState] = {}
+
+    def submit(self, channel_id: int, reply: Callable[[], Awaitable[None]]) -> int:
+        """Schedules `reply` and returns the submission's number for `withdraw`."""
+        state = self._channels.setdefault(channel_id, _ChannelState())
+        self.stats.submitted += 1
+        state.latest += 1
+        state.waiting += 1
+        self._schedule(state, reply)
+        return state.latest
+
+    def withdraw(
+        self, channel_id: int, submission: int, reply: Callable[[], Awaitable[None]]
+    ):
+        """Takes back a submitted message, e.g. after it got blocked.
+
+        If its reply is the pending one, it is dropped (unless already
+        sending), and `reply` is scheduled instead when earlier messages are
+        still waiting for an answer. A later submission already covers them.
+        """
+        state = self._channels.get(channel_id)
+        if state is None:
+            return
+        state.waiting = max(state.waiting - 1, 0)
+        if submission != state.latest:
+            return
+        if state.timer is not None:
+            state.timer.cancel()
+            state.timer = None
+            state.first_pending_at = None
+        if (
+            state.task is not None
+            and not state.task.done()
+            and state.task is not state.sending_task
+        ):
+            state.task.cancel()
+        if state.waiting:
+            self._schedule(state, reply)
+
+    def _schedule(self, state: _ChannelState, reply: Callable[[], Awaitable[None]]):
+        loop = asyncio.get_running_loop()
+        if state.timer is not None:
+            state.timer.cancel()
+        else:
+            state.first_pending_at = loop.time()
+        if (
+            state.task is not None
+            and not state.task.done()
+            and state.task is not state.sending_task
+        ):
+            state.task.cancel()
+            self.stats.superseded += 1
+
+        delay = min(
+            self.debounce_seconds,
+            state.first_pending_at + self.max_delay_seconds - loop.time(),
+        )
+        state.timer = loop.call_later(max(delay, 0), self._start, state, reply)
+
+    def cancel(self, channel_id: int):
+        state = self._channels.pop(channel_id, None)
+        if state is None:
+            return
+        if state.timer is not None:
+            state.timer.cancel()
+        if state.task is not None:
+            state.task.cancel()
+
+    @contextlib.asynccontextmanager
+    async def sending(self, channel_id: int):
+        """Marks the current reply as committed so it is no longer superseded."""
+        state = self._channels.get(channel_id)
+        task = asyncio.current_task()
+        if state is not None:
+            state.sending_task = task
+            state.waiting = 0
+        try:
+            yield
+        finally:
+            if state is not None and state.sending_task is task:
+                state.sending_task = None
+
+    def _start(self, state: _ChannelState, reply: Callable[[], Awaitable[None]]):
+        state.timer = None
+        state.first_pending_at = None
+        self.stats.started += 1
+        state.task = asyncio.create_task(self._run(state.task, reply))
+
+    async def _run(
+        self, previous: Optional[asyncio.Task], reply: Callable[[], Awaitable[None]]
+    ):
+        try:
+            if previous is not None and not previous.done():
+                await asyncio.wait([previous])
+            await reply()
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            logger.exception(e)
+
+
+reply_scheduler = ReplyScheduler(
+    debounce_seconds=REPLY_DEBOUNCE_SECONDS,
+    max_delay_seconds=REPLY_MAX_DELAY_SECONDS,
+)
@@ -0,0 +1,240 @@
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Callable, Deque, Dict, Hashable, Optional
+import asyncio
+import contextlib
+import time
+
+from src.constants import (
+    OPENAI_MAX_CONCURRENT_REQUESTS,
+    OPENAI_REQUESTS_PER_MINUTE,
+    OPENAI_TOKENS_PER_MINUTE,
+    OPENAI_USER_WEIGHTS,
+)
+from src.metrics import STAGE_SECONDS, metrics
+
+
+@dataclass
+class RequestSchedulerStats:
+    admitted: int = 0
+    queued: int = 0
+    max_queue_depth: int = 0
+    total_wait_seconds: float = 0.0
+    max_wait_seconds: float = 0.0
+
+    @property
+    def average_wait_seconds(self) -> float:
+        return self.total_wait_seconds / self.queued if self.queued else 0.0
+
+
+class _Bucket:
+    """Token bucket holding at most `per_minute` units, refilled continuously."""
+
+    def __init__(self, per_minute: float):
+        self.capacity = per_minute
+        self.level = per_minute
+        self.rate = per_minute / 60
+        self.updated_at = time.monotonic()
+
+    def _refill(self, now: float):
+        self.level = min(self.capacity, self.level + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def seconds_until(self, amount: float, now: float) -> float:
+        self._refill(now)
+        # a request bigger than the whole bucket waits for a full one
+        missing = min(amount, self.capacity) - self.level
+        return max(missing, 0) / self.rate
+
+    def take(self, amount: float):
+        self.level -= amount
+
+    def give_back(self, amount: float):
+        self.level = min(self.capacity, self.level + amount)
+
+
+@dataclass
+class _Waiter:
+    tokens: int
+    future: asyncio.Future
+    enqueued_at: float
+
+
+@dataclass
+class Grant:
+    tokens: int
+    # set to the tokens the request really used to return the rest to the bucket
+    used_tokens: Optional[int] = None
+
+
+@dataclass
+class _UserQueue:
+    weight: int
+    waiters: Deque[_Waiter] = field(default_factory=deque)
+    # admissions left in the user's current round-robin turn
+    turn_left: int = 0
+
+
+class RequestScheduler:
+    """Admits OpenAI requests under a global concurrency cap and
+    request-per-minute and token-per-minute budgets.
+
+    Waiting requests are queued per user and served weighted round-robin,
+    so a user with many requests in flight can't starve the others. A user
+    gets `weight` admissions per turn (default 1).
+    """
+
+    def __init__(
+        self,
+        max_concurrent: int,
+        requests_per_minute: float,
+        tokens_per_minute: float,
+        weights: Optional[Dict[Hashable, int]] = None,
+    ):
+        self.max_concurrent = max_concurrent
+        self.weights = weights or {}
+        self.stats = RequestSchedulerStats()
+        self._requests = _Bucket(requests_per_minute)
+        self._tokens = _Bucket(tokens_per_minute)
+        self._active = 0
+        self._queues: Dict[Hashable, _UserQueue] = {}
+        # users with waiting requests, in round-robin order
+        self._turns: Deque[Hashable] = deque()
+        self._timer: Optional[asyncio.TimerHandle] = None
+
+    @property
+    def active(self) -> int:
+        return self._active
+
+    @property
+    def queue_depth(self) -> int:
+        return sum(len(q.waiters) for q in self._queues.values())
+
+    @contextlib.asynccontextmanager
+    async def slot(
+        self,
+        user: Hashable,
+        tokens: int,
+        on_queued: Optional[Callable[[int], None]] = None,
+    ):
+        """Waits for the request's turn. `on_queued` is called with the
+        request's estimated queue position if it has to wait."""
+        grant = await self._acquire(user, tokens, on_queued)
+        try:
+            yield grant
+        finally:
+            self._release(grant)
+
+    async def _acquire(
+        self, user: Hashable, tokens: int, on_queued: Optional[Callable[[int], None]]
+    ) -> Grant:
+        loop = asyncio.get_running_loop()
+        waiter = _Waiter(tokens=tokens, future=loop.create_future(), enqueued_at=time.monotonic())
+        queue = self._queues.get(user)
+        if queue is None:
+            queue = self._queues[user] = _UserQueue(weight=self.weights.get(user, 1))
+            self._turns.append(user)
+        queue.waiters.append(waiter)
+        self._dispatch()
+
+        queued = not waiter.future.done()
+        if queued:
+            self.stats.queued += 1
+            self.stats.max_queue_depth = max(self.stats.max_queue_depth, self.queue_depth)
+            if on_queued is not None:
+                on_queued(self._position(user, len(queue.waiters) - 1))
+        try:
+            await waiter.future
+        except asyncio.CancelledError:
+            if waiter.future.done() and not waiter.future.cancelled():
+                # admitted just as we were cancelled
+                self._release(waiter.future.result())
+            else:
+                self._forget(user, waiter)
+            raise
+
+        if queued:
+            waited = time.monotonic() - waiter.enqueued_at
+            self.stats.total_wait_seconds += waited
+            self.stats.max_wait_seconds = max(self.stats.max_wait_seconds, waited)
+            metrics.observe(STAGE_SECONDS, waited, stage="openai_queue")
+        return waiter.future.result()
+
+    def _release(self, grant: Grant):
+        self._active -= 1
+        if grant.used_tokens is not None and grant.used_tokens < grant.tokens:
+            self._tokens.give_back(grant.tokens - grant.used_tokens)
+        self._dispatch()
+
+    def _forget(self, user: Hashable, waiter: _Waiter):
+        queue = self._queues.get(user)
+        if queue is None:
+            return
+        try:
+            queue.waiters.remove(waiter)
+        except ValueError:
+            return
+        if not queue.waiters:
+            del self._queues[user]
+            self._turns.remove(user)
+        self._dispatch()
+
+    def _position(self, user: Hashable, index: int) -> int:
+        """Estimates how many requests will be admitted before the user's
+        `index`-th waiting request, assuming one admission per turn."""
+        order = list(self._turns)
+        mine = order.index(user)
+        ahead = index
+        for i, other in enumerate(order):
+            if other != user:
+                # users before us in the rotation get one more turn first
+                ahead += min(len(self._queues[other].waiters), index + (i < mine))
+        return ahead + 1
+
+    def _dispatch(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        while self._turns and self._active < self.max_concurrent:
+            user = self._turns[0]
+            queue = self._queues[user]
+            waiter = queue.waiters[0]
+            if waiter.future.done():
+                # cancelled, its task removes it from the queue when it resumes
+                queue.waiters.popleft()
+                if not queue.waiters:
+                    del self._queues[user]
+                    self._turns.popleft()
+                continue
+            now = time.monotonic()
+            wait = max(
+                self._requests.seconds_until(1, now),
+                self._tokens.seconds_until(waiter.tokens, now),
+            )
+            if wait > 0:
+                self._timer = asyncio.get_running_loop().call_later(wait, self._dispatch)
+                return
+
+            queue.waiters.popleft()
+            self._requests.take(1)
+            self._tokens.take(waiter.tokens)
+            self._active += 1
+            self.stats.admitted += 1
+            waiter.future.set_result(Grant(tokens=waiter.tokens))
+
+            if queue.turn_left <= 0:
+                queue.turn_left = queue.weight
+            queue.turn_left -= 1
+            if not queue.waiters:
+                del self._queues[user]
+                self._turns.popleft()
+            elif queue.turn_left <= 0:
+                self._turns.rotate(-1)
+
+
+request_scheduler = RequestScheduler(
+    max_concurrent=OPENAI_MAX_CONCURRENT_REQUESTS,
+    requests_per_minute=OPENAI_REQUESTS_PER_MINUTE,
+    tokens_per_minute=OPENAI_TOKENS_PER_MINUTE,
+    weights=OPENAI_USER_WEIGHTS,
+)
@@ -0,0 +1,222 @@
+from dataclasses import dataclass
+from typing import Awaitable, Callable, Dict, Optional, TypeVar
+import asyncio
+import random
+import time
+
+import openai
+
+from src.constants import (
+    COMPLETION_MAX_RETRIES,
+    COMPLETION_BACKOFF_BASE_SECONDS,
+    COMPLETION_BACKOFF_MAX_SECONDS,
+    CIRCUIT_FAILURE_THRESHOLD,
+    CIRCUIT_OPEN_SECONDS,
+    MODEL_FALLBACKS,
+)
+from src.utils import logger
+
+T = TypeVar("T")
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half-open"
+
+
+class CircuitOpenError(Exception):
+    def __init__(self, model: str):
+        super().__init__(f"{model} is temporarily unavailable, please try again in a bit")
+        self.model = model
+
+
+@dataclass
+class RetryStats:
+    attempts: int = 0
+    retries: int = 0
+    failures: int = 0
+    fallbacks: int = 0
+    rejected: int = 0
+    breaker_opened: int = 0
+    breaker_closed: int = 0
+
+
+class CircuitBreaker:
+    """Opens after `failure_threshold` transient failures in a row and
+    rejects calls for `open_seconds`. Then a single probe call is let
+    through; it closes the breaker again or re-opens it."""
+
+    def __init__(self, name: str, failure_threshold: int, open_seconds: float, stats: RetryStats):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.open_seconds = open_seconds
+        self.stats = stats
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self._probing = False
+
+    def allow(self) -> bool:
+        if self.state == OPEN and time.monotonic() - self.opened_at >= self.open_seconds:
+            self._set_state(HALF_OPEN)
+        if self.state == HALF_OPEN:
+            if self._probing:
+                return False
+            self._probing = True
+        return self.state != OPEN
+
+    def record_success(self):
+        self.failures = 0
+        self._probing = False
+        if self.state != CLOSED:
+            self.stats.breaker_closed += 1
+            self._set_state(CLOSED)
+
+    def record_cancelled(self):
+        self._probing = False
+
+    def record_failure(self):
+        self.failures += 1
+        self._probing = False
+        if self.state == HALF_OPEN or (
+            self.state == CLOSED and self.failures >= self.failure_threshold
+        ):
+            self.opened_at = time.monotonic()
+            self.stats.breaker_opened += 1
+            self._set_state(OPEN)
+
+    def _set_state(self, state: str):
+        logger.warning(f"circuit breaker for {self.name}: {self.state} -> {state}")
+        self.state = state
+
+
+def is_transient(error: Exception) -> bool:
+    if isinstance(error, (openai.APIConnectionError, openai.RateLimitError)):
+        return True
+    if isinstance(error, openai.APIStatusError):
+        return error.status_code in (408, 409) or error.status_code >= 500
+    return False
+
+
+def retry_after_seconds(error: Exception) -> Optional[float]:
+    response = getattr(error, "response", None)
+    if response is None:
+        return None
+    headers = response.headers
+    try:
+        if "retry-after-ms" in headers:
+            return float(headers["retry-after-ms"]) / 1000
+        if "retry-after" in headers:
+            return float(headers["retry-after"])
+    except ValueError:
+        pass
+    return None
+
+
+class ResilientCaller:
+    """Runs OpenAI requests with retries and per-model circuit breakers.
+
+    Transient errors (connection errors, timeouts, 429s and 5xx) are retried
+    with jittered exponential backoff, or after the server's Retry-After.
+    While a model's breaker is open its requests fail fast, or go to the
+    model's entry in `fallbacks` if there is one.
+    """
+
+    def __init__(
+        self,
+        max_retries: int,
+        backoff_base_seconds: float,
+        backoff_max_seconds: float,
+        failure_threshold: int,
+        open_seconds: float,
+        fallbacks: Optional[Dict[str, str]] = None,
+    ):
+        self.max_retries = max_retries
+        self.backoff_base_seconds = backoff_base_seconds
+        self.backoff_max_seconds = backoff_max_seconds
+        self.failure_threshold = failure_threshold
+        self.open_seconds = open_seconds
+        self.fallbacks = fallbacks or {}
+        self.stats = RetryStats()
+        self.breakers: Dict[str, CircuitBreaker] = {}
+
+    def breaker(self, model: str) -> CircuitBreaker:
+        if model not in self.breakers:
+            self.breakers[model] = CircuitBreaker(
+                model, self.failure_threshold, self.open_seconds, self.stats
+            )
+        return self.breakers[model]
+
+    async def call(self, model: str, request: Callable[[str], Awaitable[T]]) -> T:
+        """Calls `request` with the model to use until it succeeds."""
+        models = [model]
+        if model in self.fallbacks:
+            models.append(self.fallbacks[model])
+
+        error: Exception = CircuitOpenError(model)
+        for current in models:
+            breaker = self.breaker(current)
+            if not breaker.allow():
+                self.stats.rejected += 1
+                continue
+            if current != model:
+                self.stats.fallbacks += 1
+                logger.warning(f"falling back from {model} to {current}")
+            try:
+                return await self._call_with_retries(current, breaker, request)
+            except Exception as e:
+                if not is_transient(e):
+                    raise
+                error = e
+        raise error
+
+    async def _call_with_retries(
+        self, model: str, breaker: CircuitBreaker, request: Callable[[str], Awaitable[T]]
+    ) -> T:
+        attempt = 0
+        while True:
+            self.stats.attempts += 1
+            try:
+                result = await request(model)
+            except asyncio.CancelledError:
+                breaker.record_cancelled()
+                raise
+            except Exception as e:
+                if not is_transient(e):
+                    # the API answered, so the model itself is fine
+                    breaker.record_success()
+                    raise
+                self.stats.failures += 1
+                breaker.record_failure()
+                delay = self._backoff(attempt, e)
+                if attempt >= self.max_retries or delay is None or breaker.state == OPEN:
+                    raise
+                logger.info(f"retrying {model} in {delay:.1f}s after: {e}")
+                error = e
+            else:
+                breaker.record_success()
+                return result
+
+            self.stats.retries += 1
+            attempt += 1
+            await asyncio.sleep(delay)
+            if not breaker.allow():
+                raise error
+
+    def _backoff(self, attempt: int, error: Exception) -> Optional[float]:
+        """Seconds to wait before the next attempt, None if the server asks
+        for longer than we are willing to wait."""
+        retry_after = retry_after_seconds(error)
+        if retry_after is not None:
+            return retry_after if retry_after <= self.backoff_max_seconds else None
+        delay = min(self.backoff_max_seconds, self.backoff_base_seconds * 2**attempt)
+        return random.uniform(delay / 2, delay)
+
+
+completion_caller = ResilientCaller(
+    max_retries=COMPLETION_MAX_RETRIES,
+    backoff_base_seconds=COMPLETION_BACKOFF_BASE_SECONDS,
+    backoff_max_seconds=COMPLETION_BACKOFF_MAX_SECONDS,
+    failure_threshold=CIRCUIT_FAILURE_THRESHOLD,
+    open_seconds=CIRCUIT_OPEN_SECONDS,
+    fallbacks=MODEL_FALLBACKS,
+)
@@ -0,0 +1,121 @@
+from collections import deque
+from dataclasses import dataclass
+from typing import Deque, Dict, List, Optional, Tuple
+import asyncio
+import time
+
+import discord
+
+from src.constants import CHANNEL_SENDS_PER_WINDOW, CHANNEL_SEND_WINDOW_SECONDS
+from src.utils import split_into_shorter_messages
+
+
+@dataclass
+class SendQueueStats:
+    sends: int = 0
+    replies: int = 0
+    folded_notices: int = 0
+    max_queue_depth: int = 0
+    paced_seconds: float = 0.0
+
+
+class SendQueue:
+    """Outbound Discord messages, one FIFO queue per channel.
+
+    Sends to a channel go out one at a time and in order, paced to at most
+    `max_sends` per `window_seconds` so they stay under Discord's
+    per-channel message limit instead of running into 429s (discord.py
+    still handles the rate limit headers of every request). Replies are
+    packed into as few messages as possible and a status notice rides
+    along as an embed on the last one.
+    """
+
+    def __init__(self, max_sends: int, window_seconds: float):
+        self.max_sends = max_sends
+        self.window_seconds = window_seconds
+        self.stats = SendQueueStats()
+        self._queues: Dict[int, Deque[Tuple[discord.abc.Messageable, dict, asyncio.Future]]] = {}
+        self._sent_at: Dict[int, Deque[float]] = {}
+        self._workers: Dict[int, asyncio.Task] = {}
+
+    @property
+    def queue_depth(self) -> int:
+        return sum(len(queue) for queue in self._queues.values())
+
+    async def send(self, channel: discord.abc.Messageable, **kwargs) -> discord.Message:
+        """Queues a `channel.send(**kwargs)` and returns the sent message."""
+        return await self._enqueue(channel, kwargs)
+
+    async def send_reply(
+        self,
+        channel: discord.abc.Messageable,
+        text: str,
+        notice: Optional[discord.Embed] = None,
+    ) -> List[discord.Message]:
+        """Sends a reply, with `notice` as an embed on its last message."""
+        parts = [part for part in split_into_shorter_messages(text) if part.strip()]
+        requests = [{"content": part} for part in parts]
+        if notice is not None:
+            if requests:
+                requests[-1]["embed"] = notice
+                self.stats.folded_notices += 1
+            else:
+                requests.append({"embed": notice})
+        self.stats.replies += 1
+        # queue every part before waiting so they go out back to back
+        futures = [self._enqueue(channel, request) for request in requests]
+        return list(await asyncio.gather(*futures))
+
+    def _enqueue(self, channel: discord.abc.Messageable, kwargs: dict) -> asyncio.Future:
+        future = asyncio.get_running_loop().create_future()
+        queue = self._queues.setdefault(channel.id, deque())
+        queue.append((channel, kwargs, future))
+        self.stats.max_queue_depth = max(self.stats.max_queue_depth, len(queue))
+        if channel.id not in self._workers:
+            self._workers[channel.id] = asyncio.create_task(self._drain(channel.id))
+        return future
+
+    async def _drain(self, channel_id: int):
+        queue = self._queues[channel_id]
+        sent_at = self._sent_at.setdefault(channel_id, deque())
+        try:
+            while queue:
+                channel, kwargs, future = queue.popleft()
+                if future.done():
+                    continue
+                await self._pace(sent_at)
+                try:
+                    message = await channel.send(**kwargs)
+                except Exception as e:
+                    if not future.done():
+                        future.set_exception(e)
+                    continue
+                finally:
+                    sent_at.append(time.monotonic())
+                self.stats.sends += 1
+                if not future.done():
+                    future.set_result(message)
+        finally:
+            del self._workers[channel_id]
+            if not queue:
+                del self._queues[channel_id]
+            self._prune(sent_at)
+            if not sent_at:
+                del self._sent_at[channel_id]
+
+    def _prune(self, sent_at: Deque[float]):
+        while sent_at and time.monotonic() - sent_at[0] >= self.window_seconds:
+            sent_at.popleft()
+
+    async def _pace(self, sent_at: Deque[float]):
+        self._prune(sent_at)
+        if len(sent_at) >= self.max_sends:
+            wait = sent_at[0] + self.window_seconds - time.monotonic()
+            self.stats.paced_seconds += wait
+            await asyncio.sleep(wait)
+            self._prune(sent_at)
+
+
+send_queue = SendQueue(
+    max_sends=CHANNEL_SENDS_PER_WINDOW, window_seconds=CHANNEL_SEND_WINDOW_SECONDS
+)
@@ -0,0 +1,257 @@
+from dataclasses import dataclass, replace
+from typing import Dict, Iterable, List, Optional, Set
+import asyncio
+import datetime
+import sqlite3
+import threading
+
+from src.base import ThreadConfig
+from src.constants import SESSION_DB_PATH, SESSION_FLUSH_SECONDS
+from src.utils import logger
+
+
+@dataclass
+class Session:
+    channel_id: int
+    guild_id: int
+    user_id: int
+    config: ThreadConfig
+    last_activity: datetime.datetime
+    reminder_sent: bool = False
+
+
+class MemorySessionBackend:
+    """Keeps nothing across restarts."""
+
+    def load_all(self) -> List[Session]:
+        return []
+
+    def write(self, upserts: List[Session], deletes: List[int]):
+        pass
+
+
+class SQLiteSessionBackend:
+    """Stores sessions in a SQLite database in WAL mode.
+
+    Methods are blocking and meant to be run in a worker thread.
+    """
+
+    def __init__(self, path: str):
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            """CREATE TABLE IF NOT EXISTS sessions (
+                channel_id INTEGER PRIMARY KEY,
+                guild_id INTEGER NOT NULL,
+                user_id INTEGER NOT NULL,
+                model TEXT NOT NULL,
+                max_tokens INTEGER NOT NULL,
+                temperature REAL NOT NULL,
+                last_activity REAL NOT NULL,
+                reminder_sent INTEGER NOT NULL
+            )"""
+        )
+        self._db.commit()
+
+    def load_all(self) -> List[Session]:
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT channel_id, guild_id, user_id, model, max_tokens, temperature,"
+                " last_activity, reminder_sent FROM sessions"
+            ).fetchall()
+        return [
+            Session(
+                channel_id=row[0],
+                guild_id=row[1],
+                user_id=row[2],
+                config=ThreadConfig(model=row[3], max_tokens=row[4], temperature=row[5]),
+                last_activity=datetime.datetime.fromtimestamp(row[6]),
+                reminder_sent=bool(row[7]),
+            )
+            for row in rows
+        ]
+
+    def write(self, upserts: List[Session], deletes: List[int]):
+        with self._lock, self._db:
+            self._db.executemany(
+                "INSERT OR REPLACE INTO sessions VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                [
+                    (
+                        s.channel_id,
+                        s.guild_id,
+                        s.user_id,
+                        s.config.model,
+                        s.config.max_tokens,
+                        s.config.temperature,
+                        s.last_activity.timestamp(),
+                        int(s.reminder_sent),
+                    )
+                    for s in upserts
+                ],
+            )
+            self._db.executemany(
+                "DELETE FROM sessions WHERE channel_id = ?", [(c,) for c in deletes]
+            )
+
+
+class SessionStore:
+    """Active chat sessions, keyed by channel id and indexed by user and guild.
+
+    Reads and writes only touch the in-memory copy; changes are written
+    behind to the backend in batches every `flush_seconds` from a worker
+    thread, so the hot path never waits on disk, and once more on `close`.
+    """
+
+    def __init__(self, backend, flush_seconds: float):
+        self.backend = backend
+        self.flush_seconds = flush_seconds
+        self._sessions: Dict[int, Session] = {}
+        self._by_user: Dict[int, int] = {}
+        self._by_guild: Dict[int, Set[int]] = {}
+        # users whose chat channel is being created right now
+        self._creating: Set[int] = set()
+        self._dirty: Set[int] = set()
+        self._deleted: Set[int] = set()
+        self._flush_task: Optional[asyncio.Task] = None
+        self._loaded = False
+
+    def __contains__(self, channel_id: int) -> bool:
+        return channel_id in self._sessions
+
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+    def get(self, channel_id: int) -> Optional[Session]:
+        return self._sessions.get(channel_id)
+
+    def values(self) -> List[Session]:
+        return list(self._sessions.values())
+
+    def for_user(self, user_id: int) -> Optional[Session]:
+        channel_id = self._by_user.get(user_id)
+        return self._sessions.get(channel_id) if channel_id is not None else None
+
+    def for_guild(self, guild_id: int) -> List[Session]:
+        return [self._sessions[c] for c in self._by_guild.get(guild_id, ())]
+
+    def try_reserve(self, user_id: int) -> bool:
+        """Claims the right to create a chat for the user.
+
+        Fails if the user already has a session or one is being created, so
+        concurrent /chat calls from one user create exactly one channel. The
+        check and the claim happen without awaiting in between.
+        """
+        if user_id in self._by_user or user_id in self._creating:
+            return False
+        self._creating.add(user_id)
+        return True
+
+    def release(self, user_id: int):
+        self._creating.discard(user_id)
+
+    def add(self, session: Session):
+        self._index(session)
+        self._deleted.discard(session.channel_id)
+        self._dirty.add(session.channel_id)
+
+    def _index(self, session: Session):
+        previous = self._sessions.get(session.channel_id)
+        if previous:
+            self._unindex(previous)
+        self._sessions[session.channel_id] = session
+        self._by_user[session.user_id] = session.channel_id
+        self._by_guild.setdefault(session.guild_id, set()).add(session.channel_id)
+
+    def _unindex(self, session: Session):
+        if self._by_user.get(session.user_id) == session.channel_id:
+            del self._by_user[session.user_id]
+        guild_channels = self._by_guild.get(session.guild_id)
+        if guild_channels is not None:
+            guild_channels.discard(session.channel_id)
+            if not guild_channels:
+                del self._by_guild[session.guild_id]
+
+    def touch(self, channel_id: int):
+        """Records activity in the channel and re-arms the reminder."""
+        session = self._sessions.get(channel_id)
+        if session:
+            session.last_activity = datetime.datetime.now()
+            session.reminder_sent = False
+            self._dirty.add(channel_id)
+
+    def mark_reminder_sent(self, channel_id: int):
+        session = self._sessions.get(channel_id)
+        if session:
+            session.reminder_sent = True
+            self._dirty.add(channel_id)
+
+    def remove(self, channel_id: int) -> Optional[Session]:
+        session = self._sessions.pop(channel_id, None)
+        self._dirty.discard(channel_id)
+        if session:
+            self._unindex(session)
+            self._deleted.add(channel_id)
+        return session
+
+    async def load(self):
+        if self._loaded:
+            return
+        self._loaded = True
+        sessions = await asyncio.to_thread(self.backend.load_all)
+        for session in sessions:
+            if session.channel_id not in self._sessions:
+                self._index(session)
+        logger.info(f"Loaded {len(sessions)} chat sessions")
+
+    def reconcile(
+        self, guild_id: int, existing_channel_ids: Iterable[int]
+    ) -> List[Session]:
+        """Drops the guild's sessions whose channel no longer exists and
+        returns them."""
+        existing = set(existing_channel_ids)
+        return [
+            self.remove(session.channel_id)
+            for session in self.for_guild(guild_id)
+            if session.channel_id not in existing
+        ]
+
+    def start(self):
+        if self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._flush_loop())
+
+    async def flush(self):
+        if not self._dirty and not self._deleted:
+            return
+        # copies, the worker thread must not read sessions while they change
+        upserts = [replace(self._sessions[c]) for c in self._dirty if c in self._sessions]
+        deletes = list(self._deleted)
+        self._dirty.clear()
+        self._deleted.clear()
+        try:
+            await asyncio.to_thread(self.backend.write, upserts, deletes)
+        except Exception as e:
+            logger.error(f"Failed to write chat sessions: {e}")
+            self._dirty.update(s.channel_id for s in upserts)
+            self._deleted.update(c for c in deletes if c not in self._sessions)
+
+    async def close(self):
+        """Stops the periodic flush and writes the changes still pending."""
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            self._flush_task = None
+        await self.flush()
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.flush_seconds)
+            await self.flush()
+
+
+sessions = SessionStore(
+    backend=SQLiteSessionBackend(SESSION_DB_PATH)
+    if SESSION_DB_PATH
+    else MemorySessionBackend(),
+    flush_seconds=SESSION_FLUSH_SECONDS,
+)
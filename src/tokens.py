@@ -0,0 +1,127 @@
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+import math
+
+from src.constants import CONTEXT_HEADROOM_TOKENS, MODEL_CONTEXT_SIZES
+from src.utils import logger
+
+try:
+    import tiktoken
+except ImportError:  # optional, fall back to the calibrated estimator
+    tiktoken = None
+
+# chat format overhead, see https://github.com/openai/openai-cookbook
+TOKENS_PER_MESSAGE = 4
+TOKENS_PER_REPLY = 3
+DEFAULT_CONTEXT_SIZE = 4096
+
+
+@dataclass
+class TokenStats:
+    requests: int = 0
+    prompt_tokens: int = 0
+    max_prompt_tokens: int = 0
+    trimmed_messages: int = 0
+    rejected_requests: int = 0
+
+    @property
+    def average_prompt_tokens(self) -> float:
+        return self.prompt_tokens / self.requests if self.requests else 0.0
+
+
+class TokenCounter:
+    """Counts chat tokens locally.
+
+    Uses tiktoken when it is installed. Otherwise tokens are estimated from
+    the character count, with a scale factor calibrated against the
+    `usage.prompt_tokens` reported by the API.
+    """
+
+    def __init__(self, chars_per_token: float = 4.0):
+        self.chars_per_token = chars_per_token
+        self.scale = 1.0
+        self._encodings: Dict[str, object] = {}
+
+    def count_text(self, text: Optional[str], model: str) -> int:
+        if not text:
+            return 0
+        encoding = self._encoding(model)
+        if encoding is not None:
+            return len(encoding.encode(text))
+        return math.ceil(len(text) / self.chars_per_token * self.scale)
+
+    def count_message(self, message: dict, model: str) -> int:
+        return (
+            TOKENS_PER_MESSAGE
+            + self.count_text(message.get("content"), model)
+            + self.count_text(message.get("name"), model)
+        )
+
+    def count_messages(self, messages: List[dict], model: str) -> int:
+        return TOKENS_PER_REPLY + sum(self.count_message(m, model) for m in messages)
+
+    def calibrate(self, estimated: int, actual: Optional[int]):
+        if tiktoken is not None or not estimated or not actual:
+            return
+        # smooth towards the observed ratio so a single odd request can't skew it
+        self.scale *= 1 + 0.2 * (actual / estimated - 1)
+
+    def _encoding(self, model: str):
+        if tiktoken is None:
+            return None
+        if model not in self._encodings:
+            try:
+                self._encodings[model] = tiktoken.encoding_for_model(model)
+            except KeyError:
+                self._encodings[model] = tiktoken.get_encoding("cl100k_base")
+        return self._encodings[model]
+
+
+token_counter = TokenCounter()
+token_stats = TokenStats()
+
+
+def context_size(model: str) -> int:
+    return MODEL_CONTEXT_SIZES.get(model, DEFAULT_CONTEXT_SIZE)
+
+
+def fit_to_context(
+    rendered: List[dict],
+    model: str,
+    max_tokens: int,
+    system_tokens: Optional[int] = None,
+    keep_first: int = 1,
+) -> Tuple[Optional[List[dict]], int]:
+    """Drops the oldest conversation messages until the prompt plus
+    `max_tokens` and some headroom fits the model's context window.
+
+    The first `keep_first` messages (the system prompt, and a conversation
+    summary if there is one) and the latest message are always kept; the
+    messages are None if even those don't fit. Also returns the estimated
+    prompt token count. `system_tokens` skips re-counting the system prompt
+    when its size is already known.
+    """
+    budget = context_size(model) - max_tokens - CONTEXT_HEADROOM_TOKENS
+    counts = [
+        system_tokens
+        if i == 0 and system_tokens is not None
+        else token_counter.count_message(m, model)
+        for i, m in enumerate(rendered)
+    ]
+    total = TOKENS_PER_REPLY + sum(counts)
+    start = keep_first
+    while total > budget and start < len(rendered) - 1:
+        total -= counts[start]
+        start += 1
+    if total > budget:
+        token_stats.rejected_requests += 1
+        return None, total
+
+    fitted = rendered[:keep_first] + rendered[start:]
+    token_stats.requests += 1
+    token_stats.prompt_tokens += total
+    token_stats.max_prompt_tokens = max(token_stats.max_prompt_tokens, total)
+    token_stats.trimmed_messages += start - keep_first
+    if start > keep_first:
+        logger.info(f"trimmed {start - keep_first} messages to fit {model} context ({total} tokens)")
+    return fitted, total
@@ -6,10 +6,13 @@ import logging
 logger = logging.getLogger(__name__)
 from src.base import Message
 from discord import Message as DiscordMessage
-from typing import Optional, List
+from typing import Any, Awaitable, Callable, Dict, Hashable, Optional, List, Tuple
+import asyncio
+import re
+import time
 import discord
 
-from src.constants import MAX_CHARS_PER_REPLY_MSG, INACTIVATE_THREAD_PREFIX
+from src.constants import MAX_CHARS_PER_REPLY_MSG
 
 
 def discord_message_to_message(message: DiscordMessage) -> Optional[Message]:
@@ -28,33 +31,75 @@ def discord_message_to_message(message: DiscordMessage) -> Optional[Message]:
     return None
 
 
-def split_into_shorter_messages(message: str) -> List[str]:
-    return [
-        message[i : i + MAX_CHARS_PER_REPLY_MSG]
-        for i in range(0, len(message), MAX_CHARS_PER_REPLY_MSG)
-    ]
+CODE_FENCE = "```"
+# a line that opens or closes a code block, "```python" but not "```ls``` lists"
+FENCE_LINE = re.compile(r"```[\w+.-]{0,20}")
+SENTENCE_END = re.compile(r"[.!?][)\]\"'*_]*\s+")
 
 
-def is_last_message_stale(
-    interaction_message: DiscordMessage, last_message: DiscordMessage, bot_id: str
-) -> bool:
-    return (
-        last_message
-        and last_message.id != interaction_message.id
-        and last_message.author
-        and last_message.author.id != bot_id
-    )
+def _split_point(text: str) -> int:
+    """Where to end a message taken from the start of `text`: after the last
+    paragraph break or before a code fence, else after the last line break,
+    sentence or word in the second half, else anywhere."""
+    half = len(text) // 2
+    best = max(text.rfind("\n\n") + 2, text.rfind("\n" + CODE_FENCE) + 1)
+    if best > half:
+        return best
+    best = text.rfind("\n") + 1
+    if best > half:
+        return best
+    sentences = [m.end() for m in SENTENCE_END.finditer(text, half)]
+    if sentences:
+        return sentences[-1]
+    best = text.rfind(" ") + 1
+    if best > half:
+        return best
+    return len(text)
 
 
-async def close_thread(thread: discord.Thread):
-    await thread.edit(name=INACTIVATE_THREAD_PREFIX)
-    await thread.send(
-        embed=discord.Embed(
-            description="**Thread closed** - Context limit reached, closing...",
-            color=discord.Color.blue(),
-        )
-    )
-    await thread.edit(archived=True, locked=True)
+def _open_fence_after(fence: Optional[str], text: str) -> Optional[str]:
+    for line in text.split("\n"):
+        line = line.strip()
+        if FENCE_LINE.fullmatch(line):
+            fence = None if fence else line
+    return fence
+
+
+def split_into_shorter_messages(
+    message: str, limit: int = MAX_CHARS_PER_REPLY_MSG
+) -> List[str]:
+    """Packs a reply into as few messages of at most `limit` characters as
+    possible, splitting on paragraph, code fence, line, sentence and word
+    boundaries. A code block cut in two is closed at the end of one message
+    and reopened, with its language, in the next.
+
+    Only the first `limit` characters decide where the first message ends,
+    so the split of a growing streamed reply stays stable.
+    """
+    parts = []
+    fence = None
+    rest = message
+    while rest:
+        prefix = f"{fence}\n" if fence else ""
+        if len(prefix) + len(rest) <= limit:
+            parts.append(prefix + rest)
+            break
+        # leave room to close a code block that is still open
+        window = rest[: limit - len(prefix) - len(CODE_FENCE) - 1]
+        cut = _split_point(window)
+        chunk, rest = window[:cut], rest[cut:]
+        fence = _open_fence_after(fence, chunk)
+        part = prefix + chunk.rstrip("\n")
+        if fence:
+            part += f"\n{CODE_FENCE}"
+            # the block ends right after the cut, don't reopen it just to close it
+            line, _, after = rest.lstrip("\n").partition("\n")
+            if line.strip() == CODE_FENCE:
+                fence, rest = None, after
+        if not fence:
+            rest = rest.lstrip("\n")
+        parts.append(part)
+    return parts
 
 
 def should_block(guild: Optional[discord.Guild]) -> bool:
@@ -68,3 +113,84 @@ def should_block(guild: Optional[discord.Guild]) -> bool:
         logger.info(f"Guild {guild} not allowed")
         return True
     return False
+
+
+class SharedCalls:
+    """Runs one call per key at a time, concurrent callers of the same key
+    share its result.
+
+    A failure is raised to every caller. If the caller running the call is
+    cancelled, the ones waiting on it start over rather than wait forever.
+    """
+
+    def __init__(self):
+        self._in_flight: Dict[Hashable, asyncio.Future] = {}
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._in_flight
+
+    async def call(self, key: Hashable, call: Callable[[], Awaitable[Any]]) -> Any:
+        while key in self._in_flight:
+            future = self._in_flight[key]
+            try:
+                return await asyncio.shield(future)
+            except asyncio.CancelledError:
+                if not future.cancelled():
+                    raise  # this caller was cancelled, not the shared call
+
+        future = asyncio.get_running_loop().create_future()
+        self._in_flight[key] = future
+        try:
+            value = await call()
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            # mark retrieved so an unshared failure isn't reported as unhandled
+            future.exception()
+            raise
+        else:
+            future.set_result(value)
+            return value
+        finally:
+            if self._in_flight.get(key) is future:
+                del self._in_flight[key]
+
+
+class TTLCache:
+    """Caches values that rarely change, like guild members and channels.
+
+    Concurrent misses for the same key share a single fetch.
+    """
+
+    def __init__(self, ttl_seconds: float):
+        self.ttl_seconds = ttl_seconds
+        self._values: Dict[Hashable, Tuple[float, Any]] = {}
+        self._fetching = SharedCalls()
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        entry = self._values.get(key)
+        if entry and entry[0] > time.monotonic():
+            return entry[1]
+        return None
+
+    def set(self, key: Hashable, value: Any):
+        self._values[key] = (time.monotonic() + self.ttl_seconds, value)
+
+    def invalidate(self, key: Hashable):
+        self._values.pop(key, None)
+
+    async def get_or_fetch(
+        self, key: Hashable, fetch: Callable[[], Awaitable[Any]]
+    ) -> Optional[Any]:
+        entry = self._values.get(key)
+        if entry and entry[0] > time.monotonic():
+            return entry[1]
+
+        async def fetch_and_set():
+            value = await fetch()
+            self.set(key, value)
+            return value
+
+        return await self._fetching.call(key, fetch_and_set)
@@ -0,0 +1,12 @@
+import os
+import sys
+
+# src.constants reads these at import
+os.environ.setdefault("DISCORD_BOT_TOKEN", "test")
+os.environ.setdefault("DISCORD_CLIENT_ID", "1")
+os.environ.setdefault("OPENAI_API_KEY", "sk-test")
+os.environ.setdefault("DEFAULT_MODEL", "gpt-3.5-turbo")
+os.environ.setdefault("ALLOWED_SERVER_IDS", "1")
+os.environ.setdefault("SESSION_DB_PATH", "")
+os.environ.setdefault("SERVER_TO_MODERATION_CHANNEL", "1:2")
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
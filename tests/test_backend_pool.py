@@ -0,0 +1,74 @@
+from types import SimpleNamespace
+import asyncio
+import time
+
+import openai
+import pytest
+
+from src.backend_pool import BackendPool, OpenAIBackend
+from src.constants import MODERATION_MODEL
+
+
+def backend(base_url=None, models=frozenset()):
+    return OpenAIBackend("sk-test", base_url, models, client=object())
+
+
+def test_moderation_only_goes_to_openai_or_opted_in_servers():
+    openai_backend = backend()
+    local = backend("http://localhost:8000/v1")
+    opted_in = backend("http://localhost:8001/v1", frozenset({MODERATION_MODEL, "llama"}))
+    assert openai_backend.serves(MODERATION_MODEL, moderation=True)
+    assert not local.serves(MODERATION_MODEL, moderation=True)
+    assert opted_in.serves(MODERATION_MODEL, moderation=True)
+
+    pool = BackendPool([local], health_check_seconds=30)
+    with pytest.raises(ValueError):
+        pool.choose(MODERATION_MODEL, moderation=True)
+
+
+def test_moderation_rate_limits_do_not_affect_completion_routing():
+    b = backend()
+    headers = {
+        "x-ratelimit-limit-requests": "100",
+        "x-ratelimit-remaining-requests": "0",
+        "x-ratelimit-reset-requests": "10s",
+    }
+    b.record_response(headers, 0.1, moderation=True)
+    now = time.monotonic()
+    assert b.moderation_limit.headroom(now) == 0
+    assert b.requests_limit.headroom(now) == 1.0
+
+
+class FakeStream(openai.AsyncStream):
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.closed = False
+
+    async def __aiter__(self):
+        for chunk in self.chunks:
+            yield chunk
+
+    async def close(self):
+        self.closed = True
+
+
+def test_streams_count_as_in_flight_until_read_or_closed():
+    async def main():
+        b = backend()
+        pool = BackendPool([b], health_check_seconds=30)
+
+        async def send(client):
+            return SimpleNamespace(headers={}, parse=lambda: FakeStream(["a", "b"]))
+
+        stream = await pool.call(send, model="gpt-3.5-turbo")
+        assert b.in_flight == 1
+        assert [chunk async for chunk in stream] == ["a", "b"]
+        assert b.in_flight == 0
+
+        stream = await pool.call(send, model="gpt-3.5-turbo")
+        assert b.in_flight == 1
+        await stream.close()
+        await stream.close()
+        assert b.in_flight == 0
+
+    asyncio.run(main())
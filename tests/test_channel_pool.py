@@ -0,0 +1,63 @@
+import asyncio
+from types import SimpleNamespace
+
+import discord
+
+from src.channel_pool import ChannelPool
+
+
+class FakeChannel:
+    def __init__(self, channel_id: int, last_message_id=None, edit_error=None):
+        self.id = channel_id
+        self.last_message_id = last_message_id
+        self.created_at = discord.utils.utcnow()
+        self.edit_error = edit_error
+        self.deleted = False
+
+    async def edit(self, **kwargs):
+        if self.edit_error is not None:
+            raise self.edit_error
+        return self
+
+    async def delete(self, reason=None):
+        self.deleted = True
+
+
+async def no_create():
+    return None
+
+
+def test_adopt_refuses_channels_with_messages():
+    pool = ChannelPool(size=2, max_age_seconds=3600, create=no_create)
+    assert pool.adopt(FakeChannel(1))
+    assert not pool.adopt(FakeChannel(2, last_message_id=123))
+    assert 1 in pool and 2 not in pool
+
+
+def test_adopting_a_channel_twice_keeps_one_copy():
+    async def main():
+        pool = ChannelPool(size=2, max_age_seconds=3600, create=no_create)
+        channel = FakeChannel(1)
+        assert pool.adopt(channel)
+        assert not pool.adopt(channel)
+        assert len(pool) == 1
+        assert await pool.claim(name="chat", overwrites={}, reason="test") is channel
+        assert await pool.claim(name="chat", overwrites={}, reason="test") is None
+
+    asyncio.run(main())
+
+
+def test_claim_retires_a_channel_that_fails_to_edit():
+    async def main():
+        pool = ChannelPool(size=2, max_age_seconds=3600, create=no_create)
+        error = discord.HTTPException(SimpleNamespace(status=500, reason="error"), "error")
+        broken, good = FakeChannel(1, edit_error=error), FakeChannel(2)
+        pool.adopt(broken)
+        pool.adopt(good)
+        assert await pool.claim(name="chat", overwrites={}, reason="test") is good
+        await asyncio.sleep(0)
+        assert broken.deleted
+        assert pool.stats.failed == 1
+        assert await pool.claim(name="chat", overwrites={}, reason="test") is None
+
+    asyncio.run(main())
@@ -0,0 +1,51 @@
+import asyncio
+
+from src.base import Message
+from src.completion import CompiledSystemPrompt, StreamingReply, render_prompt
+from src.tokens import context_size, token_counter
+
+MODEL = "gpt-3.5-turbo"
+
+
+def test_trimming_keeps_the_conversation_summary():
+    # each message is a few hundred tokens, so only some of them fit
+    messages = [
+        Message(user="user", text=f"message {i} " + "word " * 300)
+        for i in range(context_size(MODEL) // 100)
+    ]
+    rendered, _ = render_prompt(
+        messages, model=MODEL, max_tokens=256, summary="SUMMARY OF EARLIER MESSAGES"
+    )
+    assert "SUMMARY OF EARLIER MESSAGES" in rendered[1]["content"]
+    assert messages[-1].text in rendered[-1]["content"]
+    assert len(rendered) < len(messages) + 2
+
+
+def test_system_prompt_tokens_follow_calibration(monkeypatch):
+    prompt = CompiledSystemPrompt("bot")
+    prompt.tokens(MODEL)
+    monkeypatch.setattr(token_counter, "scale", token_counter.scale * 2)
+    assert prompt.tokens(MODEL) == token_counter.count_message(prompt.message, MODEL)
+
+
+def test_closing_a_streaming_reply_cancels_its_partial_check():
+    async def main():
+        started = asyncio.Event()
+
+        async def moderate(text):
+            started.set()
+            await asyncio.sleep(10)
+            return "", ""
+
+        reply = StreamingReply(
+            thread=None, edit_interval=60, moderate_partial=moderate, partial_moderation_chars=5
+        )
+        reply.text = "some partial text"
+        reply._check_partial()
+        check = reply._partial_check
+        await started.wait()
+        reply.close()
+        await asyncio.sleep(0)
+        assert check.cancelled()
+
+    asyncio.run(main())
@@ -0,0 +1,46 @@
+import asyncio
+from types import SimpleNamespace
+
+from src.conversation_cache import ConversationCache
+
+
+class FakeChannel:
+    def __init__(self, channel_id: int, texts):
+        self.id = channel_id
+        self.texts = texts
+        self.fetched = asyncio.Event()
+        self.release = asyncio.Event()
+        self.fetches = 0
+
+    async def history(self, limit):
+        self.fetches += 1
+        self.fetched.set()
+        await self.release.wait()
+        # newest first, like discord
+        for i, text in reversed(list(enumerate(self.texts))):
+            yield SimpleNamespace(
+                id=i,
+                type=None,
+                content=text,
+                author=SimpleNamespace(id=1, name="user"),
+                channel=self,
+            )
+
+
+def test_invalidation_during_a_cold_load_is_not_lost():
+    async def main():
+        cache = ConversationCache()
+        channel = FakeChannel(1, ["hello", "deleted later"])
+        loading = asyncio.create_task(cache.get_messages(channel))
+        await channel.fetched.wait()
+        cache.invalidate(channel.id)  # e.g. a bulk delete
+        channel.release.set()
+        assert [m.text for m in await loading] == ["hello", "deleted later"]
+
+        channel.texts = ["hello"]
+        assert [m.text for m in await cache.get_messages(channel)] == ["hello"]
+        assert channel.fetches == 2
+        assert [m.text for m in await cache.get_messages(channel)] == ["hello"]
+        assert channel.fetches == 2
+
+    asyncio.run(main())
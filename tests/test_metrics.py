@@ -0,0 +1,10 @@
+from src.metrics import Metrics
+from src.moderation import ModerationCacheStats
+
+
+def test_stats_properties_are_exported():
+    metrics = Metrics(enabled=True)
+    metrics.export_stats("moderation_cache", ModerationCacheStats(hits=3, misses=1))
+    lines = metrics.render().splitlines()
+    assert "moderation_cache_hits 3.0" in lines
+    assert "moderation_cache_hit_rate 0.75" in lines
@@ -0,0 +1,82 @@
+import asyncio
+
+from src import moderation
+from src.moderation import moderate_message, set_moderation_backend
+
+
+class FakeBackend:
+    def __init__(self, delay_seconds: float = 0.0):
+        self.delay_seconds = delay_seconds
+        self.calls = 0
+
+    async def moderate(self, inputs):
+        self.calls += 1
+        await asyncio.sleep(self.delay_seconds)
+        return [{"harassment": 0.0} for _ in inputs]
+
+
+class ShortBackend(FakeBackend):
+    async def moderate(self, inputs):
+        return (await super().moderate(inputs))[:-1]
+
+
+def use_backend(monkeypatch, backend):
+    monkeypatch.setattr(moderation, "moderation_backend", moderation.moderation_backend)
+    set_moderation_backend(backend)
+
+
+def test_identical_text_is_moderated_when_the_first_caller_is_cancelled(monkeypatch):
+    use_backend(monkeypatch, FakeBackend(delay_seconds=0.2))
+
+    async def main():
+        text = "copy pasted message that is cancelled"
+        first = asyncio.create_task(moderate_message(text, "user1"))
+        await asyncio.sleep(0)
+        second = asyncio.create_task(moderate_message(text, "user2"))
+        await asyncio.sleep(0.05)
+        first.cancel()
+        assert await asyncio.wait_for(second, 2) == ("", "")
+        assert first.cancelled()
+
+    asyncio.run(main())
+
+
+def test_event_loop_keeps_running_while_moderation_is_slow(monkeypatch):
+    use_backend(monkeypatch, FakeBackend(delay_seconds=0.5))
+
+    async def main():
+        loop = asyncio.get_running_loop()
+        gaps = []
+
+        async def heartbeat():
+            last = loop.time()
+            while True:
+                await asyncio.sleep(0.01)
+                now = loop.time()
+                gaps.append(now - last)
+                last = now
+
+        ticking = asyncio.create_task(heartbeat())
+        result = await moderate_message("a message the slow backend moderates", "user")
+        ticking.cancel()
+        assert result == ("", "")
+        assert len(gaps) >= 20
+        assert max(gaps) < 0.1
+
+    asyncio.run(main())
+
+
+def test_batch_with_missing_results_fails_every_caller(monkeypatch):
+    use_backend(monkeypatch, ShortBackend())
+
+    async def main():
+        batcher = moderation.ModerationBatcher(window_seconds=0.01, max_size=10)
+        results = await asyncio.wait_for(
+            asyncio.gather(
+                batcher.moderate("first"), batcher.moderate("second"), return_exceptions=True
+            ),
+            2,
+        )
+        assert all(isinstance(result, ValueError) for result in results)
+
+    asyncio.run(main())
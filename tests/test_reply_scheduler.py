@@ -0,0 +1,59 @@
+import asyncio
+
+from src.reply_scheduler import ReplyScheduler
+
+
+def run_replies(submissions):
+    """Submits `(name, withdraw)` messages to one channel, returns the replies sent."""
+
+    async def main():
+        scheduler = ReplyScheduler(debounce_seconds=0.01, max_delay_seconds=1)
+        sent = []
+
+        def reply(name):
+            async def send():
+                async with scheduler.sending(1):
+                    sent.append(name)
+
+            return send
+
+        for name, withdraw in submissions:
+            submission = scheduler.submit(1, reply(name))
+            if withdraw:
+                scheduler.withdraw(1, submission, reply(f"{name} withdrawn"))
+        await asyncio.sleep(0.1)
+        return sent
+
+    return asyncio.run(main())
+
+
+def test_messages_in_the_debounce_window_get_one_reply():
+    assert run_replies([("a", False), ("b", False)]) == ["b"]
+
+
+def test_withdrawing_the_latest_message_still_answers_earlier_ones():
+    assert run_replies([("a", False), ("b", True)]) == ["b withdrawn"]
+
+
+def test_withdrawing_the_only_message_sends_nothing():
+    assert run_replies([("a", True)]) == []
+
+
+def test_withdrawing_a_superseded_message_keeps_the_later_reply():
+    async def main():
+        scheduler = ReplyScheduler(debounce_seconds=0.01, max_delay_seconds=1)
+        sent = []
+
+        async def reply():
+            sent.append("c")
+
+        async def unused():
+            sent.append("unexpected")
+
+        submission = scheduler.submit(1, unused)
+        scheduler.submit(1, reply)
+        scheduler.withdraw(1, submission, unused)
+        await asyncio.sleep(0.1)
+        return sent
+
+    assert asyncio.run(main()) == ["c"]
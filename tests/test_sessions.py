@@ -0,0 +1,50 @@
+import asyncio
+import datetime
+
+from src.base import ThreadConfig
+from src.sessions import Session, SessionStore, SQLiteSessionBackend
+
+
+def session(channel_id: int) -> Session:
+    return Session(
+        channel_id=channel_id,
+        guild_id=1,
+        user_id=channel_id,
+        config=ThreadConfig(model="gpt-3.5-turbo", max_tokens=512, temperature=1.0),
+        last_activity=datetime.datetime.now(),
+    )
+
+
+def test_close_writes_pending_changes(tmp_path):
+    async def main():
+        store = SessionStore(SQLiteSessionBackend(str(tmp_path / "sessions.db")), flush_seconds=3600)
+        store.start()
+        store.add(session(1))
+        store.add(session(2))
+        await store.flush()
+        store.remove(2)
+        store.mark_reminder_sent(1)
+        await store.close()
+
+        restored = SessionStore(SQLiteSessionBackend(str(tmp_path / "sessions.db")), flush_seconds=3600)
+        await restored.load()
+        assert 2 not in restored
+        assert restored.get(1).reminder_sent
+
+    asyncio.run(main())
+
+
+def test_flush_writes_a_snapshot():
+    class Backend:
+        def write(self, upserts, deletes):
+            self.upserts = upserts
+
+    async def main():
+        backend = Backend()
+        store = SessionStore(backend, flush_seconds=3600)
+        store.add(session(1))
+        await store.flush()
+        store.mark_reminder_sent(1)
+        assert not backend.upserts[0].reminder_sent
+
+    asyncio.run(main())
@@ -0,0 +1,103 @@
+import asyncio
+
+from src.utils import TTLCache, split_into_shorter_messages
+
+
+def test_concurrent_misses_share_one_fetch():
+    async def main():
+        cache = TTLCache(ttl_seconds=60)
+        calls = 0
+
+        async def fetch():
+            nonlocal calls
+            calls += 1
+            await asyncio.sleep(0.01)
+            return "value"
+
+        results = await asyncio.gather(*(cache.get_or_fetch("key", fetch) for _ in range(5)))
+        assert results == ["value"] * 5
+        assert calls == 1
+        assert cache.get("key") == "value"
+
+    asyncio.run(main())
+
+
+def test_waiters_refetch_when_first_fetch_is_cancelled():
+    async def main():
+        cache = TTLCache(ttl_seconds=60)
+        started = asyncio.Event()
+
+        async def slow_fetch():
+            started.set()
+            await asyncio.sleep(10)
+
+        async def fetch():
+            return "value"
+
+        first = asyncio.create_task(cache.get_or_fetch("key", slow_fetch))
+        await started.wait()
+        second = asyncio.create_task(cache.get_or_fetch("key", fetch))
+        await asyncio.sleep(0)
+        first.cancel()
+        assert await asyncio.wait_for(second, 1) == "value"
+        assert first.cancelled()
+
+    asyncio.run(main())
+
+
+def test_failed_fetch_is_raised_to_every_waiter():
+    async def main():
+        cache = TTLCache(ttl_seconds=60)
+
+        async def fetch():
+            await asyncio.sleep(0.01)
+            raise RuntimeError("down")
+
+        results = await asyncio.gather(
+            *(cache.get_or_fetch("key", fetch) for _ in range(3)), return_exceptions=True
+        )
+        assert all(isinstance(r, RuntimeError) for r in results)
+        assert cache.get("key") is None
+
+    asyncio.run(main())
+
+
+def split(message, limit=200):
+    parts = split_into_shorter_messages(message, limit)
+    assert all(len(part) <= limit for part in parts)
+    return parts
+
+
+def test_plain_text_splits_between_sentences():
+    parts = split("This is a sentence. " * 30)
+    assert len(parts) == 4
+    assert all(part.rstrip().endswith(".") for part in parts)
+    assert " ".join(parts).split() == ("This is a sentence. " * 30).split()
+
+
+def test_code_block_is_closed_and_reopened_with_its_language():
+    parts = split("```python\n" + "print(1)\n" * 50 + "```")
+    assert len(parts) == 3
+    assert all(part.startswith("```python\n") and part.endswith("\n```") for part in parts)
+    assert sum(part.count("print(1)") for part in parts) == 50
+
+
+def test_no_empty_block_when_cut_before_the_closing_fence():
+    parts = split("```python\n" + "print(1)\n" * 20 + "```\n" + "word " * 50)
+    assert parts[0].endswith("print(1)\n```")
+    assert not any(part.startswith("```python\n```") for part in parts)
+    assert not parts[1].startswith("```")
+
+
+def test_inline_triple_backticks_dont_open_a_block():
+    message = "```npm install``` then run it. " + "Start the server and open it. " * 20
+    parts = split(message)
+    assert len(parts) == 4
+    assert sum("npm install" in part for part in parts) == 1
+
+
+def test_long_first_line_fits_the_limit():
+    parts = split("```" + "z" * 500)
+    assert "".join(parts) == "```" + "z" * 500
+    parts = split("word" * 100 + "\n" + "text " * 100)
+    assert len(parts) == 5